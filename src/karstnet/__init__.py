@@ -1,5 +1,7 @@
 from karstnet.base import *
 from karstnet.import_fc import *
+from karstnet.profiling import *
+from karstnet.batch import *
 from karstnet.utils.cleaning_fc import *
 from karstnet.utils.export_fc import *
 from karstnet.utils.nx_fc import *
@@ -19,11 +19,26 @@ graphs and compute statistics.
 import numpy as np
 import networkx as nx
 import scipy.stats as st
+import scipy.sparse as sp
+from scipy.sparse import csgraph
 import matplotlib.pyplot as plt
 import sqlite3
+import heapq
+from collections.abc import Mapping
+import copy
+import functools
+import inspect
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 # noinspection PyUnresolvedReferences
 import mplstereonet
 
+# ----Internal module dependancies
+from karstnet.profiling import _stage
+
 
 # *************************************************************
 # -------------------Test function--------------------------
@@ -40,6 +55,198 @@ def test_kn():
 # **************************************************************
 
 
+# Construction stages of a KGraph, in order of dependency
+_STAGES = ('lengths', 'orientations', 'branches', 'simplified')
+
+# Stage computing each edge attribute
+_EDGE_STAGES = {'length': 'lengths', 'length2d': 'orientations',
+                'azimuth': 'orientations', 'dip': 'orientations'}
+
+
+# Steps of characterize_graph, in the order of the results: name of the
+# step, metrics it computes and metrics it needs
+_CHARACTERIZATION_STEPS = (
+    ('mean length', ('mean length',), ()),
+    ('cv length', ('cv length',), ()),
+    ('length entropy', ('length entropy',), ()),
+    ('mean tortuosity', ('tortuosity',), ()),
+    ('orientation entropy', ('orientation entropy',), ()),
+    ('aspl,cpd', ('aspl', 'cpd'), ()),
+    ('md,cv degree', ('mean degree', 'cv degree'), ()),
+    ('cvd', ('correlation vertex degree',), ('cv degree',)),
+)
+
+# Metrics computed by characterize_graph
+_METRICS = tuple(metric for _, computed, _ in _CHARACTERIZATION_STEPS
+                 for metric in computed)
+
+# Groups of steps of characterize_graph run concurrently with an executor,
+# a step only depends on steps of its own group
+_CHARACTERIZATION_GROUPS = {
+    'mean length': 'branches', 'cv length': 'branches',
+    'mean tortuosity': 'branches',
+    'length entropy': 'entropies', 'orientation entropy': 'entropies',
+    'aspl,cpd': 'paths',
+    'md,cv degree': 'degrees', 'cvd': 'degrees'}
+
+
+# Version of the format written by KGraph.save
+_FORMAT_VERSION = 2
+
+# Arrays saved by KGraph.save: those of the compact core and those of
+# each construction stage
+_SAVED_ARRAYS = {
+    'core': ('_coords', '_edges', '_indptr', '_adj', '_adj_edge',
+             '_extra_coords'),
+    'branches': ('_br_nodes', '_br_edges', '_br_ptr', 'br_lengths',
+                 'br_tort'),
+    'simplified': ('_simpl_edges', '_simpl_lengths', '_simpl_origin',
+                   '_simpl_span', '_simpl_nodes', '_simpl_indptr',
+                   '_simpl_adj', '_simpl_adj_length', '_simpl_degrees')}
+
+
+class _LazyAttribute:
+    """
+    NOT PUBLIC
+    Attribute of a KGraph computed by a construction stage the first time
+    it is read. Once computed, the value is stored in the instance.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.name not in obj.__dict__:
+            obj._run_stage(self.stage)
+        return obj.__dict__[self.name]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+    def __delete__(self, obj):
+        obj.__dict__.pop(self.name, None)
+
+
+def _cached_metric(*ignore, check=None):
+    """NON PUBLIC.
+    Decorator memoising a metric method of KGraph in the metric cache of
+    the instance (see KGraph.metric_cache), under the name of the method
+    and the values of its parameters, except the parameters in ignore,
+    which do not change the result. The cache is dropped when the version
+    of the graph changes. Sampling estimates without a seed and calls
+    with unhashable parameters are not cached.
+
+    check is an optional function called with the dictionnary of the
+    arguments before the cache is searched, to validate the parameters
+    which are not part of the key.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        def metric_key(self, *args, **kwargs):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            params = tuple((name, value)
+                           for name, value in bound.arguments.items()
+                           if name != 'self' and name not in ignore)
+            return method.__name__, params
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if check is not None:
+                bound = signature.bind(self, *args, **kwargs)
+                bound.apply_defaults()
+                check(bound.arguments)
+            key = metric_key(self, *args, **kwargs)
+            params = dict(key[1])
+            if (params.get('k') is not None or
+                    params.get('error') is not None) and \
+                    params.get('seed') is None:
+                # Random estimate
+                return method(self, *args, **kwargs)
+            cache = self._metric_results()
+            try:
+                hit = key in cache
+            except TypeError:
+                # Unhashable parameters
+                return method(self, *args, **kwargs)
+            if not hit:
+                cache[key] = method(self, *args, **kwargs)
+            return _copy_result(cache[key])
+
+        wrapper.metric_key = metric_key
+        return wrapper
+
+    return decorator
+
+
+def _check_backend(arguments):
+    """NON PUBLIC.
+    Checks the backend of the shortest path computations.
+    """
+    if arguments['backend'] not in ('scipy', 'python'):
+        raise ValueError("backend must be 'scipy' or 'python'")
+
+
+def _characterization_task(kgraph, steps, needed):
+    """NON PUBLIC.
+    Computes steps of characterize_graph in order, in the current process
+    or in a worker of an executor. Returns the computed metrics and the
+    metric cache of kgraph.
+    """
+    results = {}
+    for step in steps:
+        results.update(kgraph._characterization_step(step, needed, results))
+    return results, kgraph._metric_results()
+
+
+def _copy_result(value):
+    """NON PUBLIC.
+    Copy of a cached result which could be modified by the caller.
+    """
+    if isinstance(value, (dict, list, np.ndarray)):
+        return value.copy()
+    return value
+
+
+class _PositionView(Mapping):
+    """
+    NOT PUBLIC
+    Read-only dictionnary of the node coordinates of a KGraph, giving for
+    each node name the list of the first dim values of its row in the
+    array of coordinates. The nodes having coordinates but no edge are
+    included after the nodes of the graph.
+    """
+
+    def __init__(self, kgraph, dim):
+        self._index = kgraph._node_index
+        self._extra_index = kgraph._extra_node_index
+        self._labels = kgraph._labels
+        self._extra_labels = kgraph._extra_labels
+        self._coords = kgraph._coords[:, :dim]
+        self._extra_coords = kgraph._extra_coords[:, :dim]
+
+    def __getitem__(self, node):
+        if node in self._index:
+            return self._coords[self._index[node]].tolist()
+        return self._extra_coords[self._extra_index[node]].tolist()
+
+    def __iter__(self):
+        yield from self._labels.tolist()
+        yield from self._extra_labels.tolist()
+
+    def __len__(self):
+        return len(self._labels) + len(self._extra_labels)
+
+    def __contains__(self, node):
+        return node in self._index or node in self._extra_index
+
+
 class KGraph:
     """
     Class dedicated to the construction and manipulation of graphs
@@ -50,12 +257,13 @@ class KGraph:
         - graph : the complete graph of the karstic network.
                 Each station is a node, each line-of sigth is an edge.
                 It is a Networkx graph object, with length of edges
-                as attributes.
+                as attributes. It is built on first access from the
+                compact arrays on which all the metrics are computed.
         - graph_simpl: the simplified graph of the karstic network,
                 i.e. all nodes of degree 2 are removed except in loops
                 (2 types of loops)(cf Collon et al, 2017, Geomorphology)
                 graph_simple is a Networkx graph object, with length of
-                edges as attributes.
+                edges as attributes. It is also built on first access.
         - pos2d : a dictionnary of the nodes with their 2d coordinates
                 as a values [x, y]
         - pos3d : a dictionnary of the nodes with their 3d coordinates
@@ -72,53 +280,750 @@ class KGraph:
 
     """
 
-    def __init__(self, edges, coordinates, properties=None, verbose=True):
+    # Attributes derived from the compact core, with the construction
+    # stage computing them (see _run_stage)
+    br_lengths = _LazyAttribute('branches')
+    br_tort = _LazyAttribute('branches')
+    _br_nodes = _LazyAttribute('branches')
+    _br_edges = _LazyAttribute('branches')
+    _br_ptr = _LazyAttribute('branches')
+    _simpl_edges = _LazyAttribute('simplified')
+    _simpl_lengths = _LazyAttribute('simplified')
+    _simpl_origin = _LazyAttribute('simplified')
+    _simpl_span = _LazyAttribute('simplified')
+    _simpl_nodes = _LazyAttribute('simplified')
+    _simpl_indptr = _LazyAttribute('simplified')
+    _simpl_adj = _LazyAttribute('simplified')
+    _simpl_adj_length = _LazyAttribute('simplified')
+    _simpl_degrees = _LazyAttribute('simplified')
+
+    def __init__(self, edges, coordinates, properties=None, verbose=True,
+                 lazy=False, n_jobs=1):
 
         """
         Creates a Kgraph from nodes and edges.
 
         Parameters
         ----------
-        edges : list
-            a list of edges
-
-        coord : dictionnary
-            coordinates of the nodes, keys are node names
+        edges : list or array
+            a list of edges, or an (E,2) integer array of edges
+
+        coord : dictionnary or array
+            coordinates of the nodes, keys are node names. It can also be
+            an (N,2) or (N,3) array whose row i contains the coordinates of
+            node i, the nodes of the edges being then row indices. An
+            (N,3) float array whose rows follow the order in which the
+            nodes appear in the edges is used without copy, and must not be
+            modified afterwards. The nodes having coordinates but no edge
+            are only kept in pos2d and pos3d.
 
         properties : dictionnary
             optional properties associated to the nodes
 
+        verbose : boolean
+            If True, prints information about the network
+
+        lazy : boolean
+            If False (default), the edge attributes, the branches and the
+            simplified graph are computed by the constructor. If True, each
+            of them is computed the first time it is needed.
+
+        n_jobs : int
+            Number of processes used to build the branches, their lengths
+            and tortuosities and the simplified graph, the connected
+            components being processed independently, and to compute the
+            exact betweenness centrality, the sources of the Brandes
+            algorithm being split between the processes. 1 (default)
+            computes them in the current process, -1 uses all the
+            processors. The result does not depend on n_jobs.
+
         Examples
         --------
            >>> myKGraph = KGraph([],{})
+           >>> myKGraph = KGraph(edges, coord, lazy=True)
+           >>> myKGraph = KGraph(edges, coord, n_jobs=-1)
+           >>> myKGraph = KGraph(np.array([[0, 1], [1, 2]]),
+           ...                   np.array([[0., 0.], [1., 0.], [1., 1.]]))
         """
 
-        # Initialization of the complete graph - use functions of kgraph_fc
-        # module
-        self.graph = nx.Graph()
-        self.graph.add_edges_from(edges)
-        self.verbose = verbose
+        # Compact core of the graph: the node names, ordered as they appear
+        # in the edges, an (N,3) array of coordinates, the (E,2) array of
+        # edges given as node indices and the CSR adjacency of the graph.
+        # The Networkx graphs are only built when they are requested.
+        with _stage('index'):
+            labels, edges, edge_data = _index_edges(edges)
+            self._setup(labels, edges, _coords_array(coordinates, labels),
+                        _extra_nodes(coordinates, labels), edge_data,
+                        properties, verbose, n_jobs)
 
-        self.pos2d, self.pos3d = _pos_initialization(coordinates)
         if self.verbose:
             print(
                 "\n This network contains ",
-                nx.number_connected_components(
-                    self.graph),
+                self._number_connected_components(),
                 " connected components")
 
-        # Compute graph length from the pos3d_ to initialize properly the graph
-        self._set_graph_lengths()
-        self._set_graph_orientations()
+        # The edge attributes, branches and simplified graph are derived
+        # from the compact core. In lazy mode, each of them is computed on
+        # first access, otherwise they are all computed now.
+        if not lazy:
+            self.precompute()
+
+    def _setup(self, labels, edges, coords, extra, edge_data, properties,
+               verbose, n_jobs, adjacency=None):
+        """NON PUBLIC.
+        Sets the state of a new KGraph from its compact core. Used by the
+        constructor and by load, the construction stages being run or
+        loaded afterwards.
+
+        Parameters:
+        -----------
+           - labels : array of the node names
+           - edges : (E,2) array of node indices
+           - coords : (N,3) array of the coordinates of the nodes
+           - extra : names and (M,3) coordinates of the nodes having
+                coordinates but no edge, only kept for pos2d and pos3d
+           - edge_data : list of the attribute dictionnaries of the edges,
+                or None
+           - adjacency : optional CSR adjacency (indptr, adj, adj_edge),
+                computed from the edges if not given
+        """
+        self.verbose = verbose
+        self.n_jobs = n_jobs
         self.properties = properties
 
-        # Compute branches of the graph
-        # self.branches is necessary to export graph to plines
-        self.branches, self.br_lengths, self.br_tort = self._getallbranches()
+        self._labels = labels
+        self._edges = edges
+        self._edge_data = edge_data
+        self._coords = coords
+        self._extra_labels, self._extra_coords = extra
+        if adjacency is None:
+            adjacency = _csr_adjacency(len(labels), edges)
+        self._indptr, self._adj, self._adj_edge = adjacency
+
+        self._graph = None
+        self._graph_simpl = None
+        self._pos2d = None
+        self._pos3d = None
+        self._branches = None
+
+        # Edge attributes are stored in arrays aligned with self._edges
+        self._edge_attr = {}
+        self._stages_done = set()
+
+        # Version of the graph, incremented at each modification
+        self._version = 0
+        self._index = None
+
+        # Results of the metrics, valid for the version _metric_version
+        self._metric_cache = {}
+        self._metric_version = 0
+
+    # **********************************
+    #    Networkx views of the graph
+    # **********************************
+
+    @property
+    def graph(self):
+        """
+        The complete graph of the karstic network as a Networkx graph.
+
+        It is built from the compact arrays on first access, with the
+        length, length2d, azimuth and dip of the edges as attributes.
+        """
+        if self._graph is None:
+            self._graph = self._build_graph()
+        return self._graph
+
+    @property
+    def graph_simpl(self):
+        """
+        The simplified graph of the karstic network as a Networkx graph.
+
+        It is built from the simplified edges on first access, with the
+        length of the edges as attribute.
+        """
+        if self._graph_simpl is None:
+            self._graph_simpl = self._build_graph_simpl()
+        return self._graph_simpl
+
+    @property
+    def pos2d(self):
+        """
+        Dictionnary of the nodes with their 2d coordinates [x, y].
+        This is a read-only view of the coordinates given to the
+        constructor, including the nodes without any edge.
+        """
+        if self._pos2d is None:
+            self._pos2d = _PositionView(self, 2)
+        return self._pos2d
+
+    @property
+    def pos3d(self):
+        """
+        Dictionnary of the nodes with their 3d coordinates [x, y, z].
+        This is a read-only view of the coordinates given to the
+        constructor, including the nodes without any edge.
+        """
+        if self._pos3d is None:
+            self._pos3d = _PositionView(self, 3)
+        return self._pos3d
+
+    @property
+    def branches(self):
+        """
+        The list of branches, each branch being a list of node names.
+        """
+        if self._branches is None:
+            nodes = self._labels[self._br_nodes].tolist()
+            ptr = self._br_ptr.tolist()
+            self._branches = [nodes[ptr[i]:ptr[i + 1]]
+                              for i in range(len(ptr) - 1)]
+        return self._branches
+
+    @property
+    def list_simpl_edges(self):
+        """
+        The list of simple edges [start node, end node], necessary to
+        export the simplified graph to plines.
+        """
+        return self._labels[self._simpl_edges].tolist()
+
+    # **********************************
+    #    Edge attributes
+    # **********************************
+
+    @property
+    def edge_nodes(self):
+        """
+        (E,2) array of the node names of the edges of the complete graph.
+
+        Row k is the edge of index k: the arrays returned by edge_array are
+        aligned with it. The edge indices only change when edges are
+        removed by remove_edges; new edges are added at the end.
+        """
+        return self._labels[self._edges]
+
+    @property
+    def edge_names(self):
+        """
+        List of the names of the edge attributes available with
+        edge_array: the computed attributes 'length', 'length2d',
+        'azimuth' and 'dip', the attributes set with set_edge_array and
+        those given with the edges at the creation of the graph.
+        """
+        names = list(_EDGE_STAGES)
+        names += [name for name in self._edge_attr if name not in names]
+        if self._edge_data is not None:
+            for d in self._edge_data:
+                names += [name for name in d if name not in names]
+        return names
+
+    def edge_array(self, name):
+        """
+        Array of an attribute of the edges of the complete graph.
+
+        The values are aligned with the edges of the graph: the k-th value
+        belongs to the edge self.edge_nodes[k]. For the computed attributes
+        ('length', 'length2d', 'azimuth', 'dip') and for those set with
+        set_edge_array, the returned array is a read-only view, no copy is
+        made. The attributes given with the edges at the creation of the
+        graph are gathered in a new array, with NaN (or None for non
+        numeric values) for the edges without this attribute.
+
+        Parameters
+        ----------
+        name : string
+            name of the attribute, see edge_names
+
+        Returns
+        -------
+        numpy array
+            the value of the attribute for each edge
+
+        Examples
+        --------
+           >>> lengths = myKGraph.edge_array('length')
+        """
+        if name not in self._edge_attr and name not in _EDGE_STAGES:
+            if self._edge_data is None or \
+                    not any(name in d for d in self._edge_data):
+                raise KeyError("No edge attribute named {}".format(name))
+            return _data_column(self._edge_data, name)
+
+        values = self._edge_column(name).view()
+        values.flags.writeable = False
+        return values
+
+    def set_edge_array(self, name, values):
+        """
+        Adds or replaces an attribute of the edges of the complete graph.
+
+        The values are stored without copy when they are given as an
+        array, and are then available with edge_array and as edge
+        attributes of self.graph. Edges added later by add_edges get NaN
+        (or None for a non numeric attribute).
+
+        Parameters
+        ----------
+        name : string
+            name of the attribute, it cannot be one of the computed
+            attributes 'length', 'length2d', 'azimuth' and 'dip'
+
+        values : array
+            one value for each edge, aligned with self.edge_nodes
+
+        Examples
+        --------
+           >>> myKGraph.set_edge_array('width', widths)
+        """
+        if name in _EDGE_STAGES:
+            raise ValueError("The edge attribute {} is computed from the "
+                             "coordinates and cannot be set".format(name))
+        values = np.asarray(values)
+        if values.shape[:1] != (len(self._edges),):
+            raise ValueError("{} values are required, one for each "
+                             "edge".format(len(self._edges)))
+        self._edge_attr[name] = values
+        self._graph = None
+
+        return
+
+    def simpl_edge_ids(self, k):
+        """
+        Indices of the edges of the complete graph covered by a simple edge.
+
+        Parameters
+        ----------
+        k : int
+            index of the simple edge in self.list_simpl_edges
+
+        Returns
+        -------
+        numpy array
+            indices of the edges (see edge_nodes), from the start to the
+            end node of the simple edge
+
+        Examples
+        --------
+           >>> ids = myKGraph.simpl_edge_ids(0)
+           >>> myKGraph.edge_array('length')[ids].sum()
+        """
+        start, stop = self._simpl_edge_slice(k)
+        return self._br_edges[start:stop].copy()
+
+    def simpl_edge_path(self, k):
+        """
+        Nodes of the complete graph along a simple edge, from its start to
+        its end node. Their coordinates give the full geometry of the
+        simple edge.
+
+        Parameters
+        ----------
+        k : int
+            index of the simple edge in self.list_simpl_edges
+
+        Returns
+        -------
+        list
+            names of the nodes
+
+        Examples
+        --------
+           >>> path = myKGraph.simpl_edge_path(0)
+           >>> xyz = [myKGraph.pos3d[n] for n in path]
+        """
+        branch = self._simpl_origin[k]
+        start, stop = self._simpl_edge_slice(k)
+        nodes = self._br_nodes[start + branch:stop + branch + 1]
+        return self._labels[nodes].tolist()
+
+    def simpl_edge_array(self, name, reduce='sum'):
+        """
+        Attribute of the edges of the complete graph aggregated over each
+        simple edge.
+
+        Parameters
+        ----------
+        name : string
+            name of the edge attribute, see edge_names
+
+        reduce : string
+            'sum' (default), 'mean', 'min' or 'max'
+
+        Returns
+        -------
+        numpy array
+            aggregated value for each simple edge, in the order of
+            self.list_simpl_edges
 
-        # Construct the simplified graph
-        # self.list_simpl_edges is necessary to export graph to plines
-        self.list_simpl_edges, self.graph_simpl = self._simplify_graph()
+        Examples
+        --------
+           >>> lengths = myKGraph.simpl_edge_array('length')
+           >>> max_dips = myKGraph.simpl_edge_array('dip', 'max')
+        """
+        functions = {'sum': np.add, 'mean': np.add, 'min': np.minimum,
+                     'max': np.maximum}
+        if reduce not in functions:
+            raise ValueError("reduce must be 'sum', 'mean', 'min' or 'max'")
+
+        # Edges of all the simple edges, one after the other
+        counts = self._simpl_span[:, 1] - self._simpl_span[:, 0]
+        ptr = np.cumsum(counts) - counts
+        first = (_edge_ptr(self._br_ptr)[self._simpl_origin] +
+                 self._simpl_span[:, 0])
+        edges = self._br_edges[np.repeat(first - ptr, counts) +
+                               np.arange(np.sum(counts))]
+
+        if len(ptr) == 0:
+            return np.zeros(0)
+        values = functions[reduce].reduceat(self.edge_array(name)[edges], ptr)
+        if reduce == 'mean':
+            values = values / counts
+        return values
+
+    # **********************************
+    #    Construction stages
+    # **********************************
+
+    def precompute(self, networkx=False):
+        """
+        Computes all the structures derived from the graph.
+
+        Computes the edge lengths and orientations, the branches with their
+        lengths and tortuosities and the simplified graph. This is done by
+        the constructor, unless the KGraph has been created with
+        lazy=True. In that case, each structure is otherwise computed the
+        first time it is needed.
+
+        Parameters
+        ----------
+        networkx : boolean
+            If True, the Networkx views `graph` and `graph_simpl` are also
+            built.
+
+        Examples
+        --------
+           >>> myKGraph = KGraph(edges, coord, lazy=True)
+           >>> myKGraph.precompute()
+        """
+        for stage in _STAGES:
+            self._run_stage(stage)
+
+        if networkx:
+            self.graph
+            self.graph_simpl
+
+        return
+
+    def save(self, path, allow_pickle=False):
+        """
+        Saves the KGraph in a directory, to be reloaded with load.
+
+        All the construction stages are computed before saving. The
+        arrays (coordinates, edges, edge attributes, branches, simplified
+        graph, names of the nodes when they are all numbers or all
+        strings) are stored as .npy files. The other names of the nodes,
+        the edge dictionnaries and the properties are stored with the
+        description of the content in karstnet.json, with the version of
+        the format.
+
+        Parameters
+        ----------
+        path : string
+            Name of the directory, created if it does not exist. The files
+            of a previously saved KGraph are replaced.
+
+        allow_pickle : boolean
+            The names, edge dictionnaries and properties can only contain
+            numbers, strings, lists, tuples and dictionnaries. If True,
+            other objects are accepted and stored in a pickle file
+            (objects.pkl), which load only reads with allow_pickle=True.
+            If False (default), they raise a TypeError.
+
+        Examples
+        --------
+           >>> myKGraph.save("MyKarst.kgraph")
+           >>> myKGraph = kn.load("MyKarst.kgraph")
+        """
+        self.precompute()
+        os.makedirs(path, exist_ok=True)
+
+        objects = {'properties': self.properties,
+                   'edge_data': self._edge_data}
+        arrays = {}
+        label_types = {}
+        for name in ('_labels', '_extra_labels'):
+            labels = getattr(self, name)
+            if labels.dtype == object:
+                if all(isinstance(label, str) for label in labels.tolist()):
+                    labels = labels.astype(str)
+                    label_types[name[1:]] = 'str'
+                else:
+                    objects[name[1:]] = labels.tolist()
+                    labels = None
+            arrays[name] = labels
+        for stage, names in _SAVED_ARRAYS.items():
+            for name in names:
+                arrays[name] = np.asarray(getattr(self, name))
+
+        # Edge attributes, the object columns are stored with the objects
+        edge_attributes = list(self._edge_attr)
+        for i, name in enumerate(edge_attributes):
+            column = self._edge_attr[name]
+            if column.dtype == object:
+                objects.setdefault('edge_attr', {})[name] = column.tolist()
+            else:
+                arrays['edge_attr_{}'.format(i)] = column
+
+        metadata = {'format': 'karstnet.KGraph',
+                    'version': _FORMAT_VERSION,
+                    'arrays': [name for name, array in arrays.items()
+                               if array is not None],
+                    'labels': label_types.get('labels'),
+                    'extra_labels': label_types.get('extra_labels'),
+                    'edge_attributes': edge_attributes,
+                    'stages': [stage for stage in _STAGES
+                               if stage in self._stages_done],
+                    'verbose': bool(self.verbose),
+                    'n_jobs': self.n_jobs}
+        pickle_name = os.path.join(path, 'objects.pkl')
+        try:
+            metadata['objects'] = _to_json(objects)
+        except TypeError:
+            if not allow_pickle:
+                raise
+            with open(pickle_name, 'wb') as f:
+                pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            if os.path.exists(pickle_name):
+                os.remove(pickle_name)
+
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(path, name + '.npy'), array,
+                        allow_pickle=False)
+        with open(os.path.join(path, 'karstnet.json'), 'w') as f:
+            json.dump(metadata, f, indent=1)
+
+    # **********************************
+    #    Modifications of the graph
+    # **********************************
+
+    def add_edges(self, edges, coordinates=None):
+        """
+        Adds edges, and if needed new nodes, to the karstic network.
+
+        The graph is updated without being rebuilt: only the attributes of
+        the new edges are computed, and only the branches touching their
+        extremities are extracted again, together with the corresponding
+        simple edges, branch lengths and tortuosities.
+
+        Parameters
+        ----------
+        edges : list
+            a list of edges (pairs of node names). Edges already in the
+            graph are ignored.
+
+        coordinates : dictionnary
+            coordinates of the new nodes, keys are node names. It is only
+            required if some edges connect nodes absent from the graph
+            that were not given coordinates at the construction.
+
+        Examples
+        --------
+           >>> myKGraph.add_edges([(10, 11), (11, 12)],
+           ...                    {11: [2., 5., 1.], 12: [3., 6., 1.]})
+        """
+        if coordinates is None:
+            coordinates = {}
+
+        # Indices of the nodes, new nodes are numbered after the others
+        index = self._node_index
+        extra_index = self._extra_node_index
+        new_index = {}
+        pairs = []
+        for e in edges:
+            for node in e[:2]:
+                if node not in index and node not in new_index:
+                    if node not in coordinates and node not in extra_index:
+                        raise KeyError("No coordinates given for the new "
+                                       "node {}".format(node))
+                    new_index[node] = len(index) + len(new_index)
+            pairs.append([index[n] if n in index else new_index[n]
+                          for n in e[:2]])
+
+        if new_index:
+            # The new nodes without given coordinates were known without
+            # edge, they are moved from the extra nodes to the graph
+            new_labels = list(new_index.keys())
+            given = np.array([n in coordinates for n in new_labels],
+                             dtype=bool)
+            new_coords = np.empty((len(new_labels), 3))
+            new_coords[given] = _coords_array(
+                coordinates, _label_array([n for n in new_labels
+                                           if n in coordinates]))
+            new_coords[~given] = self._extra_coords[
+                [extra_index[n] for n in new_labels
+                 if n not in coordinates]].reshape(-1, 3)
+            self._labels = _label_array(self._labels.tolist() + new_labels)
+            self._coords = np.vstack((self._coords, new_coords))
+            index.update(new_index)
+
+            linked = [extra_index[n] for n in new_labels if n in extra_index]
+            if linked:
+                keep = np.ones(len(self._extra_labels), dtype=bool)
+                keep[linked] = False
+                self._extra_labels = self._extra_labels[keep]
+                self._extra_coords = self._extra_coords[keep]
+
+        # Orientation of the new edges, and removal of the edges already in
+        # the graph
+        nb_nodes = len(self._labels)
+        pairs = np.sort(np.array(pairs, dtype=np.int64).reshape(-1, 2),
+                        axis=1)
+        key = pairs[:, 0] * nb_nodes + pairs[:, 1]
+        _, first = np.unique(key, return_index=True)
+        first.sort()
+        first = first[~np.isin(key[first], self._edges[:, 0] * nb_nodes +
+                               self._edges[:, 1])]
+        new_edges = pairs[first]
+
+        self._edges = np.vstack((self._edges, new_edges))
+        if self._edge_data is not None:
+            self._edge_data += [{} for e in new_edges]
+        self._append_edge_attributes(new_edges)
+        self._indptr, self._adj, self._adj_edge = _csr_adjacency(
+            nb_nodes, self._edges)
+
+        self._update_branches(np.unique(new_edges))
+        self._invalidate()
+
+        return
+
+    def remove_edges(self, edges):
+        """
+        Removes edges from the karstic network.
+
+        The nodes are kept, even if they are not connected any more. As in
+        add_edges, only the branches touching the extremities of the
+        removed edges are extracted again.
+
+        Parameters
+        ----------
+        edges : list
+            a list of edges (pairs of node names). Edges that are not in
+            the graph are ignored.
+
+        Examples
+        --------
+           >>> myKGraph.remove_edges([(10, 11)])
+        """
+        index = self._node_index
+        nb_nodes = len(self._labels)
+        pairs = np.array([[index[e[0]], index[e[1]]] for e in edges
+                          if e[0] in index and e[1] in index],
+                         dtype=np.int64).reshape(-1, 2)
+        pairs = np.sort(pairs, axis=1)
+
+        removed = np.isin(self._edges[:, 0] * nb_nodes + self._edges[:, 1],
+                          pairs[:, 0] * nb_nodes + pairs[:, 1])
+        if not np.any(removed):
+            return
+        touched = np.unique(self._edges[removed])
+
+        # New index of the remaining edges
+        keep = ~removed
+        edge_map = np.cumsum(keep) - 1
+        edge_map[removed] = -1
+
+        self._edges = self._edges[keep]
+        for name in self._edge_attr:
+            self._edge_attr[name] = self._edge_attr[name][keep]
+        if self._edge_data is not None:
+            self._edge_data = [d for d, k in zip(self._edge_data,
+                                                 keep.tolist()) if k]
+        self._indptr, self._adj, self._adj_edge = _csr_adjacency(
+            nb_nodes, self._edges)
+
+        self._update_branches(touched, edge_map)
+        self._invalidate()
+
+        return
+
+    def move_nodes(self, coordinates):
+        """
+        Changes the coordinates of some nodes of the karstic network.
+
+        Only the attributes of the edges connected to these nodes are
+        computed again, together with the lengths and tortuosities of the
+        branches and simple edges containing them.
+
+        Parameters
+        ----------
+        coordinates : dictionnary
+            new coordinates [x, y, z] of the nodes, keys are node names.
+            If only [x, y] is given, z is unchanged.
+
+        Examples
+        --------
+           >>> myKGraph.move_nodes({11: [2., 5.5, 1.]})
+        """
+        index = self._node_index
+        # The arrays are copied before being modified: they can be shared
+        # with the caller (coordinates given as an array, edge_array)
+        if any(n not in index for n in coordinates):
+            # Nodes without edge, only their coordinates are changed
+            extra_index = self._extra_node_index
+            self._extra_coords = self._extra_coords.copy()
+            for n, value in coordinates.items():
+                if n not in index:
+                    self._extra_coords[extra_index[n], :len(value)] = value
+            coordinates = {n: value for n, value in coordinates.items()
+                           if n in index}
+        nodes = np.array([index[n] for n in coordinates], dtype=np.int64)
+        self._coords = self._coords.copy()
+        for i, value in zip(nodes.tolist(), coordinates.values()):
+            self._coords[i, :len(value)] = value
+
+        # Edges connected to the moved nodes
+        edge_ids = np.unique(_incident_edges(self._indptr, self._adj_edge,
+                                             nodes))
+        edges = self._edges[edge_ids]
+        d = _edge_vectors(self._coords, edges)
+        for name in ('length', 'length2d', 'azimuth', 'dip'):
+            if name in self._edge_attr:
+                self._edge_attr[name] = self._edge_attr[name].copy()
+        if 'length' in self._edge_attr:
+            self._edge_attr['length'][edge_ids] = \
+                np.sqrt(np.sum(d ** 2, axis=1))
+        if 'length2d' in self._edge_attr:
+            (self._edge_attr['length2d'][edge_ids],
+             self._edge_attr['azimuth'][edge_ids],
+             self._edge_attr['dip'][edge_ids]) = \
+                _edge_orientations(d[:, 0], d[:, 1], d[:, 2])
+
+        if 'branches' in self._stages_done:
+            nb_branches = len(self._br_ptr) - 1
+            branch_of_edge = np.empty(len(self._edges), dtype=np.int64)
+            branch_of_edge[self._br_edges] = np.repeat(
+                np.arange(nb_branches), np.diff(_edge_ptr(self._br_ptr)))
+            changed = np.zeros(nb_branches, dtype=bool)
+            changed[branch_of_edge[edge_ids]] = True
+
+            ids = np.flatnonzero(changed)
+            br_nodes, br_edges, br_ptr = self._select_branches(ids)
+            self.br_lengths = self.br_lengths.copy()
+            self.br_tort = self.br_tort.copy()
+            self.br_lengths[ids], self.br_tort[ids] = \
+                self._branch_measures(br_nodes, br_edges, br_ptr)
+
+            if 'simplified' in self._stages_done:
+                self._update_simplified(self._branch_ends(),
+                                        np.arange(nb_branches), changed)
+
+        self._invalidate()
+
+        return
 
     # **********************************
     #    Plots
@@ -276,19 +1181,13 @@ class KGraph:
 
         # create an np.array of azimuths and dips
         # and lengths (projected(2d) and real (3d))
-        azim = np.array(
-            list((nx.get_edge_attributes(self.graph, 'azimuth')).values()))
+        azim = self._edge_column('azimuth')
         azim_not_Nan = azim[~np.isnan(azim)]
         bearing_dc = np.nan_to_num(azim)
-        plunge_dc = np.array(
-            list((nx.get_edge_attributes(self.graph, 'dip')).values()))
+        plunge_dc = self._edge_column('dip')
         if (weighted):
-            l2d = np.array(
-                list((nx.get_edge_attributes(self.graph,
-                                             'length2d')).values()))
-
-            l3d = np.array(
-                list((nx.get_edge_attributes(self.graph, 'length')).values()))
+            l2d = self._edge_column('length2d')
+            l3d = self._edge_column('length')
 
             l2d_not_Nan = l2d[~np.isnan(azim)]
         else:
@@ -457,25 +1356,21 @@ class KGraph:
         """
 
         # On the complete graph
-        nb_nodes_comp = nx.number_of_nodes(self.graph)
-        nb_edges_comp = nx.number_of_edges(self.graph)
+        nb_nodes_comp = len(self._labels)
+        nb_edges_comp = len(self._edges)
 
         # On the simplified graph
-        nb_nodes = nx.number_of_nodes(self.graph_simpl)
-        nb_edges = nx.number_of_edges(self.graph_simpl)
-        nb_connected_components = nx.number_connected_components(
-            self.graph_simpl)
+        nb_nodes = len(self._simpl_nodes)
+        nb_edges = len(self._simpl_adj) // 2
+        nb_connected_components = _number_connected_components(
+            self._simpl_indptr, self._simpl_adj)
 
         nb_cycles = nb_edges - nb_nodes + nb_connected_components
 
         # Compute all extremities and junction nodes (on the simple graph)
-        nb_extremity_nodes = 0
-        nb_junction_nodes = 0
-        for i in self.graph_simpl.nodes():
-            if (self.graph_simpl.degree(i) == 1):
-                nb_extremity_nodes += 1
-            elif (self.graph_simpl.degree(i) > 2):
-                nb_junction_nodes += 1
+        degree = self._simpl_degrees
+        nb_extremity_nodes = np.count_nonzero(degree == 1)
+        nb_junction_nodes = np.count_nonzero(degree > 2)
 
         # Print these basics
         print(
@@ -520,6 +1415,7 @@ class KGraph:
               " necessary to loop preservations as Seed Nodes, in order to",
               " stay consistent with Howard's illustrations.")
 
+    @_cached_metric()
     def mean_tortuosity(self):
         """
         Compute the mean tortuosity of a karstic network
@@ -545,6 +1441,7 @@ class KGraph:
 
         return (np.nanmean(self.br_tort))
 
+    @_cached_metric()
     def mean_length(self):
         """
         Compute the mean length of the branches of a karstic networkx
@@ -559,6 +1456,7 @@ class KGraph:
         """
         return (np.mean(self.br_lengths))
 
+    @_cached_metric()
     def coef_variation_length(self):
         """
         Compute the coefficient of variation of length of the branches of a
@@ -581,6 +1479,7 @@ class KGraph:
         else:
             return 0 # No 
 
+    @_cached_metric()
     def length_entropy(self, mode="default"):
         """
         Compute the entropy of lengths of the branches of a karstic network
@@ -635,6 +1534,7 @@ class KGraph:
 
         return entropy
 
+    @_cached_metric()
     def orientation_entropy(self, mode="default"):
         """
         Computes the entropy of orientation of the segments of a
@@ -659,11 +1559,9 @@ class KGraph:
            >>> or_entropy = myKGraph.orientation_entropy()
         """
 
-        # create an np.array of azimuths and projected lengths
-        azim = np.array(
-            list((nx.get_edge_attributes(self.graph, 'azimuth')).values()))
-        l2d = np.array(
-            list((nx.get_edge_attributes(self.graph, 'length2d')).values()))
+        # azimuths and projected lengths of the edges
+        azim = self._edge_column('azimuth')
+        l2d = self._edge_column('length2d')
 
         # Removing NAN Azimuth values that correspond to length2d=0
         azim_not_Nan = azim[~np.isnan(azim)]
@@ -693,6 +1591,7 @@ class KGraph:
         else:
             return 0
 
+    @_cached_metric()
     def mean_degree_and_CV(self):
         """
         Computes the average and the coefficient of variation of the degree.
@@ -709,7 +1608,7 @@ class KGraph:
            >>> meandeg, cvde = myKGraph.coef_variation_degree()
         """
         # Vector of degrees
-        d = np.array(self.graph_simpl.degree())[:, 1]
+        d = self._simpl_degrees
 
         # Mean degree
         meandeg = np.mean(d)
@@ -720,6 +1619,7 @@ class KGraph:
 
         return meandeg, cvde
 
+    @_cached_metric()
     def correlation_vertex_degree(self, cvde=False):
         """
         Computes the correlation of vertex degree.
@@ -747,34 +1647,123 @@ class KGraph:
 
         # To avoid division by 0 when computing correlation coef
         if cvde != 0:
-            cvd = nx.degree_pearson_correlation_coefficient(self.graph_simpl)
+            # Pearson correlation of the degrees at both ends of the edges,
+            # each edge being counted in both directions
+            d = self._simpl_degrees
+            x = np.repeat(d, d)
+            y = d[self._simpl_adj]
+            cvd = float(np.corrcoef(x, y)[0, 1])
         else:
             cvd = 1
 
         return cvd
 
-    def central_point_dominance(self):
+    @_cached_metric('n_jobs')
+    def central_point_dominance(self, k=None, error=None, confidence=0.95,
+                                seed=None, n_jobs=None):
         """
         Computes central point dominance.
 
         The computation is done on the simplified graph.
 
+        The exact computation requires a breadth first search from each
+        node of the biconnected blocks containing cycles, the rest of the
+        graph being handled by the tree of the blocks. For large graphs,
+        the central point dominance can be estimated from the searches of
+        a random sample of source nodes, by giving either their number k,
+        or the target error. In that case, a confidence interval is
+        returned with the estimate.
+
+        Parameters
+        ----------
+        k : int
+            Number of sampled source nodes. By default (and if error is not
+            given), all the nodes are used and the exact value is computed.
+
+        error : float
+            Target half width of the confidence interval: sources are
+            sampled until the interval is narrow enough (or all the nodes
+            are used).
+
+        confidence : float
+            Confidence level of the interval, 0.95 by default.
+
+        seed : int
+            Seed of the random sampling of the sources.
+
+        n_jobs : int
+            Number of processes computing the exact betweenness
+            centralities, by default the n_jobs of the KGraph.
+
         Returns
         -------
         float
             Central point dominance
+        tuple
+            If k or error is given: the estimated central point dominance
+            and the confidence interval (low, high)
 
         Examples
         --------
            >>> cpd = myKGraph.central_point_dominance()
+           >>> cpd, (low, high) = myKGraph.central_point_dominance(k=500)
+           >>> cpd, ci = myKGraph.central_point_dominance(error=0.01)
+           >>> cpd = myKGraph.central_point_dominance(n_jobs=-1)
+        """
+        if k is None and error is None:
+            bet_cen = self._betweenness_array(n_jobs)
+            return _central_point_dominance(bet_cen)
+
+        if len(self._simpl_nodes) <= 2:
+            # Betweenness is 0 on graphs with less than 3 nodes
+            cpd = self.central_point_dominance()
+            return cpd, (cpd, cpd)
+
+        cpd, half_width, nb_sources = _sampled_cpd(
+            self._simpl_indptr, self._simpl_adj, k, error, confidence,
+            np.random.default_rng(seed))
+        if self.verbose:
+            print("Central point dominance estimated from", nb_sources,
+                  "sources")
+
+        return cpd, (cpd - half_width, cpd + half_width)
+
+    @_cached_metric('n_jobs')
+    def betweenness(self, n_jobs=None):
         """
-        bet_cen = nx.betweenness_centrality(self.graph_simpl)
-        bet_cen = list(bet_cen.values())
-        cpd = sum(max(bet_cen) - np.array(bet_cen)) / (len(bet_cen) - 1)
+        Computes the betweenness centrality of the nodes of the simplified
+        graph.
+
+        The betweenness centrality is normalized as in Networkx
+        (betweenness_centrality), by 1 / ((n-1)(n-2)). The simplified
+        graph is decomposed into biconnected blocks: the Brandes algorithm
+        is only run inside the blocks containing cycles, its sources being
+        split between n_jobs processes, and the pairs of nodes separated
+        by the cut vertices are counted from the tree of the blocks.
+
+        Parameters
+        ----------
+        n_jobs : int
+            Number of processes, by default the n_jobs of the KGraph.
+            -1 uses all the processors.
+
+        Returns
+        -------
+        dictionnary
+            betweenness centrality of each node of the simplified graph
 
-        return cpd
+        Examples
+        --------
+           >>> bet_cen = myKGraph.betweenness()
+           >>> bet_cen = myKGraph.betweenness(n_jobs=-1)
+        """
+        bet_cen = self._betweenness_array(n_jobs)
+        return dict(zip(self._labels[self._simpl_nodes].tolist(),
+                        bet_cen.tolist()))
 
-    def average_SPL(self, dist_weight=False):
+    @_cached_metric('backend', 'chunk_size', check=_check_backend)
+    def average_SPL(self, dist_weight=False, backend='scipy',
+                    chunk_size=None, k=None, seed=None):
         """
         Computes the average shortest path length.
 
@@ -783,6 +1772,10 @@ class KGraph:
 
         The computation is done on the simplified graph.
 
+        The graph is decomposed into biconnected blocks: the shortest
+        paths are only searched inside the blocks containing cycles, the
+        tree of the blocks giving the other paths in linear time.
+
         The function handles the case of several connected components
         which is not the case for the Networkx function
         "average_shortest_path_length".
@@ -797,41 +1790,99 @@ class KGraph:
             By default it is False.
             If it is True, the average is weighted by the distance.
 
+        backend : string
+            'scipy' (default) computes the shortest paths with
+            scipy.sparse.csgraph, by chunks of sources. 'python' uses
+            breadth first searches (Dijkstra algorithm if dist_weight is
+            True) written in pure Python, requiring less memory.
+
+        chunk_size : int
+            Number of sources whose distances are computed together by the
+            'scipy' backend. By default, it is chosen to hold about 2**23
+            distances in memory.
+
+        k : int
+            Number of sampled source nodes. By default, the shortest paths
+            from all the nodes are computed and the exact value is
+            returned. Otherwise, the average shortest path length is
+            estimated from the paths of k sources, sampled in strata of
+            nodes belonging to connected components of similar sizes, and
+            returned with its standard error.
+
+        seed : int
+            Seed of the random sampling of the sources.
+
         Returns
         -------
         float
             average shortest path length
+        tuple
+            If k is given: the estimated average shortest path length and
+            its standard error
 
         Examples
         --------
            >>> aspl = myKGraph.average_SPL()
+           >>> aspl = myKGraph.average_SPL(dist_weight=True, backend='python')
+           >>> aspl, se = myKGraph.average_SPL(k=1000, seed=0)
         """
 
-        sum_aspl = 0  # initialize the sum
-        # Compute average spl on each connected component with Networkx
-        for c in (self.graph_simpl.subgraph(c).copy()
-                  for c in nx.connected_components(self.graph_simpl)):
-            if not dist_weight:
-                sum_aspl += nx.average_shortest_path_length(
-                    c) * nx.number_of_nodes(c)
-            else:
-                sum_aspl += nx.average_shortest_path_length(
-                    c, weight="length") * nx.number_of_nodes(c)
+        if k is None:
+            blocks = _BlockCutTree(self._simpl_indptr, self._simpl_adj,
+                                   self._simpl_adj_length)
+            return blocks.average_SPL(dist_weight, backend, chunk_size)
 
-        av_SPL = sum_aspl / nx.number_of_nodes(self.graph_simpl)
+        if dist_weight:
+            weights = self._simpl_adj_length
+        else:
+            weights = None
+
+        def distance_sums(sources=None):
+            return _distance_sums(self._simpl_indptr, self._simpl_adj,
+                                  weights, sources, backend=backend,
+                                  chunk_size=chunk_size)
+
+        aspl, std_error, nb_sources = _sampled_average_SPL(
+            self._simpl_indptr, self._simpl_adj, distance_sums, k,
+            np.random.default_rng(seed))
+        if self.verbose:
+            print("Average shortest path length estimated from",
+                  nb_sources, "sources")
 
-        return av_SPL
+        return aspl, std_error
 
-    def characterize_graph(self, verbose=False):
+    def characterize_graph(self, verbose=False, metrics=None, executor=None,
+                           max_workers=None):
         """
         Computes the set of metrics used to characterize a graph.
 
+        Only the requested metrics are computed, with the metrics they
+        depend on: for instance, the shortest paths are not searched if
+        'aspl' and 'cpd' are not requested. The intermediate arrays (the
+        branch lengths, the degrees of the simplified graph) are shared by
+        the metrics using them.
+
         Parameters
         ----------
         verbose : boolean
             If True, the function displays information about the
             progress of the computation, and the results.
 
+        metrics : list
+            Names of the metrics to compute (keys of the returned
+            dictionnary), by default all of them.
+
+        executor : string
+            If 'thread' or 'process', the groups of metrics (path metrics,
+            degree statistics, branch statistics and entropies) are
+            computed concurrently in a pool of threads or of processes.
+            By default, they are computed one after the other. The result
+            does not depend on the executor.
+
+        max_workers : int
+            Number of threads or processes of the executor, by default one
+            per group of metrics.
+
         Returns
         -------
         dictionnary
@@ -842,83 +1893,243 @@ class KGraph:
             `mean length` : mean length of the branches,
             `cv length` : coefficient of variation of length of branches,
             `length entropy` : entropy of the length of the branches,
-            `mean tortuosity` : mean tortuosity of the branches,
+            `tortuosity` : mean tortuosity of the branches,
             `orientation entropy` : entropy of the orientation of the conduits,
             `aspl` : average shortest path length,
             `cpd` : central point dominance,
             `mean degree` : mean of the vertex degrees,
-            `cv degrees` : coefficient of variation of vertex degrees,
+            `cv degree` : coefficient of variation of vertex degrees,
             `correlation vertex degree` :  correlation of vertex degrees,
 
         Examples
         --------
         >>> results = myKGraph.characterize_graph()
+        >>> results = myKGraph.characterize_graph(metrics=['cv degree'])
+        >>> results = myKGraph.characterize_graph(executor='process')
         """
 
-        results = {}
+        if metrics is None:
+            metrics = _METRICS
+        elif isinstance(metrics, str):
+            metrics = [metrics]
+        unknown = set(metrics) - set(_METRICS)
+        if unknown:
+            raise ValueError("Unknown metrics {}, the metrics are {}".format(
+                sorted(unknown), list(_METRICS)))
+
+        # Steps computing the requested metrics and the metrics they need
+        needed = set(metrics)
+        steps = []
+        for step, computed, required in reversed(_CHARACTERIZATION_STEPS):
+            if needed.intersection(computed):
+                needed.update(required)
+                steps.append(step)
+        steps.reverse()
 
         if verbose:
             print('Computing:')
-            print(' - mean length', end='', flush=True)
-
-        results["mean length"] = self.mean_length()
+            print(' - ' + ', '.join(metric for metric in _METRICS
+                                    if metric in needed),
+                  end='', flush=True)
 
-        if verbose:
-            print(',cv length', end='', flush=True)
-
-        results["cv length"] = self.coef_variation_length()
-
-        if verbose:
-            print(',length entropy', end='', flush=True)
-
-        results["length entropy"] = self.length_entropy()
+        if executor is None:
+            results, _ = _characterization_task(self, steps, needed)
+        else:
+            results = self._parallel_characterization(steps, needed,
+                                                      executor, max_workers)
+        results = {key: results[key] for key in _METRICS
+                   if key in metrics}
 
         if verbose:
-            print(',mean tortuosity', end='', flush=True)
+            print('', end='\n', flush=True)
+            print("--------------------------------------")
+            for key in results.keys():
+                print(" %25s = %5.3f" % (key, results[key]))
+            print("--------------------------------------")
 
-        results["tortuosity"] = self.mean_tortuosity()
+        return (results)
 
-        if verbose:
-            print('', end='\n', flush=True)
-            print(' - orientation entropy', end='', flush=True)
+    @property
+    def metric_cache(self):
+        """
+        Results of the metrics computed on the current version of the
+        graph, as a dictionnary whose keys are the name of the metric
+        method and a tuple of its (parameter, value) pairs.
 
-        results["orientation entropy"] = self.orientation_entropy()
+        The metrics (mean_length, length_entropy, average_SPL,
+        central_point_dominance, betweenness...) are only computed once
+        for each set of parameters, until the graph is modified. The
+        parameters which do not change the result (n_jobs, chunk_size)
+        are not part of the keys. characterize_graph reuses the cached
+        metrics.
 
-        if verbose:
-            print(',aspl', end='', flush=True)
+        Examples
+        --------
+           >>> myKGraph.characterize_graph()
+           >>> list(myKGraph.metric_cache)
+        """
+        return dict(self._metric_results())
 
-        results["aspl"] = self.average_SPL()
+    def clear_metric_cache(self, name=None):
+        """
+        Clears the cached results of the metrics.
 
-        if verbose:
-            print(',cpd', end='', flush=True)
+        Parameters
+        ----------
+        name : string
+            Name of the metric method whose results are cleared, by
+            default all the results are cleared.
 
-        results["cpd"] = self.central_point_dominance()
+        Examples
+        --------
+           >>> myKGraph.clear_metric_cache()
+           >>> myKGraph.clear_metric_cache('average_SPL')
+        """
+        if name is None:
+            self._metric_cache.clear()
+        else:
+            for key in [key for key in self._metric_cache
+                        if key[0] == name]:
+                del self._metric_cache[key]
 
-        if verbose:
-            print(',md,cv degree', end='', flush=True)
+    # *************************************************************************
+    # Non Public member functions of KGraph class
+    # *************************************************************************
 
-        md, cvde = self.mean_degree_and_CV()
-        results["mean degree"] = md
-        results["cv degree"] = cvde
+    # *******************************
+    # Private functions for metrics
+    # *******************************
 
-        if verbose:
-            print(',cvd', end='', flush=True)
+    def _betweenness_array(self, n_jobs=None):
+        """NON PUBLIC.
+        Betweenness centrality of the nodes of the simplified graph, in
+        the order of _simpl_nodes, computed by n_jobs processes (by
+        default the n_jobs of the KGraph).
+        """
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        blocks = _BlockCutTree(self._simpl_indptr, self._simpl_adj)
+        return blocks.brandes(_n_workers(n_jobs))[0]
 
-        cvd = self.correlation_vertex_degree(cvde=cvde)
-        results["correlation vertex degree"] = cvd
+    def _characterization_step(self, step, needed, results):
+        """NON PUBLIC.
+        Computes a step of characterize_graph (see _CHARACTERIZATION_STEPS),
+        needed being the set of the metrics to compute and results the
+        metrics computed by the previous steps. Returns a dictionnary of
+        the computed metrics.
+        """
+        if step == 'mean length':
+            return {'mean length': self.mean_length()}
+        elif step == 'cv length':
+            return {'cv length': self.coef_variation_length()}
+        elif step == 'length entropy':
+            return {'length entropy': self.length_entropy()}
+        elif step == 'mean tortuosity':
+            return {'tortuosity': self.mean_tortuosity()}
+        elif step == 'orientation entropy':
+            return {'orientation entropy': self.orientation_entropy()}
+        elif step == 'aspl,cpd':
+            if 'cpd' not in needed:
+                return {'aspl': self.average_SPL()}
+            if 'aspl' not in needed:
+                return {'cpd': self.central_point_dominance()}
+            # Both are computed from a single traversal of the simplified
+            # graph
+            aspl, cpd = self._aspl_and_cpd()
+            return {'aspl': aspl, 'cpd': cpd}
+        elif step == 'md,cv degree':
+            md, cvde = self.mean_degree_and_CV()
+            return {'mean degree': md, 'cv degree': cvde}
+        elif step == 'cvd':
+            cvd = self.correlation_vertex_degree(cvde=results['cv degree'])
+            return {'correlation vertex degree': cvd}
+
+    def _parallel_characterization(self, steps, needed, executor,
+                                   max_workers=None):
+        """NON PUBLIC.
+        Computes the steps of characterize_graph by groups (see
+        _CHARACTERIZATION_GROUPS) in a pool of threads or processes.
 
-        if verbose:
-            print('', end='\n', flush=True)
-            print("--------------------------------------")
-            for key in results.keys():
-                print(" %25s = %5.3f" % (key, results[key]))
-            print("--------------------------------------")
+        The construction stages are run before, so that the groups share
+        them. Each process receives a copy of the KGraph without its
+        Networkx views, and sends back its metric cache, which is merged
+        in the cache of the KGraph.
+        """
+        if executor not in ('thread', 'process'):
+            raise ValueError("executor must be None, 'thread' or 'process'")
 
-        return (results)
+        self.precompute()
+        if executor == 'thread':
+            pool = ThreadPoolExecutor
+            kgraph = self
+        else:
+            pool = ProcessPoolExecutor
+            kgraph = self._metrics_copy()
+        groups = {}
+        for step in steps:
+            groups.setdefault(_CHARACTERIZATION_GROUPS[step], []).append(step)
+        if max_workers is None:
+            max_workers = len(groups)
 
-    # *************************************************************************
-    # Non Public member functions of KGraph class
-    # *************************************************************************
+        results = {}
+        with pool(max_workers=max(max_workers, 1)) as workers:
+            futures = [workers.submit(_characterization_task, kgraph,
+                                      group, needed)
+                       for group in groups.values()]
+            for future in futures:
+                values, cache = future.result()
+                results.update(values)
+                if cache is not self._metric_cache:
+                    self._metric_results().update(cache)
+
+        return results
+
+    def _metrics_copy(self):
+        """NON PUBLIC.
+        Shallow copy of the KGraph sent to the processes computing the
+        metrics: the views built from the compact arrays (Networkx graphs,
+        positions, branches, node index) are not copied, and the copy has
+        its own metric cache.
+        """
+        kgraph = copy.copy(self)
+        kgraph.verbose = False
+        kgraph._graph = None
+        kgraph._graph_simpl = None
+        kgraph._pos2d = None
+        kgraph._pos3d = None
+        kgraph._branches = None
+        kgraph._index = None
+        kgraph._metric_cache = dict(self._metric_results())
+        return kgraph
+
+    def _aspl_and_cpd(self):
+        """NON PUBLIC.
+        Average shortest path length (counted in hops) and central point
+        dominance of the simplified graph, computed from the same
+        breadth first searches of the Brandes algorithm in the blocks of
+        the graph. They are stored in the metric cache as the results of
+        average_SPL() and central_point_dominance().
+        """
+        cache = self._metric_results()
+        aspl_key = KGraph.average_SPL.metric_key(self)
+        cpd_key = KGraph.central_point_dominance.metric_key(self)
+        if aspl_key not in cache or cpd_key not in cache:
+            blocks = _BlockCutTree(self._simpl_indptr, self._simpl_adj)
+            bet_cen, aspl = blocks.brandes(_n_workers(self.n_jobs))
+            cache[aspl_key] = aspl
+            cache[cpd_key] = _central_point_dominance(bet_cen)
+
+        return cache[aspl_key], cache[cpd_key]
+
+    def _metric_results(self):
+        """NON PUBLIC.
+        Metric cache of the current version of the graph: the results of
+        the previous versions are dropped.
+        """
+        if self._metric_version != self._version:
+            self._metric_cache.clear()
+            self._metric_version = self._version
+        return self._metric_cache
 
     # *******************************
     # Private functions for plots
@@ -1095,298 +2306,578 @@ class KGraph:
     # Private functions used by constructors
     # *******************************
 
+    def _run_stage(self, stage):
+        """NON PUBLIC.
+        Computes the structures of a construction stage if they have not
+        already been computed. The stages are listed in _STAGES, each one
+        can rely on the previous ones.
+        """
+        if stage in self._stages_done:
+            return
+
+        if stage == 'lengths':
+            with _stage('lengths'):
+                self._set_graph_lengths()
+        elif stage == 'orientations':
+            with _stage('orientations'):
+                self._set_graph_orientations()
+        elif stage == 'branches' and \
+                _n_workers(self.n_jobs) > 1 and len(self._edges) > 0:
+            # Branches and simplified graph built component by component
+            with _stage('branches'):
+                self._parallel_structures(_n_workers(self.n_jobs))
+            self._stages_done.add('simplified')
+        elif stage == 'branches':
+            # Branches are stored as flat arrays of node and edge indices,
+            # the nodes of branch i are self._br_nodes[self._br_ptr[i]:
+            # self._br_ptr[i + 1]] and its edges the following ones minus
+            # one
+            with _stage('branches'):
+                (self._br_nodes, self._br_edges, self._br_ptr,
+                 self.br_lengths, self.br_tort) = self._getallbranches()
+        elif stage == 'simplified':
+            # The branches may be computed with the simplified graph
+            self._run_stage('branches')
+            if stage in self._stages_done:
+                return
+            # self.list_simpl_edges is necessary to export graph to plines
+            with _stage('simplify'):
+                (self._simpl_edges, self._simpl_lengths, self._simpl_origin,
+                 self._simpl_span) = self._simplify_graph()
+                self._set_simplified_csr()
+        self._stages_done.add(stage)
+
+    def _set_simplified_csr(self):
+        """NON PUBLIC.
+        Builds the CSR adjacency of the simplified graph from the simple
+        edges.
+        """
+        (self._simpl_nodes, self._simpl_indptr, self._simpl_adj,
+         self._simpl_adj_length) = _simplified_csr(len(self._labels),
+                                                   self._simpl_edges,
+                                                   self._simpl_lengths)
+        self._simpl_degrees = np.diff(self._simpl_indptr)
+
+    def _invalidate(self):
+        """NON PUBLIC.
+        Called when the graph is modified: increments the version of the
+        graph and drops the views built from the previous version.
+        """
+        self._version += 1
+        self._graph = None
+        self._graph_simpl = None
+        self._pos2d = None
+        self._pos3d = None
+        self._branches = None
+
+    @property
+    def _node_index(self):
+        """NON PUBLIC.
+        Dictionnary of the index of each node name, built when needed.
+        """
+        if self._index is None:
+            self._index = dict(zip(self._labels.tolist(),
+                                   range(len(self._labels))))
+        return self._index
+
+    @property
+    def _extra_node_index(self):
+        """NON PUBLIC.
+        Dictionnary of the row in _extra_coords of each node having
+        coordinates but no edge.
+        """
+        return dict(zip(self._extra_labels.tolist(),
+                        range(len(self._extra_labels))))
+
+    def _append_edge_attributes(self, edges):
+        """NON PUBLIC.
+        Computes the already computed attributes of new edges, which are
+        appended to the attribute arrays.
+        """
+        d = _edge_vectors(self._coords, edges)
+        columns = {}
+        if 'length' in self._edge_attr:
+            columns['length'] = np.sqrt(np.sum(d ** 2, axis=1))
+        if 'length2d' in self._edge_attr:
+            (columns['length2d'], columns['azimuth'],
+             columns['dip']) = _edge_orientations(d[:, 0], d[:, 1], d[:, 2])
+        for name in self._edge_attr:
+            if name not in columns:
+                # Attributes set by the user are unknown on new edges
+                columns[name] = np.full(len(edges), _missing_value(
+                    self._edge_attr[name].dtype))
+        for name, values in columns.items():
+            self._edge_attr[name] = np.concatenate((self._edge_attr[name],
+                                                    values))
+
+    def _branch_ends(self):
+        """NON PUBLIC.
+        (B,2) array of the first and last node of each branch.
+        """
+        return np.column_stack((self._br_nodes[self._br_ptr[:-1]],
+                                self._br_nodes[self._br_ptr[1:] - 1]))
+
+    def _select_branches(self, ids):
+        """NON PUBLIC.
+        Flat node and edge arrays, with their offsets, of a subset of the
+        branches.
+        """
+        lengths = np.diff(self._br_ptr)
+        selected = np.zeros(len(lengths), dtype=bool)
+        selected[ids] = True
+        br_nodes = self._br_nodes[np.repeat(selected, lengths)]
+        br_edges = self._br_edges[np.repeat(selected, lengths - 1)]
+        br_ptr = np.concatenate(([0], np.cumsum(lengths[ids])))
+
+        return br_nodes, br_edges, br_ptr
+
+    def _update_branches(self, touched, edge_map=None):
+        """NON PUBLIC.
+        Updates the branches after a modification of the edges.
+
+        The branches containing one of the touched nodes are removed and
+        the edges that do not belong to the remaining branches are followed
+        again, starting from the same nodes as a complete extraction.
+        The simple edges of the branches having the same extremities as
+        the removed or new branches are computed again.
+
+        Parameters:
+        -----------
+           - touched : array of the nodes whose degree has changed
+           - edge_map : optional array of the new index of each old edge,
+                -1 for removed edges
+        """
+        if 'branches' not in self._stages_done:
+            return
+
+        nb_branches = len(self._br_ptr) - 1
+        lengths = np.diff(self._br_ptr)
+        old_ends = self._branch_ends()
+
+        # Branches going through a touched node
+        branch_of_node = np.repeat(np.arange(nb_branches), lengths)
+        hit = np.zeros(nb_branches, dtype=bool)
+        hit[branch_of_node[np.isin(self._br_nodes, touched)]] = True
+        keep = ~hit
+        br_nodes, br_edges, br_ptr = self._select_branches(
+            np.flatnonzero(keep))
+        if edge_map is not None:
+            br_edges = edge_map[br_edges]
+
+        # Follows the edges not belonging to the kept branches, from the
+        # start nodes of a complete extraction so that isolated loops
+        # start from the same node
+        visited = np.zeros(len(self._edges), dtype=bool)
+        visited[br_edges] = True
+        targets = _branch_targets(self._indptr, self._adj, self._labels)
+        is_end = np.zeros(len(self._indptr) - 1, dtype=bool)
+        is_end[self._edges[~visited]] = True
+        new_nodes, new_edges, new_ptr = _extract_branches(
+            self._indptr, self._adj, self._adj_edge,
+            targets[is_end[targets]], visited)
+        new_lengths, new_tort = self._branch_measures(new_nodes, new_edges,
+                                                      new_ptr)
+
+        self._br_nodes = np.concatenate((br_nodes, new_nodes))
+        self._br_edges = np.concatenate((br_edges, new_edges))
+        self._br_ptr = np.concatenate((br_ptr, new_ptr[1:] + br_ptr[-1]))
+        self.br_lengths = np.concatenate((self.br_lengths[keep],
+                                          new_lengths))
+        self.br_tort = np.concatenate((self.br_tort[keep], new_tort))
+
+        if 'simplified' in self._stages_done:
+            branch_map = np.cumsum(keep) - 1
+            branch_map[hit] = -1
+            changed = np.arange(len(self._br_ptr) - 1) >= len(br_ptr) - 1
+            self._update_simplified(old_ends, branch_map, changed)
+
+    def _update_simplified(self, old_ends, branch_map, changed):
+        """NON PUBLIC.
+        Updates the simple edges after a modification of the branches.
+
+        Parameters:
+        -----------
+           - old_ends : (B,2) array of the extremities of the branches
+                before the modification
+           - branch_map : new index of each old branch, -1 if removed
+           - changed : boolean array of the current branches that are new
+                or modified
+        """
+        nb_nodes = len(self._labels)
+        ends = self._branch_ends()
+        old_key = old_ends[:, 0] * nb_nodes + old_ends[:, 1]
+        key = ends[:, 0] * nb_nodes + ends[:, 1]
+
+        # Groups of branches with the same extremities that have changed
+        affected = np.union1d(old_key[branch_map < 0], key[changed])
+
+        keep = ~np.isin(old_key[self._simpl_origin], affected)
+        simpl_edges, simpl_lengths, simpl_origin, simpl_span = \
+            self._simplify_graph(np.flatnonzero(np.isin(key, affected)))
+
+        self._simpl_edges = np.vstack((self._simpl_edges[keep],
+                                       simpl_edges))
+        self._simpl_lengths = np.concatenate((self._simpl_lengths[keep],
+                                              simpl_lengths))
+        self._simpl_origin = np.concatenate(
+            (branch_map[self._simpl_origin[keep]], simpl_origin))
+        self._simpl_span = np.vstack((self._simpl_span[keep], simpl_span))
+        self._set_simplified_csr()
+
+    def _simpl_edge_slice(self, k):
+        """NON PUBLIC.
+        Slice of self._br_edges containing the edges of the simple edge k.
+        """
+        branch = self._simpl_origin[k]
+        start = self._br_ptr[branch] - branch
+        return (int(start + self._simpl_span[k, 0]),
+                int(start + self._simpl_span[k, 1]))
+
+    def _edge_column(self, name):
+        """NON PUBLIC.
+        Array of an edge attribute, computed if needed.
+        """
+        if name not in self._edge_attr and name in _EDGE_STAGES:
+            self._run_stage(_EDGE_STAGES[name])
+        return self._edge_attr[name]
+
     def _set_graph_lengths(self):
         """NON PUBLIC.
         Compute edge length at the creation of KGraph object.
         This function is called by all constructors.
-        It updates graph_.
+        It updates self._edge_attr.
         """
 
-        # Creation of a dictionnary to store the length of each edge
-        length = {}
-        for e in self.graph.edges():
-            dx = self.pos3d[e[0]][0] - self.pos3d[e[1]][0]
-            dy = self.pos3d[e[0]][1] - self.pos3d[e[1]][1]
-            dz = self.pos3d[e[0]][2] - self.pos3d[e[1]][2]
-            length[e] = np.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
+        # Coordinate differences between the extremities of all the edges
+        d = _edge_vectors(self._coords, self._edges)
         # Storing the length as an edge attribute
-        nx.set_edge_attributes(self.graph, length, 'length')
+        self._edge_attr['length'] = np.sqrt(np.sum(d ** 2, axis=1))
 
         return
 
-    def _simplify_graph(self):
+    def _simplify_graph(self, branch_ids=None):
         """
         Constructs a simplified graph by removing nodes of degree 2.
         Member function:
-          Use self.graph (with its "length" attribute on edges) and self.pos3d
-          Use self.branches produced by get_allbranches_
+          Use self._edge_column('length') and the branches produced by
+          _getallbranches
+
+        Parameters:
+        -----------
+           - branch_ids : optional array of the branches to simplify, all
+                the branches by default. Branches having the same
+                extremities must be simplified together.
 
         Returns:
         --------
-           - list_simpl_edges : the list of simple edges (necessary for export
-                to pline)
-           - Gs: the simplified output graph object
+           - simpl_edges : (S,2) array of the simple edges, as node indices
+           - simpl_lengths : array of the length of the simple edges
+           - simpl_origin : array of the index of the branch of each simple
+                edge
+           - simpl_span : (S,2) array, simple edge k covers the edges
+                simpl_span[k, 0] to simpl_span[k, 1] - 1 of its branch
 
         """
 
-        # Deals with cycles and loops to ensure that topology is not changed
-        simpl_edges = _split_branches(self.branches)
-
-        # Creates a new empty graph
-        Gs = nx.Graph()
-
-        # Read the dictionnary of length for each edge
-        length = nx.get_edge_attributes(self.graph, 'length')
-
-        # Creates the dictionnary for length  of edges
-        edges_length = {}
-
-        # list of simpl_edges for export
-        list_simpl_edges = []
-        # Fills the graph with simpl_edges
-        for i in simpl_edges:
-            # Add the edge corresponding to the simpl_edges
-            Gs.add_edge(i[0], i[-1])
-            list_simpl_edges.append([i[0], i[-1]])
-
-            # Compute the length of the current edge
-            l_edge = 0
-            for k in range(0, len(i) - 1):
-                local_edge = (i[k], i[k + 1])
-                if length.__contains__(local_edge):
-                    l_edge += length[local_edge]
-                else:
-                    local_edge = (i[k + 1], i[k])
-                    if length.__contains__(local_edge):
-                        l_edge += length[local_edge]
-                    else:
-
-                        if self.verbose:
-                            print("Warning: could not find ",
-                                  "1 edge when computing length")
-
-            edges_length[(i[0], i[-1])] = l_edge
+        if branch_ids is None:
+            branch_ids = np.arange(len(self._br_ptr) - 1)
+        branch_ids = np.asarray(branch_ids, dtype=np.int64)
 
-        # Stores the results
-        nx.set_edge_attributes(Gs, edges_length, 'length')
-
-        return list_simpl_edges, Gs
+        return _simple_edges(self._br_nodes, self._br_edges, self._br_ptr,
+                             branch_ids, self._edge_column('length'))
 
     def _getallbranches(self):
         """
-        Constructs the list of all branches of the karstic graph self_graph.
+        Constructs all branches of the karstic graph.
         Compute lengths and tortuosities
+
+        Returns:
+        --------
+           - br_nodes : flat array of the node indices of the branches
+           - br_edges : flat array of the edge indices of the branches
+           - br_ptr : (B+1) array of offsets, branch i is made of the nodes
+                br_nodes[br_ptr[i]:br_ptr[i+1]] and of the edges
+                br_edges[br_ptr[i]-i:br_ptr[i+1]-i-1]
+           - br_lengths : array of the branch lengths
+           - br_tort : array of the branch tortuosities
         """
 
-        # Initialisations
-        target = []
-        degreeTarget = []
-
-        # Create one subgraph per connected components
-        # to get isolated loops as branches
-        # Return a list of connected graphs
-        list_sub_gr = [self.graph.subgraph(c).copy()
-                       for c in nx.connected_components(self.graph)]
-
-        for sub_gr in list_sub_gr:
-            local_counter = 0
-            last_node_index = 0
-            # Identifies all the extremeties of the branches (nodes of degree
-            # != 2)
-            for i in sub_gr.nodes():
-                if (sub_gr.degree(i) != 2):
-                    target.append(i)
-                    degreeTarget.append(nx.degree(sub_gr, i))
-                    local_counter += 1
-                last_node_index = i
-            # to manage cases where a subgraph is only composed of nodes of
-            # degree 2
-            if (local_counter == 0):
-                target.append(last_node_index)
-                degreeTarget.append(nx.degree(sub_gr, last_node_index))
-
-        # Identifies all the neighbors of those nodes,
-        # to create all the initial paths
-        listStartBranches = []
-        for i in target:
-            for n in self.graph.neighbors(i):
-                listStartBranches.append([i, n])
-
-        # Follow all these initial paths to get all the branches
-        branches = []
-        for path in listStartBranches:
-            go = True
-            # Check all existing branches to avoid adding a branch twice
-            # if starting from other extremity
-            for knownbranch in branches:
-                if ((path[0] == knownbranch[-1]) &
-                        (path[1] == knownbranch[-2])):
-                    go = False
-                    break
-            if go:
-                branches.append(self._getbranch(path))
-
-        # Compute the list of branch lengths and tortuosities
-        br_lengths = []
-        br_tort = []
-
-        # Read the dictionnary of length for each edge
-        length = nx.get_edge_attributes(self.graph, 'length')
-
-        # To count the number of looping branches, for which tortuosity is Nan
-        nb_of_Nan = 0
-        for br in branches:
-
-            # Computes the distance between extremities IF they are different
-            if self.pos3d[br[0]] != self.pos3d[br[-1]]:
-                dx = self.pos3d[br[0]][0] - self.pos3d[br[-1]][0]
-                dy = self.pos3d[br[0]][1] - self.pos3d[br[-1]][1]
-                dz = self.pos3d[br[0]][2] - self.pos3d[br[-1]][2]
-                dist = np.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
-            else:
-                dist = 0
-
-            # Compute the length of the current branch
-            br_len = 0
-            tort = 0
-            # we don't want to treat the last node of the branch
-            for k in range(0, len(br) - 1):
-                local_edge = (br[k], br[k + 1])
-                if length.__contains__(local_edge):
-                    br_len += length[local_edge]
-                else:
-                    local_edge = (br[k + 1], br[k])
-                    if length.__contains__(local_edge):
-                        br_len += length[local_edge]
-                    else:
-                        print("Warning: could not find ",
-                              "1 edge when computing length")
-
-            br_lengths.append(br_len)
-            # dist = 0 when positions are not defined
-            # or when we have a loop
-            if dist != 0:
-                tort = br_len / dist
-                br_tort.append(tort)
-            else:
-                # print("Warning: tortuosity is infinite on a looping branch.",
-                # "It is set to NAN to avoid further errors.")
-                # Pauline : On real systems, this message appears too many
-                # times and let the user thinks something goes wrong
-                br_tort.append(np.nan)
-                nb_of_Nan += 1
+        targets = _branch_targets(self._indptr, self._adj, self._labels)
+        br_nodes, br_edges, br_ptr = _extract_branches(
+            self._indptr, self._adj, self._adj_edge, targets)
+
+        br_lengths, br_tort = self._branch_measures(br_nodes, br_edges,
+                                                    br_ptr)
+        self._looping_warning(br_tort)
 
+        return br_nodes, br_edges, br_ptr, br_lengths, br_tort
+
+    def _looping_warning(self, br_tort):
+        """NON PUBLIC.
+        Prints the number of looping branches when verbose.
+        """
         if self.verbose:
             print(
                 "Warning: This network contains ",
-                nb_of_Nan,
+                np.count_nonzero(np.isnan(br_tort)),
                 "looping branche.s",
                 "Tortuosity is infinite on a looping branch.",
                 "The looping branches are not considered",
                 "for the mean tortuosity computation\n")
 
-        return branches, np.array(br_lengths), np.array(br_tort)
-
-    # ***********Functions relating to branches of graphs.
-    #     A branch is defined between two nodes of degree < > 2
-
-    def _nextstep(self, path):
+    def _parallel_structures(self, n_workers):
+        """NON PUBLIC.
+        Computes the branches, their lengths and tortuosities and the simple
+        edges of each connected component in a pool of n_workers processes.
+
+        The components are gathered in contiguous groups of similar sizes,
+        each group being processed as an independent graph. As the branches
+        are extracted component by component, the results of the groups
+        are simply concatenated in the order of the components, which gives
+        exactly the result of the serial construction.
         """
-        Work on self_graph
-        Adds the next node to a path of self_graph along a branch.
-        Stops when reaches a node of degree different from 2.
+        nb_nodes = len(self._labels)
+        nb_edges = len(self._edges)
+        nb_comp, comp = _connected_components(self._indptr, self._adj)
+        edge_comp = comp[self._edges[:, 0]]
+
+        # Contiguous groups of components with similar numbers of edges
+        nb_groups = min(nb_comp, 4 * n_workers)
+        comp_edges = np.bincount(edge_comp, minlength=nb_comp)
+        before = np.cumsum(comp_edges) - comp_edges
+        comp_group = np.minimum(before * nb_groups // max(nb_edges, 1),
+                                nb_groups - 1)
+
+        node_group = comp_group[comp]
+        edge_group = comp_group[edge_comp]
+        group_nodes = np.split(np.argsort(node_group, kind='stable'),
+                               np.cumsum(np.bincount(
+                                   node_group, minlength=nb_groups))[:-1])
+        group_edges = np.split(np.argsort(edge_group, kind='stable'),
+                               np.cumsum(np.bincount(
+                                   edge_group, minlength=nb_groups))[:-1])
+
+        # The start nodes of the branches depend on the whole graph (size
+        # of the components, names of the nodes), they are found here
+        targets = _branch_targets(self._indptr, self._adj, self._labels)
+        target_group = node_group[targets]
+
+        length = self._edge_column('length')
+        tasks = [(np.searchsorted(nodes, self._edges[edges]), length[edges],
+                  self._coords[nodes],
+                  np.searchsorted(nodes, targets[target_group == group]))
+                 for group, (nodes, edges) in enumerate(zip(group_nodes,
+                                                            group_edges))]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_component_structures, *zip(*tasks)))
+
+        # Back to the indices of the whole graph
+        br_nodes, br_edges, br_ptr, br_lengths, br_tort = [], [], [], [], []
+        simpl_edges, simpl_lengths, simpl_origin, simpl_span = [], [], [], []
+        nb_br = 0
+        nb_br_nodes = 0
+        for nodes, edges, res in zip(group_nodes, group_edges, results):
+            br_nodes.append(nodes[res[0]])
+            br_edges.append(edges[res[1]])
+            br_ptr.append(res[2][:-1] + nb_br_nodes)
+            br_lengths.append(res[3])
+            br_tort.append(res[4])
+            simpl_edges.append(nodes[res[5]])
+            simpl_lengths.append(res[6])
+            simpl_origin.append(res[7] + nb_br)
+            simpl_span.append(res[8])
+            nb_br += len(res[2]) - 1
+            nb_br_nodes += res[2][-1]
+        br_ptr.append([nb_br_nodes])
+
+        self._br_nodes = np.concatenate(br_nodes).astype(np.int64)
+        self._br_edges = np.concatenate(br_edges).astype(np.int64)
+        self._br_ptr = np.concatenate(br_ptr).astype(np.int64)
+        self.br_lengths = np.concatenate(br_lengths)
+        self.br_tort = np.concatenate(br_tort)
+        self._simpl_edges = np.concatenate(simpl_edges).reshape(
+            -1, 2).astype(np.int64)
+        self._simpl_lengths = np.concatenate(simpl_lengths)
+        self._simpl_origin = np.concatenate(simpl_origin).astype(np.int64)
+        self._simpl_span = np.concatenate(simpl_span).reshape(
+            -1, 2).astype(np.int64)
+        self._set_simplified_csr()
+        self._looping_warning(self.br_tort)
+
+    def _branch_measures(self, br_nodes, br_edges, br_ptr):
+        """NON PUBLIC.
+        Lengths and tortuosities of branches given as flat arrays.
         """
+        return _measure_branches(self._edge_column('length'), self._coords,
+                                 br_nodes, br_edges, br_ptr)
 
-        current = path[-1]
-        # Checks first if the end of the path is already on an end
-        if (self.graph.degree(current) != 2):
-            stopc = False
-            return path, stopc
+    # *******************************
+    # Private functions used for orientations
+    # *******************************
 
-        # This is a security / it may be removed
-        if len(path) > 1:
-            old = path[-2]
-        else:
-            old = current
+    def _set_graph_orientations(self):
+        """NON PUBLIC.
+        Compute edge projected length, azimuth and dip at the creation of
+        KGraph object.
+        This function is called by all constructors.
+        It updates self._edge_attr.
+        """
 
-        # Among the neighbors search for the next one
-        for nextn in self.graph.neighbors(current):
-            if old != nextn:
-                break
+        d = _edge_vectors(self._coords, self._edges)
+        length2d, azimuth, dip = _edge_orientations(d[:, 0], d[:, 1], d[:, 2])
 
-        # Add the next node to the path and check stopping criteria
-        path.append(nextn)
+        # Storing the results as edge attributes
+        self._edge_attr['length2d'] = length2d
+        self._edge_attr['azimuth'] = azimuth
+        self._edge_attr['dip'] = dip
 
-        # Test for a closed loop / even if start node has degree = 2
-        testloop = path[0] == path[-1]
+        return
 
-        if ((self.graph.degree(nextn) != 2) or testloop):
-            stopc = False
-        else:
-            stopc = True
+    # *******************************
+    # Private functions building the Networkx views
+    # *******************************
 
-        return path, stopc
+    def _number_connected_components(self):
+        """NON PUBLIC.
+        Number of connected components of the complete graph.
+        """
+        return _number_connected_components(self._indptr, self._adj)
 
-    def _getbranch(self, path):
+    def _build_graph(self):
+        """NON PUBLIC.
+        Builds the Networkx complete graph from the compact arrays.
+        The nodes are added first to keep the order of the node names.
         """
-        Work on self_graph
-        Construct a branch from a starting node.
+        G = nx.Graph()
+        labels = self._labels.tolist()
+        G.add_nodes_from(labels)
+
+        self._run_stage('lengths')
+        self._run_stage('orientations')
+        names = list(self._edge_attr.keys())
+        columns = [self._edge_attr[name].tolist() for name in names]
+        for k, (i, j) in enumerate(self._edges.tolist()):
+            attr = {}
+            if self._edge_data is not None:
+                attr.update(self._edge_data[k])
+            attr.update((name, col[k]) for name, col in zip(names, columns))
+            G.add_edge(labels[i], labels[j], **attr)
+
+        return G
+
+    def _build_graph_simpl(self):
+        """NON PUBLIC.
+        Builds the Networkx simplified graph from the simplified edges.
         """
+        Gs = nx.Graph()
+        labels = self._labels.tolist()
+        for (i, j), length in zip(self._simpl_edges.tolist(),
+                                  self._simpl_lengths.tolist()):
+            Gs.add_edge(labels[i], labels[j], length=length)
 
-        path, stopc = self._nextstep(path)
-        while stopc:
-            path, stopc = self._nextstep(path)
-        return (path)
+        return Gs
 
-    # *******************************
-    # Private functions used for orientations
-    # *******************************
 
-    def _set_graph_orientations(self):
-        """NON PUBLIC.
-        Compute edge length at the creation of KGraph object.
-        This function is called by all constructors.
-        It updates graph_.
-        """
-
-        # Creation of a dictionnary to store the projected length of each edge,
-        # the dip and the azimuth
-        length2d = {}
-        dip = {}
-        azimuth = {}
-        for e in self.graph.edges():
-            dx = self.pos3d[e[0]][0] - self.pos3d[e[1]][0]
-            dy = self.pos3d[e[0]][1] - self.pos3d[e[1]][1]
-            dz = self.pos3d[e[0]][2] - self.pos3d[e[1]][2]
-            length2d[e] = np.sqrt(dx ** 2 + dy ** 2)
-
-            if length2d[e] != 0:
-                dip[e] = np.arctan(dz / length2d[e])  # returns in radians
-                dip[e] = np.degrees(dip[e])
-                azimuth[e] = np.pi / 2 - np.arctan2(dy, dx) # returns in radians
-                azimuth[e] = np.degrees(azimuth[e]) % 360 
-
-                if (dz < 0):
-                    # negative cave gradients yield positive plunges in a stereonet
-                    dip[e] = -dip[e] 
-                else:
-                    # positive cave gradients have bearings 180 apart for the stereonet
-                    azimuth[e] = (azimuth[e] + 180) % 360 
+# -------------------END of KGraph class-------------------------------
 
-            else:  # case of nearly pure vertical segments
-                azimuth[e] = np.nan
-                # azimuth[e] = 0.0 #Convention
-                dip[e] = 90  # degrees
 
-        # Storing the length as an edge attribute
-        nx.set_edge_attributes(self.graph, length2d, 'length2d')
-        nx.set_edge_attributes(self.graph, azimuth, 'azimuth')
-        nx.set_edge_attributes(self.graph, dip, 'dip')
+def load(path, mmap=True, verbose=None, allow_pickle=False):
+    """
+    Loads a KGraph saved with KGraph.save.
 
-        return
+    Nothing is computed again: the branches and the simplified graph are
+    read from the saved arrays. With mmap=True, the arrays are memory
+    mapped (in copy-on-write mode, the files are never modified), so that
+    they are only read from the disk when they are used.
 
+    Parameters
+    ----------
+    path : string
+        Name of the directory written by KGraph.save
+
+    mmap : boolean
+        If True (default), the arrays are memory mapped, otherwise they
+        are read in memory.
+
+    verbose : boolean
+        Verbose mode of the KGraph, by default the one of the saved KGraph
+
+    allow_pickle : boolean
+        If True, reads the objects stored in a pickle file (KGraph saved
+        with allow_pickle=True, or with karstnet versions writing the
+        format 1). Loading a pickle file can execute arbitrary code: only
+        use it for files from a trusted source. If False (default), such
+        a KGraph raises a ValueError.
+
+    Returns
+    -------
+    KGraph
+        A KGraph object
+
+    Examples
+    --------
+       >>> myKGraph = kn.load("MyKarst.kgraph")
+    """
+    with open(os.path.join(path, 'karstnet.json')) as f:
+        metadata = json.load(f)
+    if metadata.get('format') != 'karstnet.KGraph':
+        raise ValueError("{} does not contain a KGraph".format(path))
+    if metadata['version'] > _FORMAT_VERSION:
+        raise ValueError("{} was saved with a more recent version of "
+                         "karstnet (format {})".format(path,
+                                                       metadata['version']))
+    if 'objects' in metadata:
+        objects = _from_json(metadata['objects'])
+    elif allow_pickle:
+        with open(os.path.join(path, 'objects.pkl'), 'rb') as f:
+            objects = pickle.load(f)
+    else:
+        raise ValueError("{} contains pickled objects, which can execute "
+                         "arbitrary code when loaded: use "
+                         "allow_pickle=True if the file comes from a "
+                         "trusted source".format(path))
+
+    mmap_mode = 'c' if mmap else None
+    arrays = {name: np.load(os.path.join(path, name + '.npy'),
+                            mmap_mode=mmap_mode, allow_pickle=False)
+              for name in metadata['arrays']}
+
+    labels = {}
+    for name in ('_labels', '_extra_labels'):
+        if name[1:] in objects:
+            labels[name] = _label_array(list(objects[name[1:]]))
+        elif name not in arrays:
+            # Saved before the nodes without edge were kept
+            labels[name] = np.zeros(0, dtype=np.int64)
+        elif metadata.get(name[1:]) == 'str':
+            labels[name] = np.array(arrays[name].tolist(), dtype=object)
+        else:
+            labels[name] = arrays[name]
+
+    kgraph = KGraph.__new__(KGraph)
+    kgraph._setup(labels['_labels'], arrays['_edges'], arrays['_coords'],
+                  (labels['_extra_labels'],
+                   arrays.get('_extra_coords', np.zeros((0, 3)))),
+                  objects['edge_data'], objects['properties'],
+                  metadata['verbose'] if verbose is None else verbose,
+                  metadata['n_jobs'],
+                  (arrays['_indptr'], arrays['_adj'], arrays['_adj_edge']))
+    for stage, names in _SAVED_ARRAYS.items():
+        for name in names:
+            if stage != 'core' and name in arrays:
+                setattr(kgraph, name, arrays[name])
+
+    for i, name in enumerate(metadata['edge_attributes']):
+        if name in objects.get('edge_attr', {}):
+            column = np.empty(len(kgraph._edges), dtype=object)
+            column[:] = list(objects['edge_attr'][name])
+        else:
+            column = arrays['edge_attr_{}'.format(i)]
+        kgraph._edge_attr[name] = column
+    kgraph._stages_done = set(metadata['stages'])
+
+    return kgraph
 
-# -------------------END of KGraph class-------------------------------
 
 # **************************************************************
 #
@@ -1396,121 +2887,1332 @@ class KGraph:
 # **************************************************************
 
 
-def _pos_initialization(coordinates):
-    '''NON PUBLIC.
-    Create a dictionnary of 3d coordinates from 2d or 3d input coordinates.
+def _to_json(value):
+    """NON PUBLIC.
+    Converts the objects saved by KGraph.save (None, booleans, numbers,
+    strings, lists, tuples and dictionnaries with any of these as keys)
+    to a JSON value restored by _from_json: tuples and dictionnaries are
+    tagged so that their type and the type of the keys are kept.
+    Raises TypeError for the other objects.
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value)
+    if isinstance(value, list):
+        return [_to_json(v) for v in value]
+    if isinstance(value, tuple):
+        return {'tuple': [_to_json(v) for v in value]}
+    if isinstance(value, dict):
+        return {'dict': [[_to_json(k), _to_json(v)]
+                         for k, v in value.items()]}
+    raise TypeError("Object of type {} can not be saved without "
+                    "pickle".format(type(value).__name__))
+
+
+def _from_json(value):
+    """NON PUBLIC.
+    Restores an object converted by _to_json.
+    """
+    if isinstance(value, list):
+        return [_from_json(v) for v in value]
+    if isinstance(value, dict):
+        if 'tuple' in value:
+            return tuple(_from_json(v) for v in value['tuple'])
+        return {_from_json(k): _from_json(v) for k, v in value['dict']}
+    return value
+
+
+def _label_array(labels):
+    """NON PUBLIC.
+    Stores a list of node names in a numpy array, using an integer array
+    when all the names are integers and an object array otherwise.
+    """
+    if len(labels) == 0 or all(isinstance(l, (int, np.integer))
+                               for l in labels):
+        return np.array(labels, dtype=np.int64)
+    array = np.empty(len(labels), dtype=object)
+    for i, label in enumerate(labels):
+        array[i] = label
+    return array
+
+
+def _index_edges(edges):
+    """NON PUBLIC.
+    Converts the edges given to the constructor into node indices.
+
+    The nodes are numbered in the order in which they appear in the edges,
+    as in a Networkx graph built from these edges. Duplicated edges are
+    removed and each edge is oriented from its first to its last appearing
+    node, which is the orientation of the edges of a Networkx graph.
+
+    Returns:
+    --------
+       - labels : array of the node names, the position of a name is the
+            index of the node
+       - edges : (E,2) array of node indices
+       - data : list of the attribute dictionnaries of the edges when the
+            edges are given as (u, v, dictionnary), None otherwise
+    """
+    if isinstance(edges, np.ndarray) and edges.dtype.kind in 'iu':
+        flat = edges.reshape(-1, 2)[:, :2].ravel()
+        labels, first, inverse = np.unique(flat, return_index=True,
+                                           return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        labels = labels[order].astype(np.int64)
+        pairs = rank[inverse.ravel()].reshape(-1, 2)
+        data = None
+    else:
+        index = {}
+        labels = []
+        pairs = []
+        data = []
+        for e in edges:
+            for node in e[:2]:
+                if node not in index:
+                    index[node] = len(labels)
+                    labels.append(node)
+            pairs.append((index[e[0]], index[e[1]]))
+            data.append(dict(e[2]) if len(e) > 2 else {})
+        labels = _label_array(labels)
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        if not any(data):
+            data = None
+
+    # Orientation and removal of the duplicated edges
+    pairs = np.sort(pairs, axis=1)
+    key = pairs[:, 0] * len(labels) + pairs[:, 1]
+    _, keep = np.unique(key, return_index=True)
+    keep.sort()
+    if data is not None:
+        # As in Networkx, the attributes of duplicated edges are merged
+        merged = {}
+        for k, d in zip(key.tolist(), data):
+            merged.setdefault(k, {}).update(d)
+        data = [merged[k] for k in key[keep].tolist()]
+
+    return labels, np.ascontiguousarray(pairs[keep]), data
+
+
+def _data_column(data, name):
+    """NON PUBLIC.
+    Array of the values of the attribute name in a list of attribute
+    dictionnaries. Numeric values give a float array with NaN for missing
+    values, other values an object array with None for missing values.
+    """
+    values = [d.get(name) for d in data]
+    if all(v is None or (isinstance(v, (int, float, np.number)) and
+                         not isinstance(v, bool)) for v in values):
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=np.float64)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def _missing_value(dtype):
+    """NON PUBLIC.
+    Value of an edge attribute of type dtype on edges where it is unknown.
+    """
+    return np.nan if dtype.kind in 'biufc' else None
+
+
+def _coords_array(coordinates, labels):
+    """NON PUBLIC.
+    Create an (N,3) array of coordinates from 2d or 3d input coordinates,
+    the rows follow the order of the node names in labels.
     If only x, y are provided, z is set to 0
-    '''
 
-    coord_are_3d = True
-    for key in coordinates.keys():
-        if len(coordinates[key]) == 3:
-            break  # we only check one value and let coord_are_3d to True
-        else:
-            coord_are_3d = False
-            break
-    pos3d = {}
-    pos2d = {}
+    The coordinates are either a dictionnary, keys being the node names, or
+    an (M,2) or (M,3) array whose row i contains the coordinates of the
+    node i. An (N,3) float array whose rows are already in the order of
+    the nodes is used as is, without copy.
+    """
+    if isinstance(coordinates, np.ndarray):
+        if labels.dtype == object:
+            raise ValueError("When the coordinates are given as an array, "
+                             "the nodes must be row indices of the array")
+        values = coordinates
+        if (values.ndim == 2 and values.shape == (len(labels), 3) and
+                values.dtype == np.float64 and
+                np.array_equal(labels, np.arange(len(labels)))):
+            return values
+        values = np.asarray(values[labels], dtype=np.float64)
+        if values.shape[1] == 3:
+            return values
+    else:
+        if len(labels) == 0:
+            return np.zeros((0, 3))
+        values = np.array([coordinates[key] for key in labels.tolist()],
+                          dtype=np.float64)
+
+    coords = np.zeros((len(labels), 3))
     #  if coordinates are 3d
-    if coord_are_3d:
-        pos3d = coordinates
-        for key, coord in coordinates.items():
-            pos2d[key] = [coord[0], coord[1]]
+    if values.shape[1] == 3:
+        coords[:] = values
+    # if only x and y are provided, z value stays 0
+    else:
+        coords[:, :2] = values[:, :2]
+
+    return coords
+
 
-    # if only x and y are provided, set a z value = 0
+def _extra_nodes(coordinates, labels):
+    """NON PUBLIC.
+    Names and (M,3) array of coordinates of the nodes that have
+    coordinates but do not appear in the edges (labels), in the order of
+    the coordinates. If only x, y are provided, z is set to 0.
+    """
+    if isinstance(coordinates, np.ndarray):
+        extra = np.setdiff1d(np.arange(len(coordinates)), labels)
     else:
-        pos2d = coordinates
-        for key, coord in coordinates.items():
-            pos3d[key] = [coord[0], coord[1], 0]
+        known = set(labels.tolist())
+        extra = _label_array([key for key in coordinates
+                              if key not in known])
+    return extra, _coords_array(coordinates, extra)
+
+
+def _csr_adjacency(nb_nodes, edges):
+    """NON PUBLIC.
+    Builds the CSR adjacency of an undirected graph from an (E,2) array
+    of node indices.
+
+    The neighbors of each node are stored in the order of the edges, as
+    in the adjacency of a Networkx graph.
+
+    Returns:
+    --------
+       - indptr : (N+1) array, the neighbors of node i are stored between
+            indptr[i] and indptr[i+1]
+       - adj : (2E) array of the neighbor indices
+       - adj_edge : (2E) array of the index of the corresponding edge
+    """
+    src = edges.ravel()
+    dst = edges[:, ::-1].ravel()
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(nb_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=nb_nodes), out=indptr[1:])
+    adj = dst[order].astype(np.int64)
+    adj_edge = (order // 2).astype(np.int64)
 
-    return pos2d, pos3d
+    return indptr, adj, adj_edge
 
 
-# ******Functions used for graph simplification
+def _incident_edges(indptr, adj_edge, nodes):
+    """NON PUBLIC.
+    Indices of the edges connected to the given nodes (with repetitions).
+    """
+    start = indptr[nodes]
+    count = indptr[nodes + 1] - start
+    offsets = np.repeat(start - np.cumsum(count) + count, count)
+    return adj_edge[offsets + np.arange(np.sum(count))]
 
 
-def _split2(list_):
+def _edge_vectors(coords, edges):
+    """NON PUBLIC.
+    (E,3) array of the coordinate differences (first node - last node)
+    between the extremities of the edges.
     """
-    Splits a list in 2 sublists.
+    return coords[edges[:, 0]] - coords[edges[:, 1]]
+
+
+def _edge_orientations(dx, dy, dz):
+    """NON PUBLIC.
+    Projected length, azimuth and dip (in degrees) of edges given by their
+    coordinate differences.
+
+    Azimuths and dips follow the stereonet conventions: negative cave
+    gradients yield positive plunges and positive gradients have bearings
+    180 apart. The azimuth of a vertical edge is NaN and its dip is 90.
     """
-    list_length = len(list_)
-    if (list_length == 2):
-        return (list_, [])
-    else:
-        midpoint = int(list_length / 2)
-        return (list_[0:midpoint + 1], list_[midpoint:list_length])
+    length2d = np.sqrt(dx ** 2 + dy ** 2)
+    horizontal = length2d != 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dip = np.degrees(np.arctan(dz / length2d))  # radians to degrees
+    azimuth = np.degrees(np.pi / 2 - np.arctan2(dy, dx)) % 360
 
+    # negative cave gradients yield positive plunges in a stereonet
+    # positive cave gradients have bearings 180 apart for the stereonet
+    upward = dz >= 0
+    dip = np.where(upward, dip, -dip)
+    azimuth = np.where(upward, (azimuth + 180) % 360, azimuth)
 
-def _split3(list_):
+    # case of nearly pure vertical segments
+    azimuth[~horizontal] = np.nan
+    dip[~horizontal] = 90  # degrees
+
+    return length2d, azimuth, dip
+
+
+def _simplified_csr(nb_nodes, simpl_edges, simpl_lengths):
+    """NON PUBLIC.
+    Builds the CSR adjacency of the simplified graph.
+
+    The simplified graph only contains the extremities of the simple edges,
+    which are renumbered in the order in which they appear in the simple
+    edges. Duplicated simple edges are merged as in a Networkx graph.
+
+    Returns:
+    --------
+       - nodes : array of the (complete graph) index of the simplified nodes
+       - indptr, adj : CSR adjacency of the simplified graph
+       - adj_length : (2S) array of the length of the edges in adj
     """
-    Splits a list in 3 sublists.
+    flat = simpl_edges.ravel()
+    nodes, first, inverse = np.unique(flat, return_index=True,
+                                      return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    nodes = nodes[order]
+    local = rank[inverse.ravel()].reshape(-1, 2)
+
+    pairs = np.sort(local, axis=1)
+    key = pairs[:, 0] * len(nodes) + pairs[:, 1]
+    _, keep = np.unique(key, return_index=True)
+    keep.sort()
+    indptr, adj, adj_edge = _csr_adjacency(len(nodes), pairs[keep])
+
+    return nodes, indptr, adj, simpl_lengths[keep][adj_edge]
+
+
+def _csr_matrix(indptr, adj, weights=None):
+    """NON PUBLIC.
+    Scipy sparse matrix of a graph given by its CSR adjacency.
     """
-    list_length = len(list_)
-    if (list_length == 2):
-        return (list_, [], [])
-    elif (list_length == 3):
-        l1, l2 = _split2(list_)
-        return (l1, l2, [])
-    else:
-        k = int(list_length / 3.)
-        return (list_[0:k + 1], list_[k:2 * k + 1], list_[2 * k:list_length])
+    if weights is None:
+        weights = np.ones(len(adj))
+    n = len(indptr) - 1
+    return sp.csr_matrix((weights, adj, indptr), shape=(n, n))
 
 
-def _split_branches(branches):
+def _connected_components(indptr, adj):
+    """NON PUBLIC.
+    Number of connected components and component label of each node.
+    Components are numbered in the order of their first node.
+    """
+    nb_comp, comp = csgraph.connected_components(_csr_matrix(indptr, adj),
+                                                 directed=False)
+    # Renumbering of the components in the order of their first node
+    first = np.full(nb_comp, len(comp), dtype=np.int64)
+    np.minimum.at(first, comp, np.arange(len(comp)))
+    rank = np.empty(nb_comp, dtype=comp.dtype)
+    rank[np.argsort(first)] = np.arange(nb_comp)
+    return nb_comp, rank[comp]
+
+
+def _number_connected_components(indptr, adj):
+    """NON PUBLIC.
+    Number of connected components of a graph given by its CSR adjacency.
+    """
+    if len(indptr) <= 1:
+        return 0
+    return _connected_components(indptr, adj)[0]
+
+
+def _biconnected_blocks(indptr, adj):
+    """NON PUBLIC.
+    Biconnected blocks of a graph given by its CSR adjacency (without
+    duplicated edges), computed by the Hopcroft-Tarjan algorithm with an
+    iterative depth first search. Self loops are ignored.
+
+    Each block is closed when leaving a node w whose subtree cannot reach
+    above its parent h: h is the head of the block (a cut vertex or the
+    root of the search), w its child.
+
+    Returns:
+    --------
+       - block : block of each edge
+       - entries : adjacency entry of each edge
+       - head, child : head and child of each block
+       - size : number of nodes of the subtree of each node in the depth
+            first search
+       - hang : number of nodes reaching the block containing the edge to
+            the parent of each node through it (the node itself and the
+            subtrees of the blocks it heads)
+       - comp_size : number of nodes of the connected component of each
+            node
     """
-    Split branches in cases of loop or cycles.
+    n = len(indptr) - 1
+    indptr = indptr.tolist()
+    adj = adj.tolist()
+    ptr = indptr[:-1]
+    disc = [-1] * n
+    low = [0] * n
+    parent = [-1] * n
+    tree_entry = [-1] * n
+    size = [1] * n
+    hang = [1] * n
+    root = [0] * n
+    head = []
+    child = []
+    block = []
+    entries = []
+    edge_stack = []
+    time = 0
+
+    for r in range(n):
+        if disc[r] >= 0:
+            continue
+        disc[r] = low[r] = time
+        time += 1
+        root[r] = r
+        stack = [r]
+        while stack:
+            v = stack[-1]
+            if ptr[v] < indptr[v + 1]:
+                e = ptr[v]
+                ptr[v] += 1
+                w = adj[e]
+                if w == v or w == parent[v]:
+                    continue
+                if disc[w] < 0:
+                    # Tree edge
+                    disc[w] = low[w] = time
+                    time += 1
+                    parent[w] = v
+                    tree_entry[w] = e
+                    root[w] = r
+                    edge_stack.append(e)
+                    stack.append(w)
+                elif disc[w] < disc[v]:
+                    # Back edge to an ancestor
+                    edge_stack.append(e)
+                    if disc[w] < low[v]:
+                        low[v] = disc[w]
+                continue
+
+            stack.pop()
+            if not stack:
+                continue
+            h = parent[v]
+            size[h] += size[v]
+            if low[v] < low[h]:
+                low[h] = low[v]
+            if low[v] >= disc[h]:
+                # h is the head of a block closed by the edge h-v
+                b = len(head)
+                head.append(h)
+                child.append(v)
+                hang[h] += size[v]
+                while True:
+                    e = edge_stack.pop()
+                    block.append(b)
+                    entries.append(e)
+                    if e == tree_entry[v]:
+                        break
+
+    size = np.array(size, dtype=np.int64)
+    comp_size = size[np.array(root, dtype=np.int64)]
+
+    return (np.array(block, dtype=np.int64),
+            np.array(entries, dtype=np.int64),
+            np.array(head, dtype=np.int64),
+            np.array(child, dtype=np.int64),
+            size, np.array(hang, dtype=np.int64), comp_size)
+
+
+class _BlockCutTree:
+    """
+    NOT PUBLIC
+    Decomposition of a graph given by its CSR adjacency into biconnected
+    blocks, used to compute the exact shortest path metrics with searches
+    restricted to the blocks containing cycles.
+
+    A shortest path crosses the blocks of the block-cut tree between its
+    ends, entering and leaving each of them by one of its nodes. Seen from
+    a block B, a node x of B stands for the S_B(x) nodes reaching B
+    through x: x itself and the parts of the graph hanging from x outside
+    of B. Therefore:
+
+       - the sum of the lengths of the shortest paths between the ordered
+         pairs of nodes of a component is the sum over its blocks B of
+         sum_{x != y in B} S_B(x) S_B(y) d_B(x, y),
+       - the number of ordered pairs of nodes whose shortest paths go
+         through v (betweenness) is the number of pairs separated by v
+         (when v is a cut vertex) plus, for each block B containing v,
+         sum_{x, y != v in B} S_B(x) S_B(y) times the fraction of the
+         shortest x-y paths going through v in B.
+
+    The terms of the bridges are computed directly, so a tree requires no
+    search at all. The blocks with cycles are gathered in a block graph,
+    where each cut vertex is duplicated in each of its blocks with the
+    multiplicity S_B(x), on which the searches are done.
     """
 
-    # Creates a dictionnary to accelerate the search
-    # of branches having the same extremities
-    list_branches = dict()
-    for i, b in enumerate(branches):
-        key = (b[0], b[-1])
-        if list_branches.__contains__(key):
-            list_branches[key].append(i)
+    def __init__(self, indptr, adj, adj_length=None):
+        n = len(indptr) - 1
+        self.n = n
+        (block, entries, head, child, size, hang,
+         comp_size) = _biconnected_blocks(indptr, adj)
+        start = np.searchsorted(indptr, entries, side='right') - 1
+        end = adj[entries]
+        if adj_length is None:
+            length = np.ones(len(entries))
+        else:
+            length = adj_length[entries]
+
+        # Nodes of each block with their multiplicity S_B(x): the head
+        # stands for the nodes outside of the subtree of the child
+        key = np.unique(np.concatenate([block * n + start,
+                                        block * n + end]))
+        key_block = key // max(n, 1)
+        key_node = key - key_block * n
+        multiplicity = np.where(
+            key_node == head[key_block],
+            comp_size[key_node] - size[child[key_block]],
+            hang[key_node])
+
+        # Ordered pairs separated by each node: pairs of nodes in
+        # different parts of the component without the node
+        outside = (comp_size[key_node] - multiplicity).astype(np.float64)
+        self.cut = (comp_size - 1.) ** 2 - np.bincount(
+            key_node, weights=outside ** 2, minlength=n)
+
+        # Bridges, the blocks with a single edge
+        nb_block_edges = np.bincount(block, minlength=len(head))
+        bridge = nb_block_edges[block] == 1
+        s_start = multiplicity[np.searchsorted(
+            key, block[bridge] * n + start[bridge])]
+        s_end = multiplicity[np.searchsorted(
+            key, block[bridge] * n + end[bridge])]
+        self.bridge_pairs = 2. * s_start * s_end
+        self.bridge_length = length[bridge]
+        self.bridge_size = comp_size[start[bridge]]
+
+        # Block graph of the blocks with cycles
+        cyclic = nb_block_edges[key_block] > 1
+        cyclic_key = key[cyclic]
+        self.nodes = key_node[cyclic]
+        self.multiplicity = multiplicity[cyclic].astype(np.float64)
+        self.size = comp_size[self.nodes]
+        edges = np.column_stack([
+            np.searchsorted(cyclic_key, block[~bridge] * n + start[~bridge]),
+            np.searchsorted(cyclic_key, block[~bridge] * n + end[~bridge])])
+        self.indptr, self.adj, adj_edge = _csr_adjacency(len(self.nodes),
+                                                          edges)
+        self.adj_length = length[~bridge][adj_edge]
+
+    def combine(self, dist_sum, bridge_length):
+        """NON PUBLIC.
+        Average shortest path length, from the sums of the distances from
+        the nodes of the block graph and the lengths of the bridges.
+        """
+        total = np.sum(self.bridge_pairs * bridge_length /
+                       (self.bridge_size - 1))
+        total += np.sum(self.multiplicity * dist_sum / (self.size - 1))
+        return total / self.n
+
+    def average_SPL(self, dist_weight=False, backend='scipy',
+                    chunk_size=None):
+        """NON PUBLIC.
+        Average shortest path length counted in hops or, if dist_weight is
+        True, with the lengths of the edges.
+        """
+        if dist_weight:
+            weights = self.adj_length
+            bridge_length = self.bridge_length
         else:
-            list_branches[key] = [i]
+            weights = None
+            bridge_length = 1.
+        dist_sum = _distance_sums(self.indptr, self.adj, weights,
+                                  multiplicity=self.multiplicity,
+                                  backend=backend, chunk_size=chunk_size)[0]
+        return self.combine(dist_sum, bridge_length)
+
+    def brandes(self, n_workers=1):
+        """NON PUBLIC.
+        Betweenness centrality of the nodes, normalized as in Networkx by
+        1 / ((n-1)(n-2)), and average shortest path length counted in hops,
+        from the Brandes algorithm on the block graph computed by n_workers
+        processes.
+        """
+        nb_vertices = len(self.nodes)
+        if n_workers > 1 and nb_vertices > 2:
+            partial, dist_sum, _ = _parallel_brandes(
+                self.indptr, self.adj, n_workers, self.multiplicity)
+        else:
+            partial, dist_sum, _ = _brandes_sources(
+                self.indptr.tolist(), self.adj.tolist(),
+                range(nb_vertices), self.multiplicity.tolist())
+
+        betweenness = self.cut + np.bincount(self.nodes, weights=partial,
+                                             minlength=self.n)
+        if self.n > 2:
+            betweenness *= 1.0 / ((self.n - 1) * (self.n - 2))
+        else:
+            betweenness[:] = 0.
+
+        return betweenness, self.combine(dist_sum, 1.)
+
+
+def _brandes_source(s, indptr, adj, sigma, dist, delta, multiplicity):
+    """NON PUBLIC.
+    Single source step of the Brandes algorithm on an unweighted graph
+    given by its CSR adjacency as lists. Each node w stands for
+    multiplicity[w] targets (1 for all the nodes in a plain graph).
+
+    On return, dist contains the distances from s and delta the
+    dependencies of s on each node, for the nodes reached from s; the
+    nodes are returned in the order of their distance to s. The lists
+    sigma, dist and delta must be 0, -1 and 0 for all the nodes when the
+    function is called: they must be reset by the caller for the returned
+    nodes.
+    """
+    # Breadth first search counting the shortest paths
+    stack = [s]
+    sigma[s] = 1
+    dist[s] = 0
+    k = 0
+    while k < len(stack):
+        v = stack[k]
+        k += 1
+        dv = dist[v] + 1
+        for w in adj[indptr[v]:indptr[v + 1]]:
+            if dist[w] < 0:
+                dist[w] = dv
+                stack.append(w)
+            if dist[w] == dv:
+                sigma[w] += sigma[v]
+    # Accumulation of the dependencies in reverse order
+    for w in reversed(stack):
+        coeff = (multiplicity[w] + delta[w]) / sigma[w]
+        dw = dist[w] - 1
+        for v in adj[indptr[w]:indptr[w + 1]]:
+            if dist[v] == dw:
+                delta[v] += sigma[v] * coeff
+
+    return stack
+
+
+def _brandes_sources(indptr, adj, sources, multiplicity=None):
+    """NON PUBLIC.
+    Brandes algorithm restricted to the given sources, on an unweighted
+    graph given by its CSR adjacency as lists.
+
+    Each shortest path between two nodes is counted as many times as the
+    product of their multiplicities (list, 1 for all the nodes by
+    default).
+
+    Returns the (not normalized) sum of the dependencies of the sources on
+    each node, and the sum of the shortest path lengths from each source
+    (weighted by the multiplicity of the targets) and the number of nodes
+    it reaches (including it).
+    """
+    n = len(indptr) - 1
+    if multiplicity is None:
+        multiplicity = [1.0] * n
+    betweenness = [0.0] * n
+    sigma = [0] * n
+    dist = [-1] * n
+    delta = [0.0] * n
+    dist_sum = np.zeros(len(sources))
+    reached = np.zeros(len(sources), dtype=np.int64)
+
+    for i, s in enumerate(sources):
+        stack = _brandes_source(s, indptr, adj, sigma, dist, delta,
+                                multiplicity)
+        total = 0
+        weight = multiplicity[s]
+        for w in stack:
+            total += multiplicity[w] * dist[w]
+            if w != s:
+                betweenness[w] += weight * delta[w]
+            sigma[w] = 0
+            dist[w] = -1
+            delta[w] = 0.0
+        dist_sum[i] = total
+        reached[i] = len(stack)
+
+    return np.array(betweenness), dist_sum, reached
+
+
+# CSR adjacency and multiplicities, as lists, of the graph whose
+# betweenness is computed by a worker process of _parallel_brandes
+_worker_csr = None
+
+
+def _init_brandes_worker(names, sizes, dtypes):
+    """NON PUBLIC.
+    Initializer of the worker processes of _parallel_brandes: the CSR
+    adjacency and the multiplicities are read once from the shared memory
+    blocks.
+    """
+    global _worker_csr
+    arrays = []
+    for name, size, dtype in zip(names, sizes, dtypes):
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            arrays.append(np.ndarray(size, dtype=dtype,
+                                     buffer=block.buf).tolist())
+        finally:
+            block.close()
+    _worker_csr = arrays
+
+
+def _brandes_worker(sources):
+    """NON PUBLIC.
+    Task of the worker processes of _parallel_brandes.
+    """
+    indptr, adj, multiplicity = _worker_csr
+    return _brandes_sources(indptr, adj, sources, multiplicity)
+
 
-    # Loop over the branches with same extremitis and split them when required
-    simpl_edges = []
+def _parallel_brandes(indptr, adj, n_workers, multiplicity=None):
+    """NON PUBLIC.
+    Brandes algorithm with the sources split between n_workers processes.
 
-    for key in list_branches:
-        nbb = len(list_branches[key])
-        # We test first if this is a loop (same start and end point)
-        if key[0] == key[1]:
-            isloop = True
+    The CSR adjacency and the multiplicities are copied once into shared
+    memory blocks, read by each worker when it starts, so that only the
+    lists of sources and the partial results are sent between the
+    processes. The sources are interleaved between the tasks to balance
+    the sizes of the searches.
+    Returns the same values as _brandes_sources for all the sources.
+    """
+    n = len(indptr) - 1
+    if multiplicity is None:
+        multiplicity = np.ones(n)
+    arrays = [np.asarray(indptr, dtype=np.int64),
+              np.asarray(adj, dtype=np.int64),
+              np.asarray(multiplicity, dtype=np.float64)]
+    blocks = []
+    try:
+        for array in arrays:
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.size, dtype=array.dtype,
+                       buffer=block.buf)[:] = array
+        nb_tasks = min(n, 4 * n_workers)
+        tasks = [list(range(t, n, nb_tasks)) for t in range(nb_tasks)]
+        with ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_init_brandes_worker,
+                initargs=([block.name for block in blocks],
+                          [array.size for array in arrays],
+                          [array.dtype.str for array in arrays])) \
+                as executor:
+            results = list(executor.map(_brandes_worker, tasks))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    betweenness = np.zeros(n)
+    dist_sum = np.zeros(n)
+    reached = np.zeros(n, dtype=np.int64)
+    for sources, res in zip(tasks, results):
+        betweenness += res[0]
+        dist_sum[sources] = res[1]
+        reached[sources] = res[2]
+
+    return betweenness, dist_sum, reached
+
+
+def _sampled_cpd(indptr, adj, k=None, error=None, confidence=0.95,
+                 rng=None, nb_candidates=32, nb_pilot=16):
+    """NON PUBLIC.
+    Central point dominance estimated from the Brandes dependencies of a
+    random sample of sources (pivots), drawn without replacement.
+
+    With B(v) the sum over the sources s of the dependencies d_s(v) and
+    D_s the sum of the dependencies of s, the central point dominance is
+    sum_s (n d_s(v*) - D_s) / ((n-1)^2 (n-2)), v* being the node of largest
+    betweenness. For a fixed v*, it is estimated by n times the mean of
+    the terms of the sampled sources, with a normal confidence interval
+    (including the finite population correction). v* is chosen among
+    nb_candidates nodes of largest betweenness in a pilot sample of
+    nb_pilot sources, as the candidate of largest estimated betweenness.
+
+    Either k sources are sampled, or, if error is given, sources are added
+    until the half width of the confidence interval is below error. When
+    all the sources are used, the exact value is returned.
+
+    Returns:
+    --------
+       - cpd : estimated central point dominance
+       - half_width : half width of the confidence interval
+       - nb_sources : number of sampled sources
+    """
+    n = len(indptr) - 1
+    if rng is None:
+        rng = np.random.default_rng()
+    z = st.norm.ppf(0.5 + confidence / 2.)
+    if k is None:
+        k = n
+    k = min(k, n)
+
+    indptr = indptr.tolist()
+    adj = adj.tolist()
+    sigma = [0] * n
+    dist = [-1] * n
+    delta = [0.0] * n
+    ones = [1.0] * n
+    order = rng.permutation(n).tolist()
+
+    def dependencies(s):
+        # Dependencies of s on the nodes it reaches, the lists are reset
+        stack = _brandes_source(s, indptr, adj, sigma, dist, delta, ones)
+        values = [delta[w] for w in stack]
+        for w in stack:
+            sigma[w] = 0
+            dist[w] = -1
+            delta[w] = 0.0
+        values[0] = 0.0
+        return np.array(stack), np.array(values)
+
+    # Candidates for the node of largest betweenness
+    pilot = np.zeros(n)
+    for s in order[:min(nb_pilot, k)]:
+        nodes, values = dependencies(s)
+        pilot[nodes] += values
+    candidates = np.argsort(-pilot, kind='stable')[:nb_candidates]
+    position = np.full(n, -1, dtype=np.int64)
+    position[candidates] = np.arange(len(candidates))
+
+    # Dependencies of the sampled sources on the candidates, and sums of
+    # their dependencies
+    betweenness = np.zeros(n)
+    dep = []
+    dep_sum = []
+
+    def estimate():
+        # Estimate and half width of the interval from the sampled sources
+        m = len(dep)
+        dep_array = np.array(dep)
+        best = np.argmax(np.sum(dep_array, axis=0))
+        terms = n * (n * dep_array[:, best] - np.array(dep_sum)) / \
+            ((n - 1) ** 2 * (n - 2))
+        half_width = 0.
+        if m > 1:
+            half_width = z * np.std(terms, ddof=1) / np.sqrt(m) * \
+                np.sqrt((n - m) / (n - 1))
+        return np.mean(terms), half_width
+
+    m = 0
+    check = 32
+    while m < k:
+        nodes, values = dependencies(order[m])
+        betweenness[nodes] += values
+        inside = position[nodes] >= 0
+        row = np.zeros(len(candidates))
+        row[position[nodes[inside]]] = values[inside]
+        dep.append(row)
+        dep_sum.append(np.sum(values))
+        m += 1
+        if error is not None and m == check:
+            if estimate()[1] <= error:
+                break
+            check *= 2
+
+    if m == n:
+        # All the sources are used: exact betweenness
+        cpd = _central_point_dominance(betweenness /
+                                       ((n - 1) * (n - 2)))
+        return cpd, 0., m
+
+    cpd, half_width = estimate()
+    return cpd, half_width, m
+
+
+def _central_point_dominance(bet_cen):
+    """NON PUBLIC.
+    Central point dominance from the betweenness centrality of the nodes.
+    """
+    return np.sum(np.max(bet_cen) - bet_cen) / (len(bet_cen) - 1)
+
+
+def _average_SPL(dist_sum, reached):
+    """NON PUBLIC.
+    Average shortest path length from the sums of the distances from each
+    node and the numbers of nodes they reach.
+
+    The spl of a component is the sum of the distances divided by
+    n_c * (n_c - 1). Weighting it by n_c amounts to dividing the distances
+    from each source by the size of its component minus one.
+    """
+    valid = reached > 1
+    return np.sum(dist_sum[valid] / (reached[valid] - 1)) / len(dist_sum)
+
+
+def _sampled_average_SPL(indptr, adj, distance_sums, k, rng):
+    """NON PUBLIC.
+    Average shortest path length estimated from the distances of a sample
+    of sources, drawn without replacement.
+
+    The nodes are split into strata according to the size of their
+    connected component (floor of its log2), so that the weighting of the
+    components by their number of nodes is preserved. The k sources are
+    allocated proportionally to the number of nodes of each stratum (at
+    least 2 per stratum when possible), and the average is the weighted
+    mean of the stratum means of sum_dist(s) / (n_c - 1), with its
+    standard error including the finite population correction. When all
+    the nodes are sampled, the exact value is returned with an error of 0.
+
+    distance_sums is a function returning the sums of the distances and
+    the numbers of reached nodes of an array of sources.
+
+    Returns:
+    --------
+    the estimate, its standard error and the number of sources used
+    """
+    n = len(indptr) - 1
+    if n == 0:
+        return 0., 0., 0
+    if k >= n:
+        return _average_SPL(*distance_sums()), 0., n
+
+    comp = _connected_components(indptr, adj)[1]
+    size = np.bincount(comp)[comp]
+    strata = np.floor(np.log2(size)).astype(np.int64)
+    population = np.bincount(strata)
+    nonempty = np.flatnonzero(population)
+    population = population[nonempty]
+    alloc = np.maximum(np.minimum(2, population),
+                       np.round(k * population / n).astype(np.int64))
+    alloc = np.minimum(alloc, population)
+
+    # Sampling without replacement within each stratum
+    sources = []
+    for h, nb in zip(nonempty, alloc):
+        sources.append(rng.choice(np.flatnonzero(strata == h), nb,
+                                  replace=False))
+    sources = np.concatenate(sources)
+    dist_sum, reached = distance_sums(sources)
+
+    terms = np.zeros(len(sources))
+    valid = reached > 1
+    terms[valid] = dist_sum[valid] / (reached[valid] - 1)
+
+    estimate = 0.
+    variance = 0.
+    start = 0
+    for pop, nb in zip(population, alloc):
+        stratum = terms[start:start + nb]
+        start += nb
+        estimate += pop * stratum.mean()
+        if nb > 1:
+            variance += (pop ** 2 * (1 - nb / pop)
+                         * stratum.var(ddof=1) / nb)
+
+    return float(estimate / n), float(np.sqrt(variance) / n), len(sources)
+
+
+def _distance_sums(indptr, adj, weights=None, sources=None,
+                   multiplicity=None, backend='scipy', chunk_size=None):
+    """NON PUBLIC.
+    Sums of the shortest path lengths from the sources computed with the
+    given backend, 'scipy' (_csgraph_distance_sums) or 'python'
+    (_csr_distance_sums).
+    """
+    if backend == 'scipy':
+        return _csgraph_distance_sums(indptr, adj, weights, sources,
+                                      multiplicity, chunk_size)
+    if backend == 'python':
+        return _csr_distance_sums(indptr, adj, weights, sources,
+                                  multiplicity)
+    raise ValueError("backend must be 'scipy' or 'python'")
+
+
+def _csr_distance_sums(indptr, adj, weights=None, sources=None,
+                       multiplicity=None):
+    """NON PUBLIC.
+    Sum of the shortest path lengths from each node to all the others and
+    number of nodes reached (including the source) in a graph given by its
+    CSR adjacency. Hops are counted if weights is None, otherwise the
+    weights of the adjacency entries are used (Dijkstra algorithm).
+    If sources is given, only the paths from these nodes are computed.
+    If multiplicity is given, the length of the path to each node is
+    counted multiplicity times.
+    """
+    n = len(indptr) - 1
+    if sources is None:
+        sources = np.arange(n)
+    indptr = indptr.tolist()
+    adj = adj.tolist()
+    if weights is not None:
+        weights = weights.tolist()
+    if multiplicity is None:
+        multiplicity = [1] * n
+    else:
+        multiplicity = multiplicity.tolist()
+    dist_sum = np.zeros(len(sources))
+    reached = np.zeros(len(sources), dtype=np.int64)
+    dist = [-1] * n
+
+    for i, s in enumerate(sources.tolist()):
+        if weights is None:
+            # Breadth first search
+            visited = [s]
+            dist[s] = 0
+            k = 0
+            while k < len(visited):
+                v = visited[k]
+                k += 1
+                dv = dist[v] + 1
+                for w in adj[indptr[v]:indptr[v + 1]]:
+                    if dist[w] < 0:
+                        dist[w] = dv
+                        visited.append(w)
         else:
-            isloop = False
-
-        # Simple case - no cycle but potential loop
-        if (nbb == 1):
-            tmp = branches[list_branches[key][0]]
-            if isloop:  # In the loop case, we need to split by 3 the branch
-                tmp1, tmp2, tmp3 = _split3(tmp)
-                simpl_edges.append(tmp1)
-                if (len(tmp2) > 0):
-                    simpl_edges.append(tmp2)
-                    if (len(tmp3) > 0):
-                        simpl_edges.append(tmp3)
-            else:
-                simpl_edges.append(tmp)
+            visited = _dijkstra(s, indptr, adj, weights, dist)
+        dist_sum[i] = sum(multiplicity[v] * dist[v] for v in visited)
+        reached[i] = len(visited)
+        for v in visited:
+            dist[v] = -1
+
+    return dist_sum, reached
+
 
-        # Several branches with same extremities - cycles
+def _csgraph_distance_sums(indptr, adj, weights=None, sources=None,
+                           multiplicity=None, chunk_size=None):
+    """NON PUBLIC.
+    Same as _csr_distance_sums, computed with scipy.sparse.csgraph.
+
+    The distances from chunk_size sources are computed at once and reduced
+    to their sums, so that the full distance matrix is never stored.
+    """
+    n = len(indptr) - 1
+    if sources is None:
+        sources = np.arange(n)
+    if weights is None:
+        matrix = _csr_matrix(indptr, adj)
+    else:
+        # Edges of length 0 would be considered as missing by csgraph,
+        # they are given the smallest positive float, which does not
+        # change the sums of lengths
+        matrix = _csr_matrix(indptr, adj, np.where(
+            weights > 0, weights, np.nextafter(0., 1.)))
+    if chunk_size is None:
+        chunk_size = max(2 ** 23 // max(n, 1), 1)
+
+    dist_sum = np.zeros(len(sources))
+    reached = np.zeros(len(sources), dtype=np.int64)
+    for start in range(0, len(sources), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        dist = csgraph.shortest_path(matrix, method='D', directed=False,
+                                     unweighted=weights is None,
+                                     indices=sources[chunk])
+        finite = np.isfinite(dist)
+        dist[~finite] = 0.
+        if multiplicity is None:
+            dist_sum[chunk] = np.sum(dist, axis=1)
         else:
-            for i in range(nbb):
-                tmp = branches[list_branches[key][i]]
-                if isloop:  # Case with multiple loops
-                    tmp1, tmp2, tmp3 = _split3(tmp)
-                    simpl_edges.append(tmp1)
-                    if (len(tmp2) > 0):
-                        simpl_edges.append(tmp2)
-                        if (len(tmp3) > 0):
-                            simpl_edges.append(tmp3)
-                else:
-                    # A regular branch belonging to a cycle, need to split in 2
-                    tmp1, tmp2 = _split2(tmp)
-                    simpl_edges.append(tmp1)
-                    if (len(tmp2) > 0):
-                        simpl_edges.append(tmp2)
+            dist_sum[chunk] = dist @ multiplicity
+        reached[chunk] = np.count_nonzero(finite, axis=1)
 
-    return simpl_edges
+    return dist_sum, reached
+
+
+def _dijkstra(s, indptr, adj, weights, dist):
+    """NON PUBLIC.
+    Dijkstra algorithm from the source s. The distances are written in the
+    list dist (where unvisited nodes are negative) and the list of the
+    visited nodes is returned in the order of increasing distances.
+    """
+    visited = []
+    seen = {s: 0.0}
+    heap = [(0.0, s)]
+    while heap:
+        d, v = heapq.heappop(heap)
+        if dist[v] >= 0:
+            continue
+        dist[v] = d
+        visited.append(v)
+        for pos in range(indptr[v], indptr[v + 1]):
+            w = adj[pos]
+            dw = d + weights[pos]
+            if dist[w] < 0 and (w not in seen or dw < seen[w]):
+                seen[w] = dw
+                heapq.heappush(heap, (dw, w))
+
+    return visited
+
+
+# ******Functions used for branch extraction
+#     A branch is defined between two nodes of degree < > 2
+
+
+def _branch_targets(indptr, adj, labels):
+    """NON PUBLIC.
+    Start nodes of the branches: the nodes of degree different from 2,
+    visited component by component. A component only composed of nodes of
+    degree 2 (an isolated loop) starts from its last node.
+
+    The nodes of a component are visited in the order of its Networkx
+    subgraph: the order of the graph, except for the components having
+    less than half of the nodes of the graph (see _subgraph_order).
+    """
+    deg = np.diff(indptr)
+    if len(deg) == 0:
+        return np.zeros(0, dtype=np.int64)
+    nb_comp, comp = _connected_components(indptr, adj)
+    nodes_by_comp = np.argsort(comp, kind='stable')
+    comp_size = np.bincount(comp, minlength=nb_comp)
+    comp_end = np.cumsum(comp_size)
+    small = np.flatnonzero(2 * comp_size < len(deg))
+    if len(small):
+        _subgraph_order(indptr, adj, labels, nodes_by_comp,
+                        comp_end - comp_size, comp_size, small)
+
+    # Components without any node of degree != 2
+    ends = deg[nodes_by_comp] != 2
+    has_end = np.bincount(comp[nodes_by_comp], weights=ends,
+                          minlength=nb_comp) > 0
+    loops = comp_end[~has_end] - 1
+    ends[loops] = True
+
+    return nodes_by_comp[ends]
+
+
+def _subgraph_order(indptr, adj, labels, nodes_by_comp, comp_start,
+                    comp_size, components):
+    """NON PUBLIC.
+    Reorders in place the nodes of the given components in nodes_by_comp
+    as Networkx iterates the subgraph of a connected component having less
+    than half of the nodes of the graph.
+
+    Networkx fills the set of the names of the component by a breadth
+    first search from its first node, then adds them one by one to the
+    set of the subgraph, which gives the order of the subgraph: it depends
+    on the hash of the names and on the order of their insertion.
+    """
+    indptr = indptr.tolist()
+    adj = adj.tolist()
+    names = labels.tolist()
+    for c in components.tolist():
+        start = int(comp_start[c])
+        source = int(nodes_by_comp[start])
+        # Breadth first search of networkx.connected_components
+        seen = {names[source]}
+        index = {names[source]: source}
+        level = [source]
+        while level:
+            next_level = []
+            for v in level:
+                for w in adj[indptr[v]:indptr[v + 1]]:
+                    if names[w] not in seen:
+                        seen.add(names[w])
+                        index[names[w]] = w
+                        next_level.append(w)
+            level = next_level
+        # set(iter(seen)) inserts the names one by one, as Networkx does,
+        # while set(seen) would copy the table of seen
+        nodes_by_comp[start:start + int(comp_size[c])] = [
+            index[name] for name in set(iter(seen))]
+
+
+def _extract_branches(indptr, adj, adj_edge, targets, visited=None):
+    """NON PUBLIC.
+    Follows all the branches of a graph given by its CSR adjacency, in
+    O(V+E): each edge is walked once and marked as visited, so that a
+    branch is not added twice when reached from its other extremity.
+
+    Parameters:
+    -----------
+       - targets : start nodes of the branches, in order
+       - visited : optional boolean array of the edges that must not be
+            walked (edges already belonging to known branches)
+
+    Returns:
+    --------
+       - br_nodes, br_edges : flat arrays of node and edge indices
+       - br_ptr : offsets of the branches in br_nodes
+    """
+    deg = np.diff(indptr).tolist()
+    indptr = indptr.tolist()
+    adj = adj.tolist()
+    adj_edge = adj_edge.tolist()
+    if visited is None:
+        visited = [False] * (max(adj_edge) + 1 if adj_edge else 0)
+    else:
+        visited = visited.tolist()
+
+    br_nodes = []
+    br_edges = []
+    br_ptr = [0]
+
+    def walk(start, pos):
+        # Follows the branch leaving start by the adjacency entry pos
+        e = adj_edge[pos]
+        br_nodes.append(start)
+        while True:
+            visited[e] = True
+            node = adj[pos]
+            br_nodes.append(node)
+            br_edges.append(e)
+            # Stops at a node of degree != 2 or when the loop is closed
+            if deg[node] != 2 or node == start:
+                break
+            # Otherwise leaves the node by its other edge
+            pos = indptr[node]
+            if adj_edge[pos] == e:
+                pos += 1
+            e = adj_edge[pos]
+            if visited[e]:
+                break
+        br_ptr.append(len(br_nodes))
+
+    for start in targets.tolist():
+        for pos in range(indptr[start], indptr[start + 1]):
+            if not visited[adj_edge[pos]]:
+                walk(start, pos)
+
+    return (np.array(br_nodes, dtype=np.int64),
+            np.array(br_edges, dtype=np.int64),
+            np.array(br_ptr, dtype=np.int64))
+
+
+def _measure_branches(length, coords, br_nodes, br_edges, br_ptr):
+    """NON PUBLIC.
+    Lengths and tortuosities of branches given as flat arrays, from the
+    lengths of the edges and the coordinates of the nodes.
+    """
+    # Compute the branch lengths from the lengths of their edges
+    br_lengths = _segment_sums(length[br_edges], _edge_ptr(br_ptr))
+
+    # Computes the distance between extremities, dist = 0 when
+    # positions are not defined or when we have a loop
+    start = coords[br_nodes[br_ptr[:-1]]]
+    end = coords[br_nodes[br_ptr[1:] - 1]]
+    dist = np.sqrt(np.sum((start - end) ** 2, axis=1))
+    looping = dist == 0
+
+    # Tortuosity is infinite on a looping branch, it is set to NAN to
+    # avoid further errors
+    br_tort = np.full(len(br_lengths), np.nan)
+    br_tort[~looping] = br_lengths[~looping] / dist[~looping]
+
+    return br_lengths, br_tort
+
+
+def _simple_edges(br_nodes, br_edges, br_ptr, branch_ids, length):
+    """NON PUBLIC.
+    Simple edges of a subset of the branches, see KGraph._simplify_graph.
+
+    Each branch gives one simple edge joining its extremities, except to
+    preserve the topology:
+       - a loop (branch starting and ending at the same node) is split in 3
+       - branches having the same extremities (cycles) are split in 2
+    The simple edges are grouped by extremities, in the order of the first
+    branch of each group, and follow the order of the branches in a group.
+
+    Returns:
+    --------
+       - simpl_edges : (S,2) array of the extremities of the simple edges
+       - simpl_lengths : lengths of the simple edges, sums of the lengths
+            of the edges they cover
+       - simpl_origin : index of the branch of each simple edge
+       - simpl_span : (S,2) array, simple edge k covers the edges
+            simpl_span[k, 0] to simpl_span[k, 1] - 1 of its branch
+    """
+    start = br_ptr[branch_ids]
+    nb_nodes = br_ptr[branch_ids + 1] - start
+    first = br_nodes[start]
+    last = br_nodes[start + nb_nodes - 1]
+
+    # Groups of branches with the same extremities
+    _, group_first, group = np.unique(first * (np.max(br_nodes, initial=0) +
+                                               1) + last,
+                                      return_index=True, return_inverse=True)
+    group = group.ravel()
+    cycle = np.bincount(group)[group] > 1
+    loop = first == last
+
+    # Positions, along each branch, of the extremities of its simple edges
+    # (-1 when there are less than 3 simple edges)
+    cuts = np.full((len(branch_ids), 4), -1, dtype=np.int64)
+    cuts[:, 0] = 0
+    cuts[:, 1] = nb_nodes - 1
+    half = cycle & ~loop & (nb_nodes > 2)
+    cuts[half, 1] = nb_nodes[half] // 2
+    cuts[half, 2] = nb_nodes[half] - 1
+    third = loop & (nb_nodes == 3)
+    cuts[third, 1] = 1
+    cuts[third, 2] = 2
+    third = loop & (nb_nodes > 3)
+    cuts[third, 1] = nb_nodes[third] // 3
+    cuts[third, 2] = 2 * (nb_nodes[third] // 3)
+    cuts[third, 3] = nb_nodes[third] - 1
+
+    # Simple edges, in the order of the branches
+    valid = cuts[:, 1:] >= 0
+    piece_branch = np.nonzero(valid)[0]
+    span = np.column_stack((cuts[:, :-1][valid], cuts[:, 1:][valid]))
+
+    # Their lengths, as the simple edges of a branch cover all its edges
+    # once and in order
+    nb_edges = nb_nodes - 1
+    edge_start = np.cumsum(nb_edges) - nb_edges
+    edges = br_edges[np.repeat(start - branch_ids - edge_start, nb_edges) +
+                     np.arange(np.sum(nb_edges))]
+    simpl_lengths = _segment_sums(
+        length[edges], np.append(edge_start[piece_branch] + span[:, 0],
+                                 np.sum(nb_edges)))
+
+    # Grouping by extremities
+    order = np.argsort(group_first[group[piece_branch]], kind='stable')
+    piece_branch = piece_branch[order]
+    span = span[order]
+    simpl_edges = np.column_stack(
+        (br_nodes[start[piece_branch] + span[:, 0]],
+         br_nodes[start[piece_branch] + span[:, 1]]))
+
+    return (simpl_edges.reshape(-1, 2), simpl_lengths[order],
+            branch_ids[piece_branch], span.reshape(-1, 2))
+
+
+def _component_structures(edges, length, coords, targets):
+    """NON PUBLIC.
+    Branches, branch measures and simple edges of a group of connected
+    components, given by its (E,2) edges with local node indices, the
+    lengths of the edges, the coordinates of the nodes and the start nodes
+    of the branches.
+    Run by the worker processes of KGraph._parallel_structures.
+    """
+    indptr, adj, adj_edge = _csr_adjacency(len(coords), edges)
+    br_nodes, br_edges, br_ptr = _extract_branches(indptr, adj, adj_edge,
+                                                   targets)
+    br_lengths, br_tort = _measure_branches(length, coords, br_nodes,
+                                            br_edges, br_ptr)
+    simpl_edges, simpl_lengths, simpl_origin, simpl_span = _simple_edges(
+        br_nodes, br_edges, br_ptr, np.arange(len(br_ptr) - 1), length)
+
+    return (br_nodes, br_edges, br_ptr, br_lengths, br_tort, simpl_edges,
+            simpl_lengths, simpl_origin, simpl_span)
+
+
+def _n_workers(n_jobs):
+    """NON PUBLIC.
+    Number of worker processes for n_jobs: None or 1 means serial, a
+    negative value means all the processors.
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() or 1, 1)
+    return max(int(n_jobs), 1)
+
+
+def _edge_ptr(br_ptr):
+    """NON PUBLIC.
+    Offsets of the branches in the flat array of branch edges.
+    """
+    return br_ptr - np.arange(len(br_ptr))
+
+
+def _segment_sums(values, ptr):
+    """NON PUBLIC.
+    Sums of the consecutive segments values[ptr[i]:ptr[i+1]].
+    """
+    sums = np.zeros(len(ptr) - 1)
+    nonempty = ptr[1:] > ptr[:-1]
+    if np.any(nonempty):
+        sums[nonempty] = np.add.reduceat(values, ptr[:-1][nonempty])
+    return sums
@@ -0,0 +1,265 @@
+#    Copyright (C) 2018-2024 by
+#    Philippe Renard <philippe.renard@unine.ch>
+#    Pauline Collon <pauline.collon@univ-lorraine.fr>
+#    All rights reserved.
+#    MIT license.
+#
+"""
+Karstnet Batch
+==============
+
+Karstnet is a Python package for the analysis of karstic networks.
+
+The Batch module imports and characterizes many karstic networks (node
+and link .dat files, Gocad plines, Therion SQL exports) in a pool of
+processes, each network being processed independently.
+
+"""
+
+# ----External librairies importations
+import multiprocessing
+import os
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# ----Internal module dependancies
+from karstnet.base import _METRICS, _n_workers
+from karstnet.import_fc import from_nodlink_dat, from_pline, \
+    from_therion_sql
+
+
+# *************************************************************
+# -------------------Public Functions:-------------------------
+# *************************************************************
+
+def iter_characterize(sources, metrics=None, n_jobs=-1, memory_limit=None,
+                      max_tasks_per_worker=1):
+    """
+    Imports and characterizes karstic networks in a pool of processes,
+    yielding the result of each network as soon as it is available.
+
+    Each result is a dictionnary containing the index of the source in
+    sources ('index'), its name ('source'), whether it succeeded ('ok'),
+    the error message if it failed ('error'), the time spent to import it
+    and to compute the metrics in seconds ('import_time' and
+    'metrics_time') and the metrics returned by characterize_graph (NaN
+    if the network could not be characterized). A failure does not stop
+    the other networks.
+
+    Parameters
+    ----------
+    sources : list
+        The networks to characterize. Each one is given by the name of a
+        file: a Gocad pline (.pl), a Therion SQL export (.sql) or one of
+        the files (or their base name) of a pair basename_nodes.dat /
+        basename_links.dat. A function without argument returning a KGraph
+        can also be given, it must be picklable.
+
+    metrics : list
+        Names of the metrics computed by characterize_graph, by default
+        all of them.
+
+    n_jobs : int
+        Number of processes, -1 (default) uses all the processors.
+
+    memory_limit : int
+        Maximum size in bytes of the memory of each process (on the
+        systems providing the resource module). A network requiring more
+        memory fails with a MemoryError.
+
+    max_tasks_per_worker : int
+        Number of networks processed by a process before it is replaced by
+        a new one, which releases its memory. 1 by default.
+
+    Yields
+    ------
+    dictionnary
+        result of a network, in the order in which they are completed
+
+    Examples
+    --------
+       >>> for result in kn.iter_characterize(["Huttes", "Monachou.pl"]):
+       ...     print(result['source'], result['ok'])
+    """
+    metrics = _METRICS if metrics is None else metrics
+    if isinstance(metrics, str):
+        metrics = [metrics]
+    tasks = [(index, source, list(metrics))
+             for index, source in enumerate(sources)]
+    if len(tasks) == 0:
+        return
+
+    nb_workers = min(_n_workers(n_jobs), len(tasks))
+    with multiprocessing.Pool(nb_workers, initializer=_init_batch_worker,
+                              initargs=(memory_limit,),
+                              maxtasksperchild=max_tasks_per_worker) as pool:
+        for result in pool.imap_unordered(_characterize_source, tasks):
+            yield result
+
+
+def characterize_batch(sources, metrics=None, n_jobs=-1, output='dicts',
+                       memory_limit=None, max_tasks_per_worker=1,
+                       callback=None):
+    """
+    Imports and characterizes karstic networks in a pool of processes.
+
+    See iter_characterize for the description of the sources and of the
+    results. The results are returned in the order of the sources, as a
+    list of dictionnaries or as a NumPy record array.
+
+    Parameters
+    ----------
+    sources : list
+        The networks to characterize (see iter_characterize)
+
+    metrics : list
+        Names of the metrics computed by characterize_graph, by default
+        all of them.
+
+    n_jobs : int
+        Number of processes, -1 (default) uses all the processors.
+
+    output : string
+        'dicts' (default) for a list of dictionnaries, 'records' for a
+        record array with the fields 'source', 'ok', 'error',
+        'import_time', 'metrics_time' and one field per metric.
+
+    memory_limit : int
+        Maximum size in bytes of the memory of each process.
+
+    max_tasks_per_worker : int
+        Number of networks processed by a process before it is replaced.
+
+    callback : function
+        Optional function called with the result of each network as soon
+        as it is completed.
+
+    Returns
+    -------
+    list or numpy.recarray
+        The results of the networks
+
+    Examples
+    --------
+       >>> results = kn.characterize_batch(["Huttes", "Sakany"],
+       ...                                 output='records')
+       >>> results['aspl'][results['ok']]
+    """
+    if output not in ('dicts', 'records'):
+        raise ValueError("output must be 'dicts' or 'records'")
+    metrics = _METRICS if metrics is None else metrics
+    if isinstance(metrics, str):
+        metrics = [metrics]
+
+    results = [None] * len(sources)
+    for result in iter_characterize(sources, metrics, n_jobs, memory_limit,
+                                    max_tasks_per_worker):
+        if callback is not None:
+            callback(result)
+        results[result['index']] = result
+
+    if output == 'dicts':
+        return results
+    return _records(results, metrics)
+
+
+# *************************************************************
+# -------------------Non Public Functions:---------------------
+# *************************************************************
+
+def _init_batch_worker(memory_limit):
+    """NON PUBLIC.
+    Initializer of the processes of iter_characterize: limits the size of
+    their memory.
+    """
+    if memory_limit is not None and resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+
+def _source_name(source):
+    """NON PUBLIC.
+    Name of a source of iter_characterize.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    return getattr(source, '__name__', repr(source))
+
+
+def _import_source(source):
+    """NON PUBLIC.
+    Imports the KGraph of a source of iter_characterize, the import
+    function being chosen from the extension of the file.
+    """
+    if callable(source):
+        return source()
+
+    name = os.fspath(source)
+    if name.endswith('.pl'):
+        kgraph = from_pline(name, verbose=False, lazy=True)
+    elif name.endswith('.sql'):
+        kgraph = from_therion_sql(name[:-4], verbose=False, lazy=True)
+    elif name.endswith('_nodes.dat') or name.endswith('_links.dat'):
+        kgraph = from_nodlink_dat(name[:-10], verbose=False, lazy=True)
+    elif os.path.exists(name + '_nodes.dat'):
+        kgraph = from_nodlink_dat(name, verbose=False, lazy=True)
+    elif os.path.exists(name + '.sql'):
+        kgraph = from_therion_sql(name, verbose=False, lazy=True)
+    else:
+        raise ValueError("Unknown format of {}".format(name))
+
+    # The import functions return None when a file cannot be read
+    if kgraph is None:
+        raise OSError("Could not import {}".format(name))
+    return kgraph
+
+
+def _characterize_source(task):
+    """NON PUBLIC.
+    Imports and characterizes one source of iter_characterize, in a worker
+    process. The errors are reported in the result.
+    """
+    index, source, metrics = task
+    result = {'index': index, 'source': _source_name(source), 'ok': False,
+              'error': '', 'import_time': np.nan, 'metrics_time': np.nan}
+    result.update({metric: np.nan for metric in metrics})
+
+    try:
+        start = time.perf_counter()
+        kgraph = _import_source(source)
+        result['import_time'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        values = kgraph.characterize_graph(metrics=metrics)
+        result['metrics_time'] = time.perf_counter() - start
+    except Exception as error:
+        result['error'] = "{}: {}".format(type(error).__name__, error)
+        return result
+
+    result.update(values)
+    result['ok'] = True
+    return result
+
+
+def _records(results, metrics):
+    """NON PUBLIC.
+    Record array of the results of characterize_batch.
+    """
+    width = max([1] + [len(result['source']) for result in results])
+    error_width = max([1] + [len(result['error']) for result in results])
+    dtype = [('source', 'U{}'.format(width)), ('ok', bool),
+             ('error', 'U{}'.format(error_width)),
+             ('import_time', np.float64), ('metrics_time', np.float64)]
+    dtype += [(metric, np.float64) for metric in metrics]
+
+    records = np.recarray(len(results), dtype=dtype)
+    for i, result in enumerate(results):
+        records[i] = tuple(result[name] for name, _ in dtype)
+    return records
@@ -16,6 +16,14 @@ in various formats.
 """
 
 # ----External librairies importations
+import csv
+import hashlib
+import io
+import os
+import re
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from urllib.request import pathname2url
 import numpy as np
 import networkx as nx
 import scipy.stats as st
@@ -25,6 +33,8 @@ import mplstereonet
 
 # ----Internal module dependancies
 from karstnet.base import *
+from karstnet.base import _n_workers
+from karstnet.profiling import _stage
 
 
 # *************************************************************
@@ -32,7 +42,8 @@ from karstnet.base import *
 # -------------------GRAPH GENERATORS--------------------------
 # *************************************************************
 
-def from_nxGraph(nxGraph, coordinates, properties={}, verbose=True):
+def from_nxGraph(nxGraph, coordinates, properties={}, verbose=True,
+                 lazy=False, n_jobs=1):
     """
     Creates a Karst graph from a Networkx graph.
 
@@ -50,6 +61,14 @@ def from_nxGraph(nxGraph, coordinates, properties={}, verbose=True):
     properties : dictionnary
         optional argument containing properties associated with the nodes
 
+    lazy : boolean
+        If True, the structures derived from the graph (branches,
+        simplified graph, ...) are computed when they are first needed
+
+    n_jobs : int
+        Number of processes used to build the branches and the simplified
+        graph, component by component (-1 for all the processors)
+
     Returns
     -------
     KGraph
@@ -62,12 +81,14 @@ def from_nxGraph(nxGraph, coordinates, properties={}, verbose=True):
     """
     # Initialization of the complete graph
     edges = nx.to_edgelist(nxGraph)
-    Kg = KGraph(edges, coordinates, properties, verbose=verbose)
+    Kg = KGraph(edges, coordinates, properties, verbose=verbose, lazy=lazy,
+                n_jobs=n_jobs)
 
     return Kg
 
 
-def from_nodlink_dat(basename, verbose=True):
+def from_nodlink_dat(basename, verbose=True, lazy=False, n_jobs=1,
+                     cache=False):
     """
     Creates the Kgraph from two ascii files (nodes, and links).
 
@@ -82,6 +103,22 @@ def from_nodlink_dat(basename, verbose=True):
 
          - basename_links.dat: the list of edges
 
+    lazy : boolean
+        If True, the structures derived from the graph (branches,
+        simplified graph, ...) are computed when they are first needed
+
+    n_jobs : int
+        Number of processes used to parse large files by chunks and to
+        build the branches and the simplified graph, component by
+        component (-1 for all the processors)
+
+    cache : boolean
+        If True, the arrays read from each file are saved in a .npy file
+        next to it (basename_nodes.dat.npy and basename_links.dat.npy),
+        which is read instead of the text file as long as the size and
+        the modification time of the text file do not change. False by
+        default: the directory of the data is not written.
+
     Returns
     -------
     KGraph
@@ -95,27 +132,30 @@ def from_nodlink_dat(basename, verbose=True):
     link_name = basename + '_links.dat'
     node_name = basename + '_nodes.dat'
 
-    # Read data files if exist - otherwise return empty graph
-    try:
-        links = np.loadtxt(link_name).astype(int) - 1
-    except OSError:
-        print("IMPORT ERROR: Could not import {}".format(link_name))
-        return
+    with _stage('read'):
+        # Read data files if exist - otherwise return empty graph
+        try:
+            links = _read_dat(link_name, n_jobs=n_jobs,
+                              cache=cache).astype(np.int64) - 1
+        except OSError:
+            print("IMPORT ERROR: Could not import {}".format(link_name))
+            return
 
-    try:
-        nodes = np.loadtxt(node_name)
-    except OSError:
-        print("IMPORT ERROR: Could not import {}".format(node_name))
-        return
-    # Create the dictionnary of coordinates
-    coord = dict(enumerate(nodes[:, :3].tolist()))
+        try:
+            nodes = _read_dat(node_name, n_jobs=n_jobs, cache=cache)
+        except OSError:
+            print("IMPORT ERROR: Could not import {}".format(node_name))
+            return
+    # The coordinates of node i are in row i of the array
+    coord = nodes[:, :3]
 
-    if len(nodes[0] > 3):
+    if nodes.shape[1] > 3:
         properties = dict(enumerate(nodes[:, 3:].tolist()))
     else:
         properties = {}
 
-    Kg = KGraph(links, coord, properties, verbose=verbose)
+    Kg = KGraph(links, coord, properties, verbose=verbose, lazy=lazy,
+                n_jobs=n_jobs)
 
     if verbose:
         print("Graph successfully created from file !\n")
@@ -125,7 +165,8 @@ def from_nodlink_dat(basename, verbose=True):
 # modif PVernant 2019/11/25
 # add a function to read form an SQL export of Therion
 
-def from_therion_sql(basename, verbose=True):
+def from_therion_sql(basename, verbose=True, lazy=False, n_jobs=1,
+                     cache=False, engine='sqlite'):
     """
     Creates the Kgraph from on SQL file exported from a Therion survey file.
 
@@ -137,6 +178,29 @@ def from_therion_sql(basename, verbose=True):
         The input file is named using the following convention:
          - basename.sql: the containing all the needed informations
 
+    lazy : boolean
+        If True, the structures derived from the graph (branches,
+        simplified graph, ...) are computed when they are first needed
+
+    n_jobs : int
+        Number of processes used to build the branches and the simplified
+        graph, component by component (-1 for all the processors)
+
+    cache : boolean
+        If True, the SQL file is converted once into a SQLite database
+        next to it (basename.sql.sqlite), which is opened directly by the
+        next imports as long as the content of the SQL file does not
+        change. Only used by the 'sqlite' engine. False by default: the
+        directory of the data is not written.
+
+    engine : string
+        'sqlite' (default) executes the SQL file with SQLite. 'stream'
+        reads the file by chunks and only parses the insert statements
+        of the STATION and SHOT tables into arrays (the SURVEY,
+        STATION_FLAG and SHOT_FLAG tables, only read by
+        from_therion_sql_enhanced, are skipped), which is several times
+        faster on large files.
+
     Returns
     -------
     KGraph
@@ -145,35 +209,51 @@ def from_therion_sql(basename, verbose=True):
     Examples
     --------
        >>> myKGraph = kn.from_therion_sql("MyKarst")
+       >>> myKGraph = kn.from_therion_sql("MyKarst", engine='stream')
     """
+    if engine not in ('sqlite', 'stream'):
+        raise ValueError("engine must be 'sqlite' or 'stream'")
 
     sql_name = basename + '.sql'
 
-    # Read data files if exist - otherwise return empty graph
-    try:
-        conn = sqlite3.connect(':memory:')
-        conn.executescript(open(sql_name).read())
+    with _stage('sql_load'):
+        # Read data files if exist - otherwise return empty graph
+        try:
+            if engine == 'stream':
+                tables = _read_therion_tables(sql_name,
+                                              tables=('STATION', 'SHOT'))
+            else:
+                conn = _therion_connection(sql_name, cache=cache)
 #    	conn.executescript(open('../data/g_huttes.sql').read())
-    except OSError:
-        print("IMPORT ERROR: Could not import {}".format(sql_name))
-        return
+        except OSError:
+            print("IMPORT ERROR: Could not import {}".format(sql_name))
+            return
+
+        if engine == 'stream':
+            station = tables['STATION']
+            nodes_th = np.column_stack([station['X'], station['Y'],
+                                        station['Z']])
+            stations_th = station['NAME'].tolist()
+            stations_id = station['ID']
+            links_th = np.column_stack([tables['SHOT']['FROM_ID'],
+                                        tables['SHOT']['TO_ID']])
+        else:
+            # Read the SQL file and extract nodes and links data
+            c = conn.cursor()
+            c.execute('select st.ID, st.NAME, FULL_NAME, X, Y, Z from \
+            STATION st left join SURVEY su on st.SURVEY_ID = su.ID;')
+            nodes_th = []
+            stations_th = []
+            stations_id = []
+            for s in c.fetchall():
+                nodes_th.append([s[3], s[4], s[5]])
+                stations_th.append(s[1])
+                stations_id.append(s[0])
 
-    # Read the SQL file and extract nodes and links data
-    c = conn.cursor()
-    c.execute('select st.ID, st.NAME, FULL_NAME, X, Y, Z from STATION\
-    st left join SURVEY su on st.SURVEY_ID = su.ID;')
-    nodes_th = []
-    stations_th = []
-    stations_id = []
-    for s in c.fetchall():
-        nodes_th.append([s[3], s[4], s[5]])
-        stations_th.append(s[1])
-        stations_id.append(s[0])
-
-    c.execute('select FROM_ID, TO_ID from SHOT;')
-    links_th = []
-    for s in c.fetchall():
-        links_th.append([s[0], s[1]])
+            c.execute('select FROM_ID, TO_ID from SHOT;')
+            links_th = []
+            for s in c.fetchall():
+                links_th.append([s[0], s[1]])
 
     # Remove the splay links
     T = [((s != '.') & (s != '-')) for s in stations_th]
@@ -182,16 +262,17 @@ def from_therion_sql(basename, verbose=True):
     links_ok = np.isin(links_th, stations_id)
     links = links_th[np.logical_and(links_ok[:, 0], links_ok[:, 1])]
 
-    # Create the dictionnary of coordinates
-    nodes = np.asarray(nodes_th)
-    coord = dict(enumerate(nodes[:, :3].tolist()))
+    # The coordinates of node i are in row i of the array
+    nodes = np.asarray(nodes_th, dtype=np.float64)
+    coord = nodes[:, :3]
 
-    if len(nodes[0] > 3):
+    if nodes.shape[1] > 3:
         properties = dict(enumerate(nodes[:, 3:].tolist()))
     else:
         properties = {}
 
-    Kg = KGraph(links, coord, properties, verbose=verbose)
+    Kg = KGraph(links, coord, properties, verbose=verbose, lazy=lazy,
+                n_jobs=n_jobs)
 
     if verbose:
         print("Graph successfully created from file !\n")
@@ -201,7 +282,7 @@ def from_therion_sql(basename, verbose=True):
 # --------------------------------
 
 
-def from_pline(filename, verbose=True):
+def from_pline(filename, verbose=True, lazy=False, n_jobs=1):
     """
     Creates a KGraph from a Pline (Gocad ascii object)
 
@@ -214,6 +295,14 @@ def from_pline(filename, verbose=True):
     filename : string
         The name of the GOCAD Pline ASCII file.
 
+    lazy : boolean
+        If True, the structures derived from the graph (branches,
+        simplified graph, ...) are computed when they are first needed
+
+    n_jobs : int
+        Number of processes used to build the branches and the simplified
+        graph, component by component (-1 for all the processors)
+
     Returns
     -------
     KGraph
@@ -232,66 +321,43 @@ def from_pline(filename, verbose=True):
         print("IMPORT ERROR: Could not import {}".format(filename))
         return
 
-    #  To store 3D location
-    coord = {}
-    # To store properties
-    prop = {}
-    # To store list of edges (each edge is a tuple)
-    edges = []
-
-    # Counter of nodes: in pl format, nodes are duplicated when changing
-    # iline (eq. for branch). This is symbolized by the word ATOM instead of
-    # VRTX and a segment uses the atom index instead those of the vrtx.
-    # To track correspondance between VRTX and ATOM and avoids duplicates,
-    # we use a counter of nodes, a dictionnary of nodes and one of atoms
-    cpt_nodes = 0
-    dico_nodes = {}  # make the correspondance betwen vrtx index and node index
-    dico_atom = {}  # to memorize the atom index and use it to write segments
-
-    for line in f_pline:
-        if 'VRTX' in line:
-            cpt_nodes += 1
-            # cle,num,x,y,z=ligne.split()
-
-            # because we do not pressupose the number of properties
-            data = line.rstrip().split(" ")
-
-            dico_nodes[int(data[1])] = cpt_nodes  # vrtx index vs. node index
-
-            # store 3D location (relating to node index)
-            coord[cpt_nodes] = (float(data[2]), float(data[3]), float(data[4]))
-            # store properties if exist (relating to node index)
-            prop[cpt_nodes] = dict(enumerate(list(np.float_(data[5:]))))
-        if 'ATOM ' in line:
-            cle, num, ref = line.split()
-            # Atom must link to node index, not the index of the VTRX
-            dico_atom[int(num)] = dico_nodes[int(ref)]
-        if 'SEG' in line:
-            cle, refi, refj = line.split()
-            i = int(refi)
-            j = int(refj)
-            # Treatment of i:
-            if i in dico_atom:
-                # Replace atom number by the corresponding node index
-                i = dico_atom[i]
-            else:
-                # Replace vertex number by the corresponding node index
-                i = dico_nodes[i]
-            # Treatment of j:
-            if j in dico_atom:
-                # Replace atom number by the corresponding node index
-                j = dico_atom[j]
-            else:
-                # Replace vertex number by the corresponding node index
-                j = dico_nodes[j]
-            # Add the edge with the correct node indices
-            edges.append((i, j))
+    with _stage('read'), f_pline:
+        # In pl format, nodes are duplicated when changing iline (eq. for
+        # branch). This is symbolized by the word ATOM instead of VRTX and
+        # a segment uses the atom index instead of the one of the vrtx.
+        # The vertices are numbered from 1 in the order of the file, and
+        # the segments are converted to these node numbers.
+        vrtx_ids, values, nb_values, atoms, segs = _read_pline(f_pline)
+
+        # Node number of each vrtx and atom index
+        node_of_id = np.zeros(max(vrtx_ids.max(initial=0),
+                                  atoms.max(initial=0),
+                                  segs.max(initial=0)) + 1, dtype=np.int64)
+        node_of_id[vrtx_ids] = np.arange(1, len(vrtx_ids) + 1)
+        # Atoms must link to node index, not the index of the VTRX
+        node_of_id[atoms[:, 0]] = node_of_id[atoms[:, 1]]
+        edges = node_of_id[segs]
+        if np.any(edges == 0):
+            raise ValueError("Segment between unknown vertices in "
+                             "{}".format(filename))
+
+        # Coordinates of the nodes, numbered from 1, properties if exist
+        coord = dict(zip(range(1, len(vrtx_ids) + 1),
+                         values[:, :3].tolist()))
+        properties = values[:, 3:]
+        if nb_values is None:
+            prop = dict(zip(range(1, len(vrtx_ids) + 1),
+                            map(dict, map(enumerate, properties.tolist()))))
+        else:
+            prop = {i + 1: dict(enumerate(row[:nb - 3]))
+                    for i, (row, nb) in enumerate(zip(properties.tolist(),
+                                                      nb_values.tolist()))}
 
-    Kg = KGraph(edges, coord, prop, verbose=verbose)
+    Kg = KGraph(edges, coord, prop, verbose=verbose, lazy=lazy,
+                n_jobs=n_jobs)
 
     if verbose:
         print("Graph successfully created from file !\n")
-    f_pline.close()
 
     return Kg
 
@@ -305,7 +371,9 @@ def from_therion_sql_enhanced(  inputfile,
                                 cavename=None, 
                                 crs=None, 
                                 rights=None,
-                                citation=None ):
+                                citation=None,
+                                cache=False,
+                                engine='sqlite' ):
     """ This function 
     1. loads all the data from Therion sql, 
     2. add flags on shots and stations,
@@ -339,6 +407,19 @@ def from_therion_sql_enhanced(  inputfile,
     citation : string, optional
         Description on how to cite the dataset. Will be attached to the graph as metadata. By default None
 
+    cache : boolean, optional
+        If True, the SQL file is converted once into a SQLite database
+        next to it (inputfile.sqlite), opened directly by the next imports
+        as long as the content of the SQL file does not change. Only used
+        by the 'sqlite' engine. By default False
+
+    engine : string, optional
+        'sqlite' executes the SQL file with SQLite. 'stream' reads the
+        file by chunks and only parses the insert statements of the
+        STATION, SHOT, SURVEY, STATION_FLAG and SHOT_FLAG tables into
+        arrays, which is several times faster on large files.
+        By default 'sqlite'
+
     Returns
     -------
     G : networkx graph 
@@ -364,12 +445,14 @@ def from_therion_sql_enhanced(  inputfile,
 
     """   
 
-    import time 
     import networkx as nx
     import sqlite3
     from sqlite3 import OperationalError
     import sys
 
+    if engine not in ('sqlite', 'stream'):
+        raise ValueError("engine must be 'sqlite' or 'stream'")
+
     def list2dict(key_list, value_list):
         """Transform list to dictionnary by regouping values in list for identical keys. 
         Using dictionnary comprehension.
@@ -406,12 +489,12 @@ def from_therion_sql_enhanced(  inputfile,
         # sql_name = basename #+ '.sql'
 
         try:
-            conn = sqlite3.connect(':memory:')
-            conn.executescript(open(basename,  encoding='utf-8-sig').read())
+            conn = _therion_connection(basename, encoding='utf-8-sig',
+                                       cache=cache)
         #    	conn.executescript(open('../data/g_huttes.sql').read())
         except OSError:
             print("IMPORT ERROR: Could not import {}".format(basename))
-        #    return
+            raise
 
         # Read the SQL file
         c = conn.cursor()
@@ -439,17 +522,30 @@ def from_therion_sql_enhanced(  inputfile,
 
         if type == 'shot':
             #extract shot flags with from-to info
-            try:
-                c.execute('select SHOT_FLAG.FLAG, SHOT.FROM_ID, SHOT.TO_ID from SHOT, SHOT_FLAG  \
-                                            where SHOT.ID = SHOT_FLAG.SHOT_ID')
-            except OperationalError:
-                print(f'Cannot find sql. Verify that .sql exists or that the path is correct ')
+            if tables is not None:
+                #join of the flags and the shots on the shot id
+                shot = tables['SHOT']
+                shot_ends = dict(zip(shot['ID'].tolist(),
+                                     zip(shot['FROM_ID'].tolist(),
+                                         shot['TO_ID'].tolist())))
+                flags = tables.get('SHOT_FLAG', {'SHOT_ID': [], 'FLAG': []})
+                rows = [(flag,) + shot_ends[shot_id]
+                        for shot_id, flag in zip(list(flags['SHOT_ID']),
+                                                 list(flags['FLAG']))
+                        if shot_id in shot_ends]
+            else:
+                try:
+                    c.execute('select SHOT_FLAG.FLAG, SHOT.FROM_ID, SHOT.TO_ID from SHOT, SHOT_FLAG  \
+                                                where SHOT.ID = SHOT_FLAG.SHOT_ID')
+                except OperationalError:
+                    print(f'Cannot find sql. Verify that .sql exists or that the path is correct ')
+                rows = c.fetchall()
 
             keys = []
             values = []
             id_from = []
             id_to = []
-            for s in c.fetchall():
+            for s in rows:
                 #create list of tuple from all the links (from to)
                 keys.append((s[1],s[2]))
                 id_from.append(s[1])
@@ -464,13 +560,20 @@ def from_therion_sql_enhanced(  inputfile,
                 return list2dict(keys, values) #dict(zip(keys, values))
 
         elif type == 'station':
-            try:
-                c.execute('select STATION_ID, FLAG from STATION_FLAG')
-            except OperationalError:
-                print(f'Cannot find sql. Verify that .sql exists or that the path is correct ')
+            if tables is not None:
+                flags = tables.get('STATION_FLAG',
+                                   {'STATION_ID': [], 'FLAG': []})
+                rows = list(zip(list(flags['STATION_ID']),
+                                list(flags['FLAG'])))
+            else:
+                try:
+                    c.execute('select STATION_ID, FLAG from STATION_FLAG')
+                except OperationalError:
+                    print(f'Cannot find sql. Verify that .sql exists or that the path is correct ')
+                rows = c.fetchall()
             keys = []
             values = []
-            for s in c.fetchall():
+            for s in rows:
                 #create list of station id
                 keys.append(s[0])
                 #create list with all the flags as value
@@ -487,257 +590,289 @@ def from_therion_sql_enhanced(  inputfile,
     ########################################
 
 
-    #to check running time
-    start_time = time.time()
-
-    #read the sql database
-    c = read_sql_file(inputfile)
-    
-    # import all LINKS 
-    ###############
-    print(f'Therion Import -- Importing all links (including splays) -- {(time.time() - start_time)}s')
-    try:
-        c.execute('select FROM_ID, TO_ID from SHOT')
-    except OperationalError as e:
-        print(f'1. Cannot find sql here: {inputfile}\n verify that .sql exists or that the path is correct ')
-        raise e
-        
-    links_all = []
-    for l in c.fetchall():
-        links_all.append(l)
-   
-    
-    # import NODES
-    ###############################################################
-    #import all nodes
-    #prevents extraction of anonymous survey point symbol (- or .)  
-    print(f'Therion Import -- Importing all nodes data (including splays) -- {(time.time() - start_time)}s')
-
-    try:   
-        c.execute('select st.ID, st.NAME, st.SURVEY_ID, FULL_NAME, X, Y, Z from STATION st \
-                left join SURVEY su on st.SURVEY_ID = su.ID') 
-    except OperationalError:
-        print(f'2. Cannot find sql here: {inputfile}\n verify that .sql exists or that the path is correct ')
-    
-                           
-    nodes_coord = [] # this is all the coordinates, including the splays
-    nodes_id = [] # this all the ids, including the splays. (rename??)
-    nodes_tree_structure = []
-    for s in c.fetchall():
-        #extract x,y,z nodes coordinates. this is all the coordinates, including splays
-        nodes_coord.append([s[4], s[5], s[6]])
-        #extract unique node id from Therion. this all the ids, including splays
-        nodes_id.append(s[0])
-        #extract full stree structure from Therion. this is all the tree-structure, including the splays
-        if s[3]=='':
-            nodes_tree_structure.append(f'{s[1]}')
+    with _stage('sql_load'):
+        #read the sql database
+        if engine == 'stream':
+            #tables as arrays, the queries being done with numpy
+            tables = _read_therion_tables(inputfile, encoding='utf-8-sig')
+            c = None
         else:
-            address = '.'.join(s[3].split('.')[::-1])            
-            nodes_tree_structure.append(f'{address}.{s[1]}')
-        # nodes_tree_structure.append('%s@%s'%(s[1],s[3]))
-    #create dictionnary of the nodes coordinates
-    coord = dict(zip(nodes_id,nodes_coord))
-    #save tree structure in the form of two list, to prevent data loss when combining nodes
-    #only take the stations
-    list_tree_oldi = []
-    list_tree_values = []
-    for i, tree in enumerate(nodes_tree_structure):
-        if tree.startswith(('.','-'))==False:#tree[0].isdigit():  
-            list_tree_values.append(nodes_tree_structure[i])
-            list_tree_oldi.append(nodes_id[i])
-        #if tree.startwith(-) or tree.startwith(.):
-
+            tables = None
+            c = read_sql_file(inputfile)
+
+        # import all LINKS 
+        ###############
+        print('Therion Import -- Importing all links (including splays)')
+        if tables is not None:
+            rows = list(zip(tables['SHOT']['FROM_ID'].tolist(),
+                            tables['SHOT']['TO_ID'].tolist()))
+        else:
+            try:
+                c.execute('select FROM_ID, TO_ID from SHOT')
+            except OperationalError as e:
+                print(f'1. Cannot find sql here: {inputfile}\n verify that .sql exists or that the path is correct ')
+                raise e
+            rows = c.fetchall()
+
+        links_all = []
+        for l in rows:
+            links_all.append(l)
+
+
+        # import NODES
+        ###############################################################
+        #import all nodes
+        #prevents extraction of anonymous survey point symbol (- or .)  
+        print('Therion Import -- Importing all nodes data (including splays)')
+
+        if tables is not None:
+            stations = _therion_stations(tables)
+            rows = stations
+        else:
+            try:   
+                c.execute('select st.ID, st.NAME, st.SURVEY_ID, FULL_NAME, X, Y, Z from STATION st \
+                        left join SURVEY su on st.SURVEY_ID = su.ID') 
+            except OperationalError:
+                print(f'2. Cannot find sql here: {inputfile}\n verify that .sql exists or that the path is correct ')
+            rows = c.fetchall()
+
+
+        nodes_coord = [] # this is all the coordinates, including the splays
+        nodes_id = [] # this all the ids, including the splays. (rename??)
+        nodes_tree_structure = []
+        for s in rows:
+            #extract x,y,z nodes coordinates. this is all the coordinates, including splays
+            nodes_coord.append([s[4], s[5], s[6]])
+            #extract unique node id from Therion. this all the ids, including splays
+            nodes_id.append(s[0])
+            #extract full stree structure from Therion. this is all the tree-structure, including the splays
+            if s[3]=='':
+                nodes_tree_structure.append(f'{s[1]}')
+            else:
+                address = '.'.join(s[3].split('.')[::-1])            
+                nodes_tree_structure.append(f'{address}.{s[1]}')
+            # nodes_tree_structure.append('%s@%s'%(s[1],s[3]))
+        #create dictionnary of the nodes coordinates
+        coord = dict(zip(nodes_id,nodes_coord))
+        #save tree structure in the form of two list, to prevent data loss when combining nodes
+        #only take the stations
+        list_tree_oldi = []
+        list_tree_values = []
+        for i, tree in enumerate(nodes_tree_structure):
+            if tree.startswith(('.','-'))==False:#tree[0].isdigit():  
+                list_tree_values.append(nodes_tree_structure[i])
+                list_tree_oldi.append(nodes_id[i])
+            #if tree.startwith(-) or tree.startwith(.):
 
-    
-    #create graph with all the links
-    #################################
-    print(f'Therion Import -- Create initial graph with all the data points (including splays) -- {(time.time() - start_time)}s')
-    G = nx.Graph(cavename=cavename, crs=crs, original_data_rights=rights, citation=citation)
-    G.add_edges_from(links_all)
-    # if the nodes attributes are the same for two combined nodes, it seems that it does not affect the combining
-    nx.set_node_attributes(G, coord, 'pos')
-    # nx.set_node_attributes(G, tree_structure, 'tree_structure')
 
     
-    # Import splay leg 
-    ###################################
-    ##################################################################
-    #remove nodes that are anonymous survey point symbol (- or .)
-    
-    splay_id = []  #this is the sql id of the splay itself
-    splay_coord = []
-    try:
-        c.execute('select st.ID, st.NAME, X, Y, Z from STATION st \
-                where st.NAME in (".","-") or st.NAME like "%splay%"' )
-    except OperationalError:
-        print(f'3. Cannot find sql here: {inputfile}\n verify that .sql exists or that the path is correct ')
-    
-    for s in c.fetchall():
-        #extract x,y,z nodes coordinates
-        splay_coord.append([s[2], s[3], s[4]])
-        #extract unique node id from Therion
-        splay_id.append(s[0])
-
-    #!!! remove splays from the nodes. they will be imported later
-    if splay_id:
-        G.remove_nodes_from(splay_id)
-    else: 
-        print('no splays legs to remove')
-      
-    # Import splay leg shot info on nodes in the form of a list of coordinates of the end of the shot. 
-    #create dictionnary of the nodes coordinates for each splays. 
-    #the dictionnary key corresponds to the id for each splay in the sql database
-    coord = dict(zip(splay_id,splay_coord))
-
-    #import links only for the nodes we exported
-    string_id = ",".join(map(str,splay_id))
-    try:
-        c.execute('select FROM_ID, TO_ID from SHOT \
-                where TO_ID in (%s)' % (string_id))
-    except OperationalError:
-        print(f'4. Cannot find sql here: {inputfile}\n verify that .sql exists or that the path is correct ')
-    links = []
-    for l in c.fetchall():
-        links.append([l[0], l[1]])
-
-    #replace splay node id with the station id to which the splay is shot from
-    #for example, if 2,3,4 are splay id, and attached to station 1, then all the id will be 1
-    #splays_dict = defaultdict(list)
-    #make two lists of splays 1. station of departure, 2. coordinates for arrival
-    #(make a drawing to explain this)
-    list_splays_oldi=[]
-    list_splays_pos=[]
-    for link in links:   
-        if link:
-            list_splays_oldi.append(link[0])
-            list_splays_pos.append(coord[link[1]])
-            #splays_dict[link[0]].extend([coord[link[1]]]) 
-    
-    #nx.set_node_attributes(G, splays_dict, 'splays')   
+    with _stage('graph'):
+        #create graph with all the links
+        #################################
+        print('Therion Import -- Create initial graph with all the data points (including splays)')
+        G = nx.Graph(cavename=cavename, crs=crs, original_data_rights=rights, citation=citation)
+        G.add_edges_from(links_all)
+        # if the nodes attributes are the same for two combined nodes, it seems that it does not affect the combining
+        nx.set_node_attributes(G, coord, 'pos')
+        # nx.set_node_attributes(G, tree_structure, 'tree_structure')
+
+
+        # Import splay leg 
+        ###################################
+        ##################################################################
+        #remove nodes that are anonymous survey point symbol (- or .)
+
+        splay_id = []  #this is the sql id of the splay itself
+        splay_coord = []
+        if tables is not None:
+            #same selection as the sql query (like is not case sensitive)
+            rows = [(s[0], s[1], s[4], s[5], s[6]) for s in stations
+                    if s[1] is not None and
+                    (s[1] in ('.', '-') or 'splay' in s[1].lower())]
+        else:
+            try:
+                c.execute('select st.ID, st.NAME, X, Y, Z from STATION st \
+                        where st.NAME in (".","-") or st.NAME like "%splay%"' )
+            except OperationalError:
+                print(f'3. Cannot find sql here: {inputfile}\n verify that .sql exists or that the path is correct ')
+            rows = c.fetchall()
+
+        for s in rows:
+            #extract x,y,z nodes coordinates
+            splay_coord.append([s[2], s[3], s[4]])
+            #extract unique node id from Therion
+            splay_id.append(s[0])
+
+        #!!! remove splays from the nodes. they will be imported later
+        if splay_id:
+            G.remove_nodes_from(splay_id)
+        else: 
+            print('no splays legs to remove')
+
+        # Import splay leg shot info on nodes in the form of a list of coordinates of the end of the shot. 
+        #create dictionnary of the nodes coordinates for each splays. 
+        #the dictionnary key corresponds to the id for each splay in the sql database
+        coord = dict(zip(splay_id,splay_coord))
+
+        #import links only for the nodes we exported
+        if tables is not None:
+            shot = tables['SHOT']
+            to_splay = np.isin(shot['TO_ID'], splay_id)
+            rows = list(zip(shot['FROM_ID'][to_splay].tolist(),
+                            shot['TO_ID'][to_splay].tolist()))
+        else:
+            string_id = ",".join(map(str,splay_id))
+            try:
+                c.execute('select FROM_ID, TO_ID from SHOT \
+                        where TO_ID in (%s)' % (string_id))
+            except OperationalError:
+                print(f'4. Cannot find sql here: {inputfile}\n verify that .sql exists or that the path is correct ')
+            rows = c.fetchall()
+        links = []
+        for l in rows:
+            links.append([l[0], l[1]])
+
+        #replace splay node id with the station id to which the splay is shot from
+        #for example, if 2,3,4 are splay id, and attached to station 1, then all the id will be 1
+        #splays_dict = defaultdict(list)
+        #make two lists of splays 1. station of departure, 2. coordinates for arrival
+        #(make a drawing to explain this)
+        list_splays_oldi=[]
+        list_splays_pos=[]
+        for link in links:   
+            if link:
+                list_splays_oldi.append(link[0])
+                list_splays_pos.append(coord[link[1]])
+                #splays_dict[link[0]].extend([coord[link[1]]]) 
+
+        #nx.set_node_attributes(G, splays_dict, 'splays')   
     
    
-    #COMBINE IDENTIDAL STATIONS
-    #Rename nodes and get ride of duplicate nodes with identical position
-    ##############################################################################
-    ##############################################################################
-    # this rename nodes with identical position with the same id, 
-    # which automatically regroup the nodes with identical name into one.
-     
-    #pos2d = {key: value[0:2] for key, value in nx.get_node_attributes(G,'coord').items()}
-    # plt.figure()
-    # nx.draw(G,pos=pos2d)
-    
-    #find nodes with duplicate positions:
-    #create a list of lists of index where the coordinates are the same
-    print(f'Therion Import -- Combine Stations with identical x,y,z -- {(time.time() - start_time)}s')
-    unique_pos = [list(x) for x in set(tuple(x) for x in list(nx.get_node_attributes(G,'pos').values()))]
-    # print(len(unique_pos))
-    duplicates = []
-    for i,position in enumerate(unique_pos):
-        if i%1000 == 0:
-            print(f'{i}/{len(unique_pos)} unique positions')
-        #this could be sped up by inversing the dictionnary key and values??
-        duplicates.append([key for key,coord in G.nodes('pos') if coord==position])
-        #duplicates_fulladdress.append([])
-
-
-        
-    #rename nodes 
-    ########################################################################
-    #duplicate nodes are renamed with the same name
-    #create new ids dictionnary to replace the initial indexes  
-    #create new ids with repeating values for idential node position 
-    #################################################################
-    newis = []  
-    print(f'Therion Import -- Rename nodes -- {(time.time() - start_time)}s') 
-    # print(f'len(duplicates) = {len(duplicates)}')
-    for i, index in enumerate(range(len(duplicates))):
-        if i%1000 == 0:
-            print(f'{i}/{len(duplicates)} nodes to rename')
-        newis = newis + [index]*len(duplicates[i])
-        
-    #flatten the list of list of old ids
-    #####################################
-    print(f'Therion Import -- concatenate old ic in a dictionnary -- {(time.time() - start_time)}s')
-    concat_oldi = [j for i in duplicates for j in i]   
-    #the dictionnary has to be in the form of dict keys are the old keys, and the value is the new key
-    index_dict = dict(zip(concat_oldi, newis ))
-    # index_fulladdress = dict(zip(concat_fulladdress,newis))
-
-    # #extract full tree info
-    # #########################
-    # concat_fulladdress = []
-    # for index in concat_oldi:
-    #     concat_fulladdress.append(G.nodes('tree_structure')[index])
-    
-    print(f'Therion Import -- Relabel nodes -- {(time.time() - start_time)}s')
-    #rename nodes (nodes with same geographic posiion will be "merged" under the same name)
-    G = nx.relabel_nodes(G,index_dict)
-    #drop edges that link the node to themselves. happen because of the combining the nodes.
-    print(f'Therion Import -- remove self links -- {(time.time() - start_time)}s') 
-    G.remove_edges_from(list(nx.selfloop_edges(G)))
-
-
-    #Add attributes to the graph with the new ids,
-    ################################################################
-    print(f'Therion Import --add dictionnaries to graph -- {(time.time() - start_time)}s')  
-    #combines the information for nodes that are regrouped
-    #this steps has to be mande after the nodes have been regrouped, otherwise, 
-    #the networkx function just gets rid of attribute values is they exist in two or more combined nodes
-
-    #SPLAYS
-    #######
-    print(f'Therion Import -- add splays -- {(time.time() - start_time)}s') 
-    list_splays_newi = [index_dict.get(item, item)  for item in list_splays_oldi]
-    dict_splays = list2dict(list_splays_newi, list_splays_pos)
-    nx.set_node_attributes(G, dict_splays, 'splays') 
-
-    #TREE
-    #####
-    print(f'Therion Import -- add fulladdress -- {(time.time() - start_time)}s')
-    list_tree_newi = [index_dict.get(item, item)  for item in list_tree_oldi]
-    dict_tree = list2dict(list_tree_newi, list_tree_values)
-    nx.set_node_attributes(G, dict_tree, 'fulladdress') 
-
-
-    #add potential node flags
-    ###########################
-     # 'ent' = entrance, 'con' = continuation, 'fix' = fixed, 
-     # 'spr' = spring, 'sin' = sink, 'dol' = doline, 'dig' = dig, 
-     # 'air' =air-draught, 'ove' = overhang, 'arc' = arch attributes
-    #load the flags with the sql index
-    print('Therion Import -- add flags') 
-    list_node_flag_oldi, list_node_flag_values = extract_flags(c,'station', return_type='lists')
-    list_node_flag_newi = [index_dict.get(item, item)  for item in list_node_flag_oldi]
-    dict_node_flag = list2dict(list_node_flag_newi, list_node_flag_values)
-    nx.set_node_attributes(G, dict_node_flag, 'flag') 
-    
-    #add potential edge flags
-    ############################
-    # Shot Flags
-    # 'dpl' = duplicate, 'srf' = surface shots
-    from_edge_flag_oldi, to_edge_flag_oldi, list_edge_flag_values = extract_flags(c,'shot', return_type='lists')   
-    list_from_edge_flag_newi = [index_dict.get(item, item)  for item in from_edge_flag_oldi]
-    list_to_edge_flag_newi = [index_dict.get(item, item)  for item in to_edge_flag_oldi]
-    dict_edge_flag = list2dict(list(zip(list_from_edge_flag_newi,list_to_edge_flag_newi)), list_edge_flag_values)
-    nx.set_edge_attributes(G, dict_edge_flag, 'flags') 
-    
-
-    #SQL IDs (oldi)
-    #add old therion id name as a property
-    ################  
-    #has to be reversed from the oldi-newi dictionnary, 
-    #but preserving the 
-    print(f'Therion Import -- add sql ids -- {(time.time() - start_time)}s')
-    sql_ids = {}
-    for k, v in zip(newis, concat_oldi):
-        sql_ids.setdefault(k, []).append(v)
-    nx.set_node_attributes(G, sql_ids, 'idsql')
-    
-    #remove nodes that were isolated when removing the edges
-    #not sure that this is still necessary
-    print(f'Therion Import -- remove isolated nodes -- {(time.time() - start_time)}s')  
-    G.remove_nodes_from(list(nx.isolates(G)))      
+    with _stage('merge_duplicates'):
+        #COMBINE IDENTIDAL STATIONS
+        #Rename nodes and get ride of duplicate nodes with identical position
+        ##############################################################################
+        ##############################################################################
+        # this rename nodes with identical position with the same id, 
+        # which automatically regroup the nodes with identical name into one.
+
+        #pos2d = {key: value[0:2] for key, value in nx.get_node_attributes(G,'coord').items()}
+        # plt.figure()
+        # nx.draw(G,pos=pos2d)
+
+        #find nodes with duplicate positions:
+        #create a list of lists of index where the coordinates are the same
+        print('Therion Import -- Combine Stations with identical x,y,z')
+        unique_pos = [list(x) for x in set(tuple(x) for x in list(nx.get_node_attributes(G,'pos').values()))]
+        # print(len(unique_pos))
+        duplicates = []
+        for i,position in enumerate(unique_pos):
+            if i%1000 == 0:
+                print(f'{i}/{len(unique_pos)} unique positions')
+            #this could be sped up by inversing the dictionnary key and values??
+            duplicates.append([key for key,coord in G.nodes('pos') if coord==position])
+            #duplicates_fulladdress.append([])
+
+
+    with _stage('relabel'):
+
+        #rename nodes 
+        ########################################################################
+        #duplicate nodes are renamed with the same name
+        #create new ids dictionnary to replace the initial indexes  
+        #create new ids with repeating values for idential node position 
+        #################################################################
+        newis = []  
+        print('Therion Import -- Rename nodes') 
+        # print(f'len(duplicates) = {len(duplicates)}')
+        for i, index in enumerate(range(len(duplicates))):
+            if i%1000 == 0:
+                print(f'{i}/{len(duplicates)} nodes to rename')
+            newis = newis + [index]*len(duplicates[i])
+
+        #flatten the list of list of old ids
+        #####################################
+        print('Therion Import -- concatenate old ic in a dictionnary')
+        concat_oldi = [j for i in duplicates for j in i]   
+        #the dictionnary has to be in the form of dict keys are the old keys, and the value is the new key
+        index_dict = dict(zip(concat_oldi, newis ))
+        # index_fulladdress = dict(zip(concat_fulladdress,newis))
+
+        # #extract full tree info
+        # #########################
+        # concat_fulladdress = []
+        # for index in concat_oldi:
+        #     concat_fulladdress.append(G.nodes('tree_structure')[index])
+
+        print('Therion Import -- Relabel nodes')
+        #rename nodes (nodes with same geographic posiion will be "merged" under the same name)
+        G = nx.relabel_nodes(G,index_dict)
+        #drop edges that link the node to themselves. happen because of the combining the nodes.
+        print('Therion Import -- remove self links') 
+        G.remove_edges_from(list(nx.selfloop_edges(G)))
+
+
+    with _stage('attributes'):
+        #Add attributes to the graph with the new ids,
+        ################################################################
+        print('Therion Import --add dictionnaries to graph')  
+        #combines the information for nodes that are regrouped
+        #this steps has to be mande after the nodes have been regrouped, otherwise, 
+        #the networkx function just gets rid of attribute values is they exist in two or more combined nodes
+
+        #SPLAYS
+        #######
+        print('Therion Import -- add splays') 
+        list_splays_newi = [index_dict.get(item, item)  for item in list_splays_oldi]
+        dict_splays = list2dict(list_splays_newi, list_splays_pos)
+        nx.set_node_attributes(G, dict_splays, 'splays') 
+
+        #TREE
+        #####
+        print('Therion Import -- add fulladdress')
+        list_tree_newi = [index_dict.get(item, item)  for item in list_tree_oldi]
+        dict_tree = list2dict(list_tree_newi, list_tree_values)
+        nx.set_node_attributes(G, dict_tree, 'fulladdress') 
+
+
+        #add potential node flags
+        ###########################
+         # 'ent' = entrance, 'con' = continuation, 'fix' = fixed, 
+         # 'spr' = spring, 'sin' = sink, 'dol' = doline, 'dig' = dig, 
+         # 'air' =air-draught, 'ove' = overhang, 'arc' = arch attributes
+        #load the flags with the sql index
+        print('Therion Import -- add flags') 
+        list_node_flag_oldi, list_node_flag_values = extract_flags(c,'station', return_type='lists')
+        list_node_flag_newi = [index_dict.get(item, item)  for item in list_node_flag_oldi]
+        dict_node_flag = list2dict(list_node_flag_newi, list_node_flag_values)
+        nx.set_node_attributes(G, dict_node_flag, 'flag') 
+
+        #add potential edge flags
+        ############################
+        # Shot Flags
+        # 'dpl' = duplicate, 'srf' = surface shots
+        from_edge_flag_oldi, to_edge_flag_oldi, list_edge_flag_values = extract_flags(c,'shot', return_type='lists')   
+        list_from_edge_flag_newi = [index_dict.get(item, item)  for item in from_edge_flag_oldi]
+        list_to_edge_flag_newi = [index_dict.get(item, item)  for item in to_edge_flag_oldi]
+        dict_edge_flag = list2dict(list(zip(list_from_edge_flag_newi,list_to_edge_flag_newi)), list_edge_flag_values)
+        nx.set_edge_attributes(G, dict_edge_flag, 'flags') 
+
+
+        #SQL IDs (oldi)
+        #add old therion id name as a property
+        ################  
+        #has to be reversed from the oldi-newi dictionnary, 
+        #but preserving the 
+        print('Therion Import -- add sql ids')
+        sql_ids = {}
+        for k, v in zip(newis, concat_oldi):
+            sql_ids.setdefault(k, []).append(v)
+        nx.set_node_attributes(G, sql_ids, 'idsql')
+
+        #remove nodes that were isolated when removing the edges
+        #not sure that this is still necessary
+        print('Therion Import -- remove isolated nodes')  
+        G.remove_nodes_from(list(nx.isolates(G)))      
 
     # #remove unnecessary attributes
     # for (n,d) in G.nodes(data=True):
@@ -753,5 +888,393 @@ def from_therion_sql_enhanced(  inputfile,
     # return H
 
 
+# *************************************************************
+# -------------------Non Public Functions:---------------------
+# *************************************************************
+
+def _read_pline(f_pline, chunk_size=2 ** 24):
+    """NON PUBLIC.
+    Reads the vertices, atoms and segments of a Gocad Pline file.
+
+    The file is read by chunks of about chunk_size characters. The lines
+    are dispatched on their keyword (VRTX and PVRTX, ATOM and PATOM, SEG),
+    and the records of each kind are converted to arrays at once.
 
+    Returns:
+    --------
+       - vrtx_ids : index of each vertex in the file
+       - values : (N, 3 + P) array of the coordinates and the properties
+            of the vertices
+       - nb_values : number of values of each vertex if they do not all
+            have the same number of properties (missing ones are NaN in
+            values), None otherwise
+       - atoms : (A, 2) array of the index of each atom and of the vertex
+            it refers to
+       - segs : (S, 2) array of the indices of the ends of each segment
+    """
+    vrtx_ids, values, atoms, segs = [], [], [], []
+    widths = []
+    while True:
+        lines = f_pline.readlines(chunk_size)
+        if not lines:
+            break
+
+        vrtx_lines, atom_lines, seg_lines = [], [], []
+        records = {'VRTX': vrtx_lines, 'PVRTX': vrtx_lines,
+                   'ATOM': atom_lines, 'PATOM': atom_lines,
+                   'SEG': seg_lines}
+        for line in lines:
+            # The fields may be indented and separated by tabs
+            fields = line.split(None, 1)
+            if len(fields) == 2 and fields[0] in records:
+                records[fields[0]].append(fields[1])
+
+        if vrtx_lines:
+            try:
+                rows = np.loadtxt(io.StringIO(''.join(vrtx_lines)),
+                                  ndmin=2)
+                widths.append(np.full(len(rows), rows.shape[1]))
+            except ValueError:
+                # Vertices with different numbers of properties
+                rows = [record.split() for record in vrtx_lines]
+                width = max(len(row) for row in rows)
+                widths.append(np.array([len(row) for row in rows]))
+                rows = np.array([row + ['nan'] * (width - len(row))
+                                 for row in rows], dtype=np.float64)
+            vrtx_ids.append(rows[:, 0].astype(np.int64))
+            values.append(rows[:, 1:])
+        if atom_lines:
+            atoms.append(np.array([record.split()[:2]
+                                   for record in atom_lines],
+                                  dtype=np.int64))
+        if seg_lines:
+            segs.append(np.array(''.join(seg_lines).split(),
+                                 dtype=np.int64).reshape(-1, 2))
+
+    if vrtx_ids:
+        vrtx_ids = np.concatenate(vrtx_ids)
+        width = max(chunk.shape[1] for chunk in values)
+        values = np.concatenate([
+            np.pad(chunk, ((0, 0), (0, width - chunk.shape[1])),
+                   constant_values=np.nan) for chunk in values])
+        nb_values = np.concatenate(widths) - 1
+        if np.all(nb_values == width):
+            nb_values = None
+    else:
+        vrtx_ids = np.zeros(0, dtype=np.int64)
+        values = np.zeros((0, 3))
+        nb_values = None
+    atoms = np.concatenate(atoms) if atoms else np.zeros((0, 2), np.int64)
+    segs = np.concatenate(segs) if segs else np.zeros((0, 2), np.int64)
+
+    return vrtx_ids, values, nb_values, atoms, segs
+
+
+def _read_dat(filename, chunk_size=2 ** 26, n_jobs=1, cache=False):
+    """NON PUBLIC.
+    Reads a text file of numbers separated by white spaces, one row per
+    line, as a 2D float array.
+
+    With n_jobs > 1, a file larger than chunk_size bytes is split in
+    chunks of about chunk_size bytes ending at the end of a line, parsed
+    in n_jobs processes, each process reading its own chunks. With
+    cache=True, the array is saved in filename.npy, followed by the size
+    and the modification time of the text file: the cache is read instead
+    of the text file as long as they do not change. np.load(filename.npy)
+    gives the array.
+    """
+    stat = os.stat(filename)
+    stamp = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    cache_name = filename + '.npy'
+    if cache:
+        try:
+            with open(cache_name, 'rb') as f:
+                values = np.load(f, allow_pickle=False)
+                if np.array_equal(np.load(f, allow_pickle=False), stamp):
+                    return values
+        except (OSError, ValueError, EOFError):
+            pass
+
+    nb_workers = _n_workers(n_jobs)
+    if nb_workers > 1 and stat.st_size > chunk_size:
+        # Offsets of the chunks
+        bounds = [0]
+        with open(filename, 'rb') as f:
+            while bounds[-1] < stat.st_size:
+                f.seek(bounds[-1] + chunk_size)
+                f.readline()
+                bounds.append(min(f.tell(), stat.st_size))
+        chunks = [(filename, start, end)
+                  for start, end in zip(bounds[:-1], bounds[1:])]
+        with ProcessPoolExecutor(min(nb_workers, len(chunks))) as executor:
+            values = [chunk for chunk in executor.map(_read_dat_chunk,
+                                                      chunks)
+                      if chunk.size > 0]
+        if len({chunk.shape[1] for chunk in values}) > 1:
+            raise ValueError("{}: the lines do not all have the same "
+                             "number of values".format(filename))
+        values = np.concatenate(values) if values else np.zeros((0, 0))
+    else:
+        values = _read_dat_chunk((filename, 0, None))
 
+    if cache:
+        # Written in a temporary file to never leave an incomplete cache
+        tmp_name = '{}.{}.tmp'.format(cache_name, os.getpid())
+        try:
+            with open(tmp_name, 'wb') as f:
+                np.save(f, values, allow_pickle=False)
+                np.save(f, stamp, allow_pickle=False)
+            os.replace(tmp_name, cache_name)
+        except OSError:
+            # Read-only directory: the file is read without cache
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+    return values
+
+
+def _read_dat_chunk(chunk):
+    """NON PUBLIC.
+    Parses the lines of a .dat file between two offsets (up to the end
+    of the file if the second one is None) as a 2D float array.
+    """
+    filename, start, end = chunk
+    with warnings.catch_warnings():
+        # Chunk without any value
+        warnings.simplefilter('ignore', UserWarning)
+        if start == 0 and end is None:
+            values = np.loadtxt(filename, ndmin=2)
+        else:
+            with open(filename, 'rb') as f:
+                f.seek(start)
+                values = np.loadtxt(io.BytesIO(f.read(end - start)),
+                                    ndmin=2)
+    if values.size == 0:
+        return np.zeros((0, 0))
+    return values
+
+
+# Indexes of the SQLite databases converted from Therion SQL files
+_THERION_INDEXES = (('SHOT', 'FROM_ID'), ('SHOT', 'TO_ID'),
+                    ('STATION', 'ID'), ('SHOT_FLAG', 'SHOT_ID'))
+
+
+def _therion_connection(sql_name, encoding=None, cache=False):
+    """NON PUBLIC.
+    Connection to the SQLite database of a Therion SQL file.
+
+    Without cache, the SQL file is executed in a database in memory.
+    Otherwise, it is converted into the file sql_name.sqlite, with indexes
+    on the columns used to select the stations and the shots, and with
+    the hash of the content of the SQL file (and of its encoding): the
+    database is opened read-only by the next calls as long as the hash
+    does not change. The database is built in memory and copied to the
+    file, which is skipped if it cannot be written.
+    """
+    if cache:
+        sha = hashlib.sha256(str(encoding).encode())
+        with open(sql_name, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                sha.update(block)
+        content_hash = sha.hexdigest()
+
+        cache_name = sql_name + '.sqlite'
+        uri = 'file:{}?mode=ro'.format(
+            pathname2url(os.path.abspath(cache_name)))
+        if os.path.exists(cache_name):
+            conn = None
+            try:
+                conn = sqlite3.connect(uri, uri=True)
+                stored = conn.execute(
+                    'select HASH from KARSTNET_CACHE').fetchone()
+                if stored is not None and stored[0] == content_hash:
+                    return conn
+            except sqlite3.DatabaseError:
+                pass
+            if conn is not None:
+                conn.close()
+
+    conn = sqlite3.connect(':memory:')
+    try:
+        with open(sql_name, encoding=encoding) as f:
+            conn.executescript(f.read())
+    except Exception:
+        conn.close()
+        raise
+    if not cache:
+        return conn
+
+    for table, column in _THERION_INDEXES:
+        try:
+            conn.execute('create index {0}_{1} on {0} ({1})'.format(
+                table, column))
+        except sqlite3.OperationalError:
+            # Table missing in this SQL file
+            pass
+    conn.execute('create table KARSTNET_CACHE (HASH text)')
+    conn.execute('insert into KARSTNET_CACHE values (?)', (content_hash,))
+    conn.commit()
+
+    # Copied in a temporary file to never leave an incomplete database
+    tmp_name = '{}.{}.tmp'.format(cache_name, os.getpid())
+    try:
+        disk = sqlite3.connect(tmp_name)
+        try:
+            conn.backup(disk)
+        finally:
+            disk.close()
+        os.replace(tmp_name, cache_name)
+    except (OSError, sqlite3.Error):
+        # Read-only directory: the database is only used in memory
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    return conn
+
+
+# Tables of the Therion SQL files read by the 'stream' engine of
+# from_therion_sql_enhanced, from_therion_sql only reads STATION and SHOT
+_THERION_TABLES = ('STATION', 'SHOT', 'SURVEY', 'STATION_FLAG', 'SHOT_FLAG')
+
+
+def _read_therion_tables(sql_name, encoding=None, tables=_THERION_TABLES,
+                         chunk_size=2 ** 24):
+    """NON PUBLIC.
+    Reads the tables of a Therion SQL file as NumPy arrays, without
+    SQLite.
+
+    The file is read by chunks of about chunk_size characters. The
+    'create table' statements give the columns of the tables, and the
+    values of the 'insert into T values (...);' statements (one per line)
+    of the requested tables are extracted with a regular expression, the
+    other statements being skipped.
+    The tables containing only numbers are converted at once, the rows of
+    the other ones are split with the csv module (strings are quoted with
+    ' and a quote inside a string is doubled).
+
+    Returns:
+    --------
+       - dictionnary giving for each table a dictionnary of its columns:
+         int64 arrays for the integer columns without NULL, float arrays
+         (NULL as NaN) for the other numeric columns, and object arrays of
+         strings (NULL as None) for the text columns
+    """
+    columns = {}
+    records = {table: [] for table in tables}
+    # Values of the statements written on one line
+    patterns = {table: re.compile(r'insert into {} values ?\((.*)\);?'
+                                  .format(re.escape(table)))
+                for table in tables}
+    with open(sql_name, encoding=encoding) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            # Chunks end at the end of a line
+            chunk += f.readline()
+
+            for line in chunk.split('create table ')[1:]:
+                table, _, definition = line.partition('\n')[0].partition('(')
+                table = table.strip()
+                if table in records:
+                    definition = definition.strip().rstrip(';').rstrip()
+                    columns[table] = [column.split() for column in
+                                      definition[:-1].split(',')]
+
+            for table, target in records.items():
+                values = patterns[table].findall(chunk)
+                statement = 'insert into {} '.format(table)
+                if len(values) != chunk.count(statement):
+                    raise ValueError(
+                        "{}: unsupported insert statement in table {} "
+                        "(use engine='sqlite')".format(sql_name, table))
+                target.extend(values)
+
+    arrays = {}
+    for table, lines in records.items():
+        if table in columns:
+            arrays[table] = _therion_table(lines, columns[table], sql_name,
+                                           table)
+    return arrays
+
+
+def _therion_table(lines, columns, sql_name, table):
+    """NON PUBLIC.
+    Columns of a table of a Therion SQL file from the values of its insert
+    statements and from its columns (name and type).
+
+    The values of the tables containing only numbers are parsed at once
+    with np.fromstring. Otherwise, the numbers are converted by the csv
+    module, the strings being quoted, unless there are NULL values: the
+    values are then all read as strings before being converted.
+    """
+    names = [column[0] for column in columns]
+    kinds = [column[1].split('(')[0].lower() if len(column) > 1 else ''
+             for column in columns]
+    shape = (len(lines), len(names))
+
+    values = None
+    if all(kind in ('integer', 'real') for kind in kinds):
+        with warnings.catch_warnings():
+            # np.fromstring warns when it cannot parse the whole text
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                values = np.fromstring(','.join(lines), sep=',')
+                values = values.reshape(shape)
+            except (DeprecationWarning, ValueError):
+                values = None
+    if values is None:
+        try:
+            values = np.array(list(csv.reader(
+                lines, quotechar="'", skipinitialspace=True,
+                quoting=csv.QUOTE_NONNUMERIC)), dtype=object)
+            values = values.reshape(shape)
+        except ValueError:
+            values = None
+    if values is None:
+        try:
+            values = np.array(list(csv.reader(
+                lines, quotechar="'", skipinitialspace=True)), dtype=np.str_)
+            values = values.reshape(shape)
+        except ValueError:
+            raise ValueError("{}: wrong number of values in table "
+                             "{}".format(sql_name, table)) from None
+
+    return {name: _therion_column(values[:, i], kind)
+            for i, (name, kind) in enumerate(zip(names, kinds))}
+
+
+def _therion_column(values, kind):
+    """NON PUBLIC.
+    Array of the values of a column of a Therion SQL table, from the type
+    of the column. When the values are strings, the NULL values are given
+    as the string 'NULL'.
+    """
+    strings = values.dtype.kind == 'U'
+    if kind in ('integer', 'real'):
+        if strings:
+            values = np.where(values == 'NULL', 'nan', values)
+        values = values.astype(np.float64)
+        if kind == 'integer' and np.all(values == np.round(values)):
+            return values.astype(np.int64)
+        return values
+    column = values.astype(object)
+    if strings:
+        column[values == 'NULL'] = None
+    return column
+
+
+def _therion_stations(tables):
+    """NON PUBLIC.
+    Rows (ID, NAME, SURVEY_ID, FULL_NAME, X, Y, Z) of the stations read by
+    _read_therion_tables, the full name being the one of their survey
+    (None if it does not exist).
+    """
+    station = tables['STATION']
+    survey = tables.get('SURVEY', {'ID': np.zeros(0, dtype=np.int64),
+                                   'FULL_NAME': np.zeros(0, dtype=object)})
+    full_name = dict(zip(survey['ID'].tolist(), survey['FULL_NAME']))
+    full_names = [full_name.get(survey_id)
+                  for survey_id in station['SURVEY_ID'].tolist()]
+    return list(zip(station['ID'].tolist(), station['NAME'].tolist(),
+                    station['SURVEY_ID'].tolist(), full_names,
+                    station['X'].tolist(), station['Y'].tolist(),
+                    station['Z'].tolist()))
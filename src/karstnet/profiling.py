@@ -0,0 +1,194 @@
+#    Copyright (C) 2018-2024 by
+#    Philippe Renard <philippe.renard@unine.ch>
+#    Pauline Collon <pauline.collon@univ-lorraine.fr>
+#    All rights reserved.
+#    MIT license.
+#
+"""
+Karstnet Profiling
+==================
+
+Karstnet is a Python package for the analysis of karstic networks.
+
+The Profiling module records the time spent in the main stages of the
+construction of a KGraph (edge lengths and orientations, branches,
+simplification) and of the import functions (SQL loading, merging of
+duplicate stations, relabelling).
+
+"""
+
+# ----External librairies importations
+import time
+import tracemalloc
+
+
+# Profiler receiving the measures of the stages, None when profiling is
+# disabled
+_active = None
+
+
+class _NullStage:
+    """
+    NOT PUBLIC
+    Stage used when no profiler is active: entering and leaving it does
+    nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """
+    NOT PUBLIC
+    Measures the wall time and the peak memory of one execution of a stage
+    and reports them to the active profiler.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall_time = time.perf_counter() - self.start
+        self.profiler._exit(self, wall_time)
+        return False
+
+
+def _stage(name):
+    """
+    NOT PUBLIC
+    Context manager measuring the stage `name` if a profiler is active.
+    When profiling is disabled, the same empty context manager is always
+    returned.
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _Stage(_active, name)
+
+
+class Profiler:
+    """
+    Records the wall time, the number of calls and the peak memory of the
+    stages of the KGraph construction and of the import functions
+    executed while the profiler is active.
+
+    The stages are 'index' (compact arrays of the graph), 'lengths',
+    'orientations', 'branches', 'simplify', and for the import functions
+    'read', 'sql_load', and for from_therion_sql_enhanced 'graph',
+    'merge_duplicates', 'relabel' and 'attributes'. Nested stages are
+    included in the time of the enclosing one.
+
+    Profiling costs nothing when no profiler is active. The memory is
+    measured with tracemalloc, which slows down the execution: use
+    memory=False to only measure times.
+
+    Parameters
+    ----------
+    callback : function
+        optional function called at the end of each stage with the name
+        of the stage and a dictionnary containing its wall time in
+        seconds ('time') and its peak memory in bytes ('peak_memory')
+
+    memory : boolean
+        If True (default), the peak memory allocated during each stage,
+        above the memory allocated when it starts, is measured
+
+    Examples
+    --------
+       >>> with kn.Profiler() as prof:
+       ...     myKGraph = kn.from_therion_sql("MyKarst")
+       >>> prof.stats['branches']['time']
+       >>> kn.Profiler(callback=print, memory=False)
+    """
+
+    def __init__(self, callback=None, memory=True):
+        self.callback = callback
+        self.memory = memory
+        self._stats = {}
+        self._open = []
+        self._previous = None
+        self._tracing = False
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        self._previous = None
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        return False
+
+    @property
+    def stats(self):
+        """
+        Dictionnary of the measures of each stage: for each stage name, a
+        dictionnary with the total wall time in seconds ('time'), the
+        number of calls ('calls') and the largest peak memory in bytes
+        ('peak_memory', None if the memory is not measured).
+        """
+        return {name: dict(record) for name, record in self._stats.items()}
+
+    def reset(self):
+        """
+        Clears the measures recorded so far.
+        """
+        self._stats = {}
+
+    def _enter(self, stage):
+        """NON PUBLIC.
+        Starts the memory measure of a stage. The peak since the start of
+        the enclosing stages is saved before being reset.
+        """
+        if not (self.memory and tracemalloc.is_tracing()):
+            stage.memory = None
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        for parent in self._open:
+            parent.peak = max(parent.peak, peak)
+        tracemalloc.reset_peak()
+        stage.memory = current
+        stage.peak = current
+        self._open.append(stage)
+
+    def _exit(self, stage, wall_time):
+        """NON PUBLIC.
+        Records the measures of a stage and sends them to the callback.
+        """
+        peak_memory = None
+        if stage.memory is not None:
+            self._open.remove(stage)
+            peak = max(stage.peak, tracemalloc.get_traced_memory()[1])
+            peak_memory = peak - stage.memory
+
+        record = self._stats.setdefault(
+            stage.name, {'time': 0., 'calls': 0, 'peak_memory': None})
+        record['time'] += wall_time
+        record['calls'] += 1
+        if peak_memory is not None:
+            record['peak_memory'] = max(record['peak_memory'] or 0,
+                                        peak_memory)
+
+        if self.callback is not None:
+            self.callback(stage.name, {'time': wall_time,
+                                       'peak_memory': peak_memory})
@@ -10,7 +10,11 @@ Test module for the Karstnet class.
 Execute with pytest : `pytest test_karstnet.py`
 """
 
+import os
+import sqlite3
+
 import karstnet as kn
+import networkx as nx
 import numpy as np
 import pytest
 
@@ -247,3 +251,631 @@ def test_length_entropy(disassortative, assortative, complete):
 def test_orientation_entropy(assortative, complete):
     assert float_eq(assortative.orientation_entropy(), 0.698)
     assert float_eq(complete.orientation_entropy(), 0.841)
+
+
+def test_networkx_views(assortative):
+    assert assortative.graph.number_of_nodes() == 25
+    assert assortative.graph.number_of_edges() == 44
+    assert float_eq(assortative.graph.edges[9, 17]['length'], 1.0)
+    assert assortative.graph_simpl.number_of_edges() == \
+        len(assortative.list_simpl_edges)
+    assert np.array_equal(assortative.pos3d[2], [1.0, 0.0, 0.0])
+    assert np.array_equal(assortative.pos2d[2], [1.0, 0.0])
+
+
+def test_edge_orientations():
+    pos = {0: (0, 0, 0), 1: (1, 1, -1), 2: (1, 1, 3), 3: (2, 1, 3)}
+    k = kn.KGraph([(0, 1), (1, 2), (2, 3)], pos, verbose=False)
+    azimuth = k.edge_array('azimuth')
+    dip = k.edge_array('dip')
+    assert float_eq(azimuth[0], 45.0)
+    assert float_eq(dip[0], 35.264)
+    assert np.isnan(azimuth[1]) and dip[1] == 90
+    assert float_eq(azimuth[2], 90.0) and dip[2] == 0
+    assert float_eq(k.edge_array('length')[1], 4.0)
+    with pytest.raises(ValueError):
+        azimuth[0] = 0
+
+
+def test_branches(semibinary, assortative):
+    assert len(semibinary.branches) == 12
+    assert float_eq(np.sum(semibinary.br_lengths),
+                    np.sum(semibinary.edge_array('length')))
+    # every edge belongs to exactly one branch
+    nb_edges = sum(len(br) - 1 for br in assortative.branches)
+    assert nb_edges == assortative.graph.number_of_edges()
+
+
+def test_lazy_construction(assortative):
+    pos = dict(assortative.pos3d)
+    edges = list(assortative.graph.edges())
+    k = kn.KGraph(edges, pos, verbose=False, lazy=True)
+    assert float_eq(k.orientation_entropy(), assortative.orientation_entropy())
+    assert 'branches' not in k._stages_done
+    assert float_eq(k.mean_length(), 1.118)
+    assert 'simplified' not in k._stages_done
+    k.precompute()
+    assert float_eq(k.average_SPL(), 2.947)
+
+
+def test_graph_modifications(assortative):
+    pos = dict(assortative.pos3d)
+    edges = list(assortative.graph.edges())
+    k = kn.KGraph(edges, pos, verbose=False)
+    new_edges = [(edges[0][0], 'new'), ('new', edges[-1][1])]
+    k.add_edges(new_edges, {'new': [0.5, 0.5, 1.]})
+    k.remove_edges(edges[2:4])
+    k.move_nodes({edges[5][0]: [2., 1., 0.]})
+
+    pos.update({'new': [0.5, 0.5, 1.], edges[5][0]: [2., 1., 0.]})
+    ref = kn.KGraph(edges[:2] + edges[4:] + new_edges, pos, verbose=False)
+    def canonical(branches):
+        branches = [[str(n) for n in b] for b in branches]
+        return sorted(min(b, b[::-1]) for b in branches)
+
+    assert canonical(k.branches) == canonical(ref.branches)
+    assert float_eq(k.average_SPL(), ref.average_SPL())
+    assert float_eq(k.central_point_dominance(),
+                    ref.central_point_dominance())
+    assert float_eq(k.mean_length(), ref.mean_length())
+    assert float_eq(k.mean_tortuosity(), ref.mean_tortuosity())
+    assert k.graph.number_of_edges() == ref.graph.number_of_edges()
+
+
+def test_graph_modifications_loops():
+    # Removing the edge (3, 4) leaves the cycle 0-1-2-3 isolated, the
+    # new edges form another isolated cycle
+    edges = [(0, 1), (1, 2), (2, 3), (3, 0), (3, 4), (4, 5), (4, 6)]
+    pos = {i: [np.cos(i), np.sin(i), i % 3] for i in range(7)}
+    k = kn.KGraph(edges, pos, verbose=False)
+    k.list_simpl_edges
+    new_edges = [('a', 'b'), ('b', 'c'), ('c', 'a')]
+    new_pos = {'a': [0., 0., 1.], 'b': [1., 0., 1.], 'c': [0., 1., 1.]}
+    k.remove_edges([(3, 4)])
+    k.add_edges(new_edges, new_pos)
+
+    pos.update(new_pos)
+    ref = kn.KGraph(edges[:4] + edges[5:] + new_edges, pos, verbose=False)
+    # Same branches, starting from the same nodes
+    assert (sorted(str(b) for b in k.branches) ==
+            sorted(str(b) for b in ref.branches))
+    assert (sorted(str(e) for e in k.list_simpl_edges) ==
+            sorted(str(e) for e in ref.list_simpl_edges))
+    assert float_eq(k.average_SPL(dist_weight=True),
+                    ref.average_SPL(dist_weight=True))
+
+
+def test_move_nodes_copy():
+    coords = np.array([[0., 0., 0.], [1., 0., 0.], [1., 1., 0.]])
+    k = kn.KGraph(np.array([[0, 1], [1, 2]]), coords, verbose=False)
+    lengths = k.edge_array('length')
+    br_lengths = k.br_lengths
+    k.move_nodes({1: [5., 5., 5.]})
+
+    # The arrays given or returned before the move are not modified
+    assert np.array_equal(coords[1], [1., 0., 0.])
+    assert np.array_equal(lengths, [1., 1.])
+    assert np.array_equal(br_lengths, [2.])
+    assert np.array_equal(k.pos3d[1], [5., 5., 5.])
+    assert not np.array_equal(k.edge_array('length'), lengths)
+
+
+def networkx_branches(G):
+    # Branches of the Networkx implementation of karstnet 1.x
+    targets = []
+    for c in nx.connected_components(G):
+        sub_gr = G.subgraph(c).copy()
+        ends = [n for n in sub_gr if sub_gr.degree(n) != 2]
+        targets += ends if ends else [list(sub_gr)[-1]]
+    branches = []
+    for t in targets:
+        for n in G.neighbors(t):
+            if any(b[-1] == t and b[-2] == n for b in branches):
+                continue
+            path = [t, n]
+            while G.degree(path[-1]) == 2 and path[-1] != path[0]:
+                path.append(next(m for m in G.neighbors(path[-1])
+                                 if m != path[-2]))
+            branches.append(path)
+    return branches
+
+
+def test_branches_networkx():
+    # Disconnected random graphs with isolated loops, the labels being
+    # spread so that the order of the small components depends on them
+    rng = np.random.default_rng(0)
+    for seed in range(20):
+        G = nx.gnm_random_graph(30, 28, seed=seed)
+        for start in (30, 40):
+            nx.add_cycle(G, range(start, start + int(rng.integers(3, 7))))
+        labels = rng.permutation(50) * 9 + 1
+        edges = [(int(labels[u]), int(labels[v])) for u, v in G.edges()]
+        rng.shuffle(edges)
+        pos = {n: rng.random(3).tolist() for e in edges for n in e}
+        k = kn.KGraph(edges, pos, verbose=False)
+        assert k.branches == networkx_branches(nx.Graph(edges))
+
+
+def test_parallel_construction(periodic, assortative, semibinary):
+    # Disconnected copies of the test graphs, with a pure cycle
+    edges, pos = [], {}
+    for i, k in enumerate((periodic, assortative, semibinary)):
+        edges += [((i, u), (i, v)) for u, v in k.graph.edges()]
+        pos.update({(i, u): xyz for u, xyz in k.pos3d.items()})
+    edges += [('a', 'b'), ('b', 'c'), ('c', 'a')]
+    pos.update({'a': [0, 0, 0], 'b': [1, 0, 0], 'c': [0, 1, 0]})
+
+    serial = kn.KGraph(edges, pos, verbose=False)
+    parallel = kn.KGraph(edges, pos, verbose=False, n_jobs=2)
+    assert parallel.branches == serial.branches
+    assert parallel.list_simpl_edges == serial.list_simpl_edges
+    assert np.array_equal(parallel.br_tort, serial.br_tort, equal_nan=True)
+    assert float_eq(parallel.average_SPL(), serial.average_SPL())
+
+
+def test_profiler(assortative):
+    edges = list(assortative.graph.edges())
+    calls = []
+    with kn.Profiler(callback=lambda name, rec: calls.append(name)) as prof:
+        kn.KGraph(edges, assortative.pos3d, verbose=False)
+        k = kn.KGraph(edges, assortative.pos3d, verbose=False, lazy=True)
+    stats = prof.stats
+    assert set(stats) == {'index', 'lengths', 'orientations', 'branches',
+                          'simplify'}
+    assert stats['index']['calls'] == 2
+    assert stats['branches']['calls'] == 1
+    assert stats['branches']['time'] > 0
+    assert stats['simplify']['peak_memory'] > 0
+    assert calls.count('index') == 2
+
+    # Nothing is recorded once the profiler is closed
+    k.precompute()
+    assert prof.stats == stats
+
+
+def test_array_input(assortative):
+    labels = list(assortative.pos3d)
+    coords = np.array([assortative.pos3d[n] for n in labels])
+    index = {n: i for i, n in enumerate(labels)}
+    edges = np.array([[index[u], index[v]]
+                      for u, v in assortative.graph.edges()])
+
+    k = kn.KGraph(edges, coords, verbose=False)
+    assert np.shares_memory(k._coords, coords)
+    assert k.pos2d[1] == coords[1, :2].tolist()
+    assert float_eq(k.average_SPL(), assortative.average_SPL())
+    assert float_eq(k.mean_length(), assortative.mean_length())
+
+    # 2d coordinates, rows not in the order of the edges
+    k = kn.KGraph(edges[::-1], coords[:, :2], verbose=False)
+    assert k.pos3d[5] == [coords[5, 0], coords[5, 1], 0.]
+    # The values are copies, the graph is not modified through them
+    k.pos2d[5][0] = 1.
+    assert k.pos2d[5][0] == coords[5, 0]
+
+
+def test_position_views(tmp_path):
+    # The node 'd' has coordinates but no edge
+    pos = {'a': [0., 0., 0.], 'b': [1., 0., 0.], 'c': [1., 1., 2.],
+           'd': [5., 5., 5.]}
+    k = kn.KGraph([('a', 'b'), ('b', 'c')], pos, verbose=False)
+    assert dict(k.pos3d) == pos
+    assert k.pos2d['d'] == [5., 5.]
+    assert k.pos3d['a'] != k.pos3d['b']
+    assert k.graph.number_of_nodes() == 3
+
+    k.save(str(tmp_path / "k.kgraph"))
+    assert dict(kn.load(str(tmp_path / "k.kgraph")).pos3d) == pos
+
+    # Moving the node without edge, then linking it to the graph
+    k.move_nodes({'d': [5., 6., 5.]})
+    assert k.pos3d['d'] == [5., 6., 5.]
+    k.add_edges([('c', 'd')])
+    assert k.graph.number_of_nodes() == 4
+    assert float_eq(k.edge_array('length')[-1], np.sqrt(50.))
+    assert len(k.pos3d) == 4
+
+    # Array input: the rows that are not used by the edges are kept
+    coords = np.arange(12.).reshape(4, 3)
+    k = kn.KGraph(np.array([[0, 1], [1, 2]]), coords, verbose=False)
+    assert list(k.pos3d) == [0, 1, 2, 3]
+    assert k.pos3d[3] == [9., 10., 11.]
+
+
+def test_edge_arrays():
+    edges = [(1, 2, {'width': 1.5}), (2, 3, {'width': 2.}), (3, 4)]
+    pos = {1: [0, 0, 0], 2: [1, 0, 0], 3: [2, 0, 0], 4: [3, 1, 0]}
+    k = kn.KGraph(edges, pos, verbose=False)
+    assert k.edge_nodes.tolist() == [[1, 2], [2, 3], [3, 4]]
+    assert k.edge_names == ['length', 'length2d', 'azimuth', 'dip', 'width']
+    assert np.array_equal(k.edge_array('width'), [1.5, 2., np.nan],
+                          equal_nan=True)
+    assert k.edge_array('length') is not k.edge_array('length')
+    assert np.shares_memory(k.edge_array('length'), k.edge_array('length'))
+
+    k.set_edge_array('flow', np.array([1., 2., 3.]))
+    assert k.graph.edges[3, 4]['flow'] == 3.
+    k.add_edges([(4, 5)], {5: [3, 2, 0]})
+    k.remove_edges([(1, 2)])
+    assert np.array_equal(k.edge_array('flow'), [2., 3., np.nan],
+                          equal_nan=True)
+    with pytest.raises(ValueError):
+        k.set_edge_array('length', [1., 2., 3.])
+    with pytest.raises(KeyError):
+        k.edge_array('depth')
+
+
+def test_simple_edge_provenance(semibinary):
+    lengths = semibinary.simpl_edge_array('length')
+    assert np.allclose(lengths, semibinary._simpl_lengths)
+    edge_lengths = semibinary.edge_array('length')
+    for k, (u, v) in enumerate(semibinary.list_simpl_edges):
+        path = semibinary.simpl_edge_path(k)
+        ids = semibinary.simpl_edge_ids(k)
+        assert path[0] == u and path[-1] == v
+        assert len(ids) == len(path) - 1
+        assert float_eq(edge_lengths[ids].sum(), lengths[k])
+    assert np.all(semibinary.simpl_edge_array('length', 'max') <=
+                  lengths + 1e-12)
+
+
+def test_characterize_graph(assortative, semibinary):
+    for k in (assortative, semibinary):
+        results = k.characterize_graph()
+        assert float_eq(results['aspl'], k.average_SPL(), 1e-12)
+        assert float_eq(results['cpd'], k.central_point_dominance(), 1e-12)
+        assert float_eq(results['mean length'], k.mean_length(), 1e-12)
+
+
+def test_average_SPL_backends(assortative, semibinary):
+    for k in (assortative, semibinary):
+        for weighted in (False, True):
+            aspl = k.average_SPL(weighted, backend='python')
+            assert float_eq(k.average_SPL(weighted), aspl, 1e-9)
+            assert float_eq(k.average_SPL(weighted, chunk_size=3), aspl,
+                            1e-9)
+    with pytest.raises(ValueError):
+        assortative.average_SPL(backend='networkx')
+
+
+def test_sampled_central_point_dominance(assortative, semibinary):
+    for k in (assortative, semibinary):
+        exact = k.central_point_dominance()
+        n = len(k.graph_simpl)
+        cpd, (low, high) = k.central_point_dominance(k=n, seed=0)
+        assert float_eq(cpd, exact, 1e-12)
+        assert float_eq(low, high, 1e-12)
+        cpd, (low, high) = k.central_point_dominance(k=n // 2, seed=0)
+        assert low <= cpd <= high
+        cpd, (low, high) = k.central_point_dominance(error=1e-6, seed=1)
+        assert float_eq(cpd, exact, 1e-6)
+
+
+def test_sampled_average_SPL(assortative, semibinary):
+    for k in (assortative, semibinary):
+        n = len(k.graph_simpl)
+        for dist_weight in (False, True):
+            exact = k.average_SPL(dist_weight=dist_weight)
+            aspl, se = k.average_SPL(dist_weight=dist_weight, k=n, seed=0)
+            assert float_eq(aspl, exact, 1e-12)
+            assert se == 0
+            aspl, se = k.average_SPL(dist_weight=dist_weight, k=n // 2,
+                                     seed=0, backend='python')
+            assert abs(aspl - exact) <= 5 * se + 1e-12
+
+
+def test_parallel_betweenness(semibinary):
+    bet_cen = semibinary.betweenness()
+    expected = nx.betweenness_centrality(semibinary.graph_simpl)
+    assert bet_cen.keys() == expected.keys()
+    for node in expected:
+        assert float_eq(bet_cen[node], expected[node], 1e-12)
+    parallel = semibinary.betweenness(n_jobs=2)
+    for node in expected:
+        assert float_eq(parallel[node], bet_cen[node], 1e-12)
+    assert float_eq(semibinary.central_point_dominance(n_jobs=2),
+                    semibinary.central_point_dominance(), 1e-12)
+
+
+def test_block_decomposition():
+    # Tree with a loop and a separate cycle: cut vertices, bridges and
+    # cyclic blocks
+    edges = [[0, 1], [1, 2], [2, 3], [3, 4], [4, 1], [4, 5], [5, 6],
+             [5, 7], [8, 9], [9, 10], [10, 11], [11, 8], [11, 12]]
+    coord = {i: (float(i), float(i % 3), 0.) for i in range(13)}
+    k = kn.KGraph(edges, coord, verbose=False)
+    g = k.graph_simpl
+    expected = nx.betweenness_centrality(g)
+    bet_cen = k.betweenness()
+    for node in expected:
+        assert float_eq(bet_cen[node], expected[node], 1e-12)
+    aspl = 0
+    for c in nx.connected_components(g):
+        sub = g.subgraph(c)
+        aspl += len(c) * nx.average_shortest_path_length(sub)
+    assert float_eq(k.average_SPL(), aspl / len(g), 1e-12)
+    aspl = 0
+    for c in nx.connected_components(g):
+        sub = g.subgraph(c)
+        aspl += len(c) * nx.average_shortest_path_length(sub,
+                                                          weight='length')
+    assert float_eq(k.average_SPL(dist_weight=True), aspl / len(g), 1e-12)
+
+
+def test_metric_cache(semibinary):
+    semibinary.clear_metric_cache()
+    results = semibinary.characterize_graph()
+    assert ('average_SPL', (('dist_weight', False), ('k', None),
+                            ('seed', None))) in semibinary.metric_cache
+    assert semibinary.characterize_graph() == results
+    assert semibinary.average_SPL() == results["aspl"]
+    # The backend does not change the result and is not part of the key
+    nb_keys = len(semibinary.metric_cache)
+    assert semibinary.average_SPL(backend='python') == results["aspl"]
+    assert len(semibinary.metric_cache) == nb_keys
+    semibinary.length_entropy(mode="sturges")
+    keys = [key for key in semibinary.metric_cache
+            if key[0] == 'length_entropy']
+    assert len(keys) == 2
+    semibinary.clear_metric_cache('length_entropy')
+    assert all(key[0] != 'length_entropy'
+               for key in semibinary.metric_cache)
+    semibinary.clear_metric_cache()
+    assert semibinary.metric_cache == {}
+
+    k = kn.KGraph([[0, 1], [1, 2]], {0: (0, 0, 0), 1: (1, 0, 0),
+                                     2: (1, 2, 0)}, verbose=False)
+    assert k.mean_length() == 3
+    k.add_edges([[2, 3]], {3: (1, 6, 0)})
+    assert k.mean_length() == 7
+
+
+def test_characterize_graph_metrics(semibinary):
+    semibinary.clear_metric_cache()
+    results = semibinary.characterize_graph(
+        metrics=['correlation vertex degree', 'mean length'])
+    assert list(results) == ['mean length', 'correlation vertex degree']
+    names = {key[0] for key in semibinary.metric_cache}
+    assert names == {'mean_length', 'mean_degree_and_CV',
+                     'correlation_vertex_degree'}
+    assert semibinary.characterize_graph(metrics='cpd') == \
+        {'cpd': semibinary.central_point_dominance()}
+    assert 'average_SPL' not in {key[0] for key in semibinary.metric_cache}
+    all_metrics = semibinary.characterize_graph()
+    for key in results:
+        assert results[key] == all_metrics[key]
+    with pytest.raises(ValueError):
+        semibinary.characterize_graph(metrics=['diameter'])
+
+
+def test_parallel_characterize_graph(assortative):
+    assortative.clear_metric_cache()
+    expected = assortative.characterize_graph()
+    for executor in ('thread', 'process'):
+        assortative.clear_metric_cache()
+        results = assortative.characterize_graph(executor=executor)
+        assert results == expected
+        assert ('mean_length', ()) in assortative.metric_cache
+    with pytest.raises(ValueError):
+        assortative.characterize_graph(executor='cluster')
+
+
+def test_characterize_batch(tmp_path):
+    basename = str(tmp_path / "cave")
+    np.savetxt(basename + "_nodes.dat", [[0, 0, 0], [1, 0, 0], [1, 1, 0],
+                                         [2, 1, 1], [1, 2, 0]])
+    np.savetxt(basename + "_links.dat", [[1, 2], [2, 3], [3, 4], [3, 5]],
+               fmt="%d")
+    expected = kn.from_nodlink_dat(basename, verbose=False) \
+        .characterize_graph(metrics=['mean length', 'cpd'])
+
+    sources = [basename, str(tmp_path / "missing.sql"),
+               basename + "_links.dat"]
+    streamed = []
+    results = kn.characterize_batch(sources, metrics=['mean length', 'cpd'],
+                                    n_jobs=2, callback=streamed.append)
+    assert len(streamed) == 3
+    assert [result['index'] for result in results] == [0, 1, 2]
+    assert [result['ok'] for result in results] == [True, False, True]
+    assert results[1]['error'].startswith('OSError')
+    assert np.isnan(results[1]['cpd'])
+    for result in (results[0], results[2]):
+        assert result['import_time'] >= 0 and result['metrics_time'] >= 0
+        assert result['mean length'] == expected['mean length']
+        assert result['cpd'] == expected['cpd']
+
+    records = kn.characterize_batch(sources, metrics=['mean length', 'cpd'],
+                                    n_jobs=1, output='records')
+    assert list(records.ok) == [True, False, True]
+    assert records['cpd'][0] == expected['cpd']
+
+
+def test_from_pline(tmp_path):
+    filename = str(tmp_path / "cave.pl")
+    with open(filename, 'w') as f:
+        f.write("GOCAD PLine 1\nHEADER {\nname:cave\n}\nILINE\n"
+                "PVRTX 1 0 0 0 1.5\nPVRTX 2 1 0 0 2.5\nSEG 1 2\n"
+                "ILINE\nATOM 3 2\nPVRTX 4 1 1 0 3.5\n"
+                "PVRTX 5 1 2  1 4.5\nSEG 3 4\nSEG 4 5\nILINE\n"
+                "ATOM 6 4\nVRTX 7 2 1 0\nSEG 6 7\nEND\n")
+    k = kn.from_pline(filename, verbose=False)
+    assert sorted(k.graph.edges()) == [(1, 2), (2, 3), (3, 4), (3, 5)]
+    assert np.array_equal(k.pos3d[4], [1, 2, 1])
+    assert k.properties[3] == {0: 3.5}
+    assert k.properties[5] == {}
+
+    # Indented records and tab separators
+    with open(filename, 'w') as f:
+        f.write("GOCAD PLine 1\nILINE\n  VRTX 1 0 0 0\n\tVRTX\t2\t1\t0\t0\n"
+                "  SEG 1 2\nILINE\n\tATOM 3 2\nVRTX 4 1 1 0\n"
+                "SEG\t3\t4\nEND\n")
+    k = kn.from_pline(filename, verbose=False)
+    assert sorted(k.graph.edges()) == [(1, 2), (2, 3)]
+    assert k.pos3d[3] == [1., 1., 0.]
+
+
+def test_save_load(tmp_path, semibinary):
+    path = str(tmp_path / "karst.kgraph")
+    semibinary.properties = {1: {'flag': 'fixed'}}
+    semibinary.save(path)
+    with kn.Profiler() as prof:
+        k = kn.load(path)
+    assert prof.stats == {}
+    assert k.properties == semibinary.properties
+    assert sorted(k.graph.edges()) == sorted(semibinary.graph.edges())
+    assert np.array_equal(k.br_lengths, semibinary.br_lengths)
+    assert isinstance(k.br_lengths, np.memmap)
+    assert float_eq(k.average_SPL(), semibinary.average_SPL())
+    assert prof.stats == {}
+
+    # The saved files are not modified by the loaded KGraph
+    k.remove_edges([next(iter(k.graph.edges()))])
+    assert np.array_equal(kn.load(path, mmap=False).br_lengths,
+                          semibinary.br_lengths)
+
+
+def test_save_load_objects(tmp_path):
+    # Names, edge dictionnaries and properties are stored without pickle
+    path = str(tmp_path / "karst.kgraph")
+    edges = [((0, 'a'), 'b', {'type': 'shot', 'flags': ('dup',)}),
+             ('b', 3, {'type': None})]
+    pos = {(0, 'a'): [0, 0, 0], 'b': [1, 0, 0], 3: [1, 1, 0],
+           'c': [2, 2, 2]}
+    properties = {3: {0: 1.5}, 'b': [1, float('nan')]}
+    k = kn.KGraph(edges, pos, properties, verbose=False)
+    k.save(path)
+    assert not os.path.exists(os.path.join(path, 'objects.pkl'))
+    loaded = kn.load(path)
+    assert list(loaded.pos3d) == [(0, 'a'), 'b', 3, 'c']
+    assert loaded.properties[3] == {0: 1.5}
+    assert np.isnan(loaded.properties['b'][1])
+    assert list(loaded.edge_array('type')) == ['shot', None]
+    assert loaded.graph.edges[(0, 'a'), 'b']['flags'] == ('dup',)
+
+    # Other objects are only pickled, and read, on request
+    k.properties = {3: {1, 2}}
+    with pytest.raises(TypeError):
+        k.save(path)
+    k.save(path, allow_pickle=True)
+    with pytest.raises(ValueError):
+        kn.load(path)
+    assert kn.load(path, allow_pickle=True).properties == {3: {1, 2}}
+
+
+def test_from_nodlink_dat_cache(tmp_path):
+    basename = str(tmp_path / "karst")
+    with open(basename + "_nodes.dat", 'w') as f:
+        f.write("0 0 0\n1 0 0\n1 1 0\n")
+    with open(basename + "_links.dat", 'w') as f:
+        f.write("1 2\n2 3\n")
+    # No file is written by default
+    k = kn.from_nodlink_dat(basename, verbose=False)
+    assert not os.path.exists(basename + "_nodes.dat.npy")
+    k = kn.from_nodlink_dat(basename, verbose=False, cache=True)
+    assert k.properties == {}
+    assert sorted(k.graph.edges()) == [(0, 1), (1, 2)]
+    assert os.path.exists(basename + "_nodes.dat.npy")
+
+    # The cache is used while the size and the time of the file match
+    stat = os.stat(basename + "_nodes.dat")
+    with open(basename + "_nodes.dat", 'w') as f:
+        f.write("0 0 0\n2 0 0\n2 2 0\n")
+    os.utime(basename + "_nodes.dat", ns=(stat.st_atime_ns,
+                                           stat.st_mtime_ns))
+    k = kn.from_nodlink_dat(basename, verbose=False, cache=True)
+    assert np.array_equal(k.pos3d[2], [1, 1, 0])
+    os.utime(basename + "_nodes.dat", ns=(stat.st_atime_ns,
+                                           stat.st_mtime_ns + 10 ** 9))
+    k = kn.from_nodlink_dat(basename, verbose=False, cache=True)
+    assert np.array_equal(k.pos3d[2], [2, 2, 0])
+
+    # Chunks parsed in parallel
+    from karstnet.import_fc import _read_dat
+    nodes = _read_dat(basename + "_nodes.dat", chunk_size=4, n_jobs=2,
+                      cache=False)
+    assert np.array_equal(nodes, [[0, 0, 0], [2, 0, 0], [2, 2, 0]])
+
+
+THERION_SQL = """\
+create table SURVEY (ID integer, PARENT_ID integer, NAME varchar(4), \
+FULL_NAME varchar(4), TITLE varchar(4));
+create table STATION (ID integer, NAME varchar(4), SURVEY_ID integer, \
+X real, Y real, Z real);
+create table STATION_FLAG (STATION_ID integer, FLAG char(3));
+create table SHOT (ID integer, FROM_ID integer, TO_ID integer, \
+CENTRELINE_ID integer, LENGTH real);
+create table SHOT_FLAG (SHOT_ID integer, FLAG char(3));
+create table MAPS (ID integer, SURVEY_ID integer, NAME varchar(4));
+insert into SURVEY values (1, 0, '', '', NULL);
+insert into SURVEY values (2, 1, 'cave', 'cave', 'The cave');
+insert into STATION values (1, '0', 2, 0.00, 0.00, 0.00);
+insert into STATION values (2, '1', 2, 10.00, 0.00, -1.00);
+insert into STATION values (3, '2', 2, 10.00, 5.00, -2.00);
+insert into STATION values (4, '.', 2, 11.00, 5.00, -2.00);
+insert into STATION_FLAG values (1, 'ent');
+insert into SHOT values (1, 1, 2, 3, 10.05);
+insert into SHOT values (2, 2, 3, 3, 5.10);
+insert into SHOT values (3, 3, 4, 3, 1.00);
+insert into SHOT_FLAG values (2, 'srf');
+insert into MAPS values (1, 2, 'plan');
+"""
+
+
+def test_therion_sql_cache(tmp_path):
+    basename = str(tmp_path / "cave")
+    with open(basename + ".sql", 'w') as f:
+        f.write(THERION_SQL)
+    # No file is written by default
+    k = kn.from_therion_sql(basename, verbose=False)
+    assert not os.path.exists(basename + ".sql.sqlite")
+    k = kn.from_therion_sql(basename, verbose=False, cache=True)
+    assert sorted(k.graph.edges()) == [(0, 1), (1, 2)]
+    assert k.properties == {}
+    conn = sqlite3.connect(basename + ".sql.sqlite")
+    indexes = conn.execute("select name from sqlite_master "
+                           "where type = 'index'").fetchall()
+    conn.close()
+    assert sorted(indexes) == [('SHOT_FLAG_SHOT_ID',), ('SHOT_FROM_ID',),
+                               ('SHOT_TO_ID',), ('STATION_ID',)]
+    k = kn.from_therion_sql(basename, verbose=False, cache=True)
+    assert np.array_equal(k.pos3d[2], [10, 5, -2])
+
+    # The database is converted again when the SQL file changes
+    with open(basename + ".sql", 'w') as f:
+        f.write(THERION_SQL.replace("10.00, 5.00", "12.00, 5.00"))
+    k = kn.from_therion_sql(basename, verbose=False, cache=True)
+    assert np.array_equal(k.pos3d[2], [12, 5, -2])
+    k = kn.from_therion_sql(basename, verbose=False, cache=False)
+    assert np.array_equal(k.pos3d[2], [12, 5, -2])
+
+
+def test_therion_sql_enhanced_missing_file(tmp_path):
+    # The error of the missing file is raised, not a later query error
+    with pytest.raises(FileNotFoundError):
+        kn.from_therion_sql_enhanced(str(tmp_path / "missing.sql"))
+    assert not os.path.exists(str(tmp_path / "missing.sql.sqlite"))
+
+
+def test_therion_sql_stream(tmp_path):
+    basename = str(tmp_path / "cave")
+    with open(basename + ".sql", 'w') as f:
+        f.write(THERION_SQL)
+    expected = kn.from_therion_sql(basename, verbose=False, cache=False)
+    k = kn.from_therion_sql(basename, verbose=False, engine='stream')
+    assert sorted(k.graph.edges()) == sorted(expected.graph.edges())
+    assert all(np.array_equal(k.pos3d[n], expected.pos3d[n])
+               for n in expected.pos3d)
+
+    expected = kn.from_therion_sql_enhanced(basename + ".sql", cache=False)
+    G = kn.from_therion_sql_enhanced(basename + ".sql", engine='stream')
+    assert list(G.nodes(data=True)) == list(expected.nodes(data=True))
+    assert list(G.edges(data=True)) == list(expected.edges(data=True))
+    assert [d for _, _, d in G.edges(data=True) if d] == [{'flags': ['srf']}]
+
+    # Statement on several lines
+    with open(basename + ".sql", 'a') as f:
+        f.write("insert into STATION values (5, 'a\nb', 2, 0, 0, 0);\n")
+    with pytest.raises(ValueError):
+        kn.from_therion_sql(basename, verbose=False, engine='stream')
+    with pytest.raises(ValueError):
+        kn.from_therion_sql(basename, verbose=False, engine='python')